@@ -1,18 +1,28 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 import os
+import threading
+import time
 
-from database import get_db
+from database import ShardMovingError, get_db, get_read_db, get_replica_db, shards
 from models import User, Merchant, Customer
+from server_timing import phase
 
 SECRET_KEY = os.getenv("SECRET_KEY", "change-this-in-production-to-a-random-secret-key-min-32-chars")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))  # 24 hours
+# How long scan-rate endpoints reuse a resolved merchant (a deactivated account keeps access that long)
+PRINCIPAL_CACHE_SECONDS = float(os.getenv("PRINCIPAL_CACHE_SECONDS", "30"))
+PRINCIPAL_CACHE_SIZE = 10000
+
+_principals: "OrderedDict[int, Tuple[float, Merchant]]" = OrderedDict()
+_principals_lock = threading.Lock()
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
@@ -36,8 +46,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
-    """Get current authenticated user from JWT token"""
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)) -> User:
+    """Get current authenticated user from JWT token (resolved through the read pool)"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -45,31 +55,79 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except JWTError:
+        # Tokens carry the user id as a string, as the JWT spec requires for "sub"
+        user_id = int(payload.get("sub"))
+    except (JWTError, TypeError, ValueError):
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
+    with phase("auth"):
+        user = db.query(User).filter(User.id == user_id).first()
+    # The principal is used detached; don't pin a read connection for the rest of the request
+    db.close()
     if user is None or not user.is_active:
         raise credentials_exception
     return user
 
-async def get_current_merchant(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)) -> Merchant:
+async def get_current_merchant(current_user: User = Depends(get_current_user), db: Session = Depends(get_read_db)) -> Merchant:
     """Get current merchant for merchant endpoints"""
-    merchant = db.query(Merchant).filter(Merchant.user_id == current_user.id).first()
+    with phase("auth"):
+        merchant = db.query(Merchant).filter(Merchant.user_id == current_user.id).first()
+    db.close()
     if not merchant:
         raise HTTPException(status_code=404, detail="Merchant profile not found")
     return merchant
 
-async def get_current_customer(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)) -> Customer:
+async def get_cached_merchant(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)) -> Merchant:
+    """
+    get_current_merchant for endpoints terminals call on every scan: the token
+    is still verified each time, but the user -> merchant lookup is reused for
+    PRINCIPAL_CACHE_SECONDS.
+    """
+    try:
+        user_id = int(jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub"))
+    except (JWTError, TypeError, ValueError):
+        user_id = None
+    now = time.monotonic()
+    with _principals_lock:
+        cached = _principals.get(user_id)
+        if cached is not None and cached[0] > now:
+            _principals.move_to_end(user_id)
+            return cached[1]
+    # Misses (and invalid tokens, which raise here) take the uncached path
+    merchant = await get_current_merchant(await get_current_user(token, db), db)
+    with _principals_lock:
+        _principals[user_id] = (now + PRINCIPAL_CACHE_SECONDS, merchant)
+        _principals.move_to_end(user_id)
+        while len(_principals) > PRINCIPAL_CACHE_SIZE:
+            _principals.popitem(last=False)
+    return merchant
+
+async def get_current_customer(current_user: User = Depends(get_current_user), db: Session = Depends(get_read_db)) -> Customer:
     """Get current customer for customer endpoints"""
-    customer = db.query(Customer).filter(Customer.user_id == current_user.id).first()
+    with phase("auth"):
+        customer = db.query(Customer).filter(Customer.user_id == current_user.id).first()
+    db.close()
     if not customer:
         raise HTTPException(status_code=404, detail="Customer profile not found")
     return customer
 
+def merchant_moving_error() -> HTTPException:
+    """503 + Retry-After for writes to a merchant that is moving between shards"""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Merchant data is being migrated. Retry shortly.",
+        headers={"Retry-After": "2"},
+    )
 
+def get_merchant_db(current_merchant: Merchant = Depends(get_current_merchant), db: Session = Depends(get_db)):
+    """Session on the shard holding the merchant's transactions and inventory (writes)"""
+    try:
+        with shards.merchant_session(current_merchant.id, db, for_write=True) as merchant_db:
+            yield merchant_db
+    except ShardMovingError:
+        raise merchant_moving_error()
 
-
+def get_merchant_read_db(current_merchant: Merchant = Depends(get_current_merchant), db: Session = Depends(get_replica_db)):
+    """Session on the merchant's shard for reads (replica routing applies when unsharded)"""
+    with shards.merchant_session(current_merchant.id, db) as merchant_db:
+        yield merchant_db
@@ -2,24 +2,31 @@
 Biometric Authentication - Secure fingerprint verification
 Uses hash-based matching without decrypting stored templates
 """
+from sqlalchemy import func, literal_column, select, update
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from datetime import datetime
 
-from models import Fingerprint, Customer, User
+from models import Fingerprint, Customer
 from security_enclave import hash_fingerprint, verify_fingerprint_match
 
 def authenticate_with_fingerprint(
     fingerprint_sample: str,
-    db: Session
+    db: Session,
+    commit: bool = True
 ) -> dict:
     """
     Authenticate user using fingerprint sample.
     Uses hash-based matching for security - never decrypts stored templates.
     
+    The lookup and the verification metadata bump are a single
+    UPDATE ... RETURNING statement, so one round trip authenticates.
+    
     Args:
         fingerprint_sample: Raw fingerprint data from scanner
         db: Database session
+        commit: Commit the metadata bump immediately. Pass False to let the
+            caller fold it into its own transaction.
     
     Returns:
         Dictionary with customer/user information
@@ -30,42 +37,53 @@ def authenticate_with_fingerprint(
     # Normalize and hash the sample
     sample_hash = hash_fingerprint(fingerprint_sample)
     
-    # Lookup by hash (no decryption needed)
-    fingerprint = db.query(Fingerprint).filter(
-        Fingerprint.template_hash == sample_hash,
-        Fingerprint.is_active == True
+    # Lookup by hash (no decryption needed) and update verification metadata
+    # Hash lookup is sufficient - if hash matches, fingerprint matches
+    # RETURNING renders columns unqualified, so the correlation is spelled out
+    customer_id_str = (
+        select(Customer.customer_id)
+        .where(Customer.id == literal_column("fingerprints.customer_id"))
+        .scalar_subquery()
+    )
+    row = db.execute(
+        update(Fingerprint)
+        .where(
+            Fingerprint.template_hash == sample_hash,
+            Fingerprint.is_active == True
+        )
+        .values(
+            last_verified_at=datetime.utcnow(),
+            verification_count=func.coalesce(Fingerprint.verification_count, 0) + 1
+        )
+        .returning(
+            Fingerprint.id,
+            Fingerprint.customer_id,
+            Fingerprint.user_id,
+            Fingerprint.last_verified_at,
+            customer_id_str
+        )
+        .execution_options(synchronize_session=False)
     ).first()
     
-    if not fingerprint:
+    if not row:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Fingerprint not registered. Please enroll first."
         )
     
-    # Verify match using constant-time comparison (already matched by hash lookup)
-    # Hash lookup is sufficient - if hash matches, fingerprint matches
-    
-    # Update verification metadata
-    fingerprint.last_verified_at = datetime.utcnow()
-    fingerprint.verification_count += 1
-    db.commit()
-    
-    # Get associated customer/user
-    customer = None
-    if fingerprint.customer_id:
-        customer = db.query(Customer).filter(Customer.id == fingerprint.customer_id).first()
+    if commit:
+        db.commit()
     
-    user = None
-    if fingerprint.user_id:
-        user = db.query(User).filter(User.id == fingerprint.user_id).first()
+    fingerprint_id, customer_id, user_id, last_verified_at, customer_id_str = row
     
     return {
         "verified": True,
-        "customer_id": customer.id if customer else None,
-        "customer_id_str": customer.customer_id if customer else None,
-        "user_id": user.id if user else None,
-        "fingerprint_id": fingerprint.id,
-        "last_verified": fingerprint.last_verified_at.isoformat()
+        "customer_id": customer_id,
+        "customer_id_str": customer_id_str,
+        "user_id": user_id,
+        "fingerprint_id": fingerprint_id,
+        "template_hash": sample_hash,
+        "last_verified": last_verified_at.isoformat()
     }
 
 def check_fingerprint_exists(
@@ -0,0 +1,132 @@
+"""
+Barcode Cache - scan-time inventory lookups served from memory
+Terminals look up every scan by barcode. Results, including unknown barcodes,
+are kept per merchant under one global entry bound, evicting the least
+recently used merchant first. Writers register the barcodes they touch on
+their session and the entries are dropped when that transaction commits.
+Entries also expire after BARCODE_CACHE_TTL_SECONDS, which bounds staleness
+from writes made by other processes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+BARCODE_CACHE_MAX_ENTRIES = int(os.getenv("BARCODE_CACHE_MAX_ENTRIES", "100000"))
+BARCODE_CACHE_TTL_SECONDS = float(os.getenv("BARCODE_CACHE_TTL_SECONDS", "60"))
+
+# session.info key for invalidations waiting on the transaction's commit
+PENDING_KEY = "barcode_cache_pending"
+
+Row = Optional[tuple]  # (id, name, barcode, price, category, stock), None for an unknown barcode
+
+
+@dataclass
+class _MerchantEntries:
+    rows: Dict[str, Tuple[float, Row]] = field(default_factory=dict)
+    # Bumped by every invalidation, so a lookup that raced a write doesn't store what it read
+    generation: int = 0
+
+
+class BarcodeCache:
+    """Per-merchant barcode -> row cache with LRU eviction across merchants"""
+
+    def __init__(self, max_entries: int = BARCODE_CACHE_MAX_ENTRIES, ttl: float = BARCODE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._merchants: "OrderedDict[int, _MerchantEntries]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "invalidations": 0, "evicted_merchants": 0}
+
+    def lookup(self, merchant_pk: int, barcode: str) -> Tuple[bool, Row, tuple]:
+        """(found, row, fill token); on a miss pass the token to store() with the row read from the database"""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._merchants.get(merchant_pk)
+            if entries is None:
+                entries = self._merchants[merchant_pk] = _MerchantEntries()
+            self._merchants.move_to_end(merchant_pk)
+            cached = entries.rows.get(barcode)
+            if cached is not None:
+                if cached[0] > now:
+                    self.counters["hits"] += 1
+                    return True, cached[1], (entries, entries.generation)
+                del entries.rows[barcode]
+                self._size -= 1
+                self.counters["expired"] += 1
+            self.counters["misses"] += 1
+            return False, None, (entries, entries.generation)
+
+    def store(self, merchant_pk: int, barcode: str, row: Row, token: tuple) -> None:
+        """Remember a row read after lookup(); dropped if the merchant was invalidated or evicted meanwhile"""
+        entries, generation = token
+        with self._lock:
+            if self._merchants.get(merchant_pk) is not entries or entries.generation != generation:
+                return
+            if barcode not in entries.rows:
+                self._size += 1
+            entries.rows[barcode] = (time.monotonic() + self.ttl, row)
+            while self._size > self.max_entries and len(self._merchants) > 1:
+                _, evicted = self._merchants.popitem(last=False)
+                self._size -= len(evicted.rows)
+                self.counters["evicted_merchants"] += 1
+
+    def invalidate(self, merchant_pk: int, barcodes: Optional[Iterable[str]] = None) -> None:
+        """Drop the given barcodes, or every entry of the merchant when barcodes is None"""
+        with self._lock:
+            entries = self._merchants.get(merchant_pk)
+            if entries is None:
+                return
+            entries.generation += 1
+            self.counters["invalidations"] += 1
+            if barcodes is None:
+                self._size -= len(entries.rows)
+                entries.rows.clear()
+                return
+            for barcode in barcodes:
+                if entries.rows.pop(barcode, None) is not None:
+                    self._size -= 1
+
+    def invalidate_on_commit(
+        self, session: Session, merchant_pk: int, barcodes: Optional[Iterable[str]] = None
+    ) -> None:
+        """
+        Invalidate once the session's transaction commits. Invalidating before
+        the commit would let a concurrent lookup re-cache the old row.
+        """
+        pending = session.info.setdefault(PENDING_KEY, defaultdict(set))
+        if barcodes is None:
+            pending[merchant_pk] = None
+        elif pending[merchant_pk] is not None:
+            pending[merchant_pk].update(barcode for barcode in barcodes if barcode)
+
+    def metrics(self) -> Dict:
+        """Size and this process's hit rate since start"""
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                "entries": self._size,
+                "merchants": len(self._merchants),
+                **self.counters,
+                "hit_rate": round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+barcode_cache = BarcodeCache()
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending(session: Session) -> None:
+    for merchant_pk, barcodes in session.info.pop(PENDING_KEY, {}).items():
+        barcode_cache.invalidate(merchant_pk, barcodes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending(session: Session) -> None:
+    session.info.pop(PENDING_KEY, None)
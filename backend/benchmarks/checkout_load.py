@@ -0,0 +1,380 @@
+"""
+Checkout load test
+Seeds merchants with inventory, fingerprint-enrolled customers and a share of
+saved cards through the public API, then drives a weighted mix of fingerprint
+verification, checkout, barcode lookups and dashboard reads from concurrent
+async clients. Reports throughput and p50/p95/p99 per endpoint and, from the
+Server-Timing header (SERVER_TIMING=true on the API), per phase: fingerprint
+lookup, database work, commits and the provider call.
+
+With --spawn the provider stand-in and the API are started here on a scratch
+SQLite database, with the API's Stripe calls and webhooks wired to the
+stand-in. Otherwise point --base-url at an API that already talks to one.
+
+Usage:
+    python -m benchmarks.checkout_load --spawn --duration 60 --concurrency 32
+    python -m benchmarks.checkout_load --spawn --provider-latency lognormal:150:0.5 --slo checkout=600,verify=50
+    python -m benchmarks.checkout_load --base-url http://127.0.0.1:8000 --mix verify=4,checkout=3,barcode=2,dashboard=1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "verify=3,checkout=3,barcode=3,dashboard=1"
+DASHBOARD_PATHS = {
+    "dashboard:stats": "/api/merchant/stats",
+    "dashboard:transactions": "/api/transactions?limit=20",
+    "dashboard:customers": "/api/merchant/customers?limit=20",
+}
+
+
+def parse_weights(raw: str) -> Dict[str, float]:
+    weights = {}
+    for entry in raw.split(","):
+        name, _, weight = entry.partition("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def parse_server_timing(value: Optional[str]) -> Dict[str, float]:
+    """'db;dur=1.2, provider;dur=80' -> {'db': 1.2, 'provider': 80.0}"""
+    phases = {}
+    for entry in (value or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        for param in params.split(";"):
+            key, _, duration = param.strip().partition("=")
+            if key == "dur" and name:
+                phases[name] = float(duration)
+    return phases
+
+
+@dataclass
+class Merchant:
+    token: str
+    barcodes: List[str]
+    prices: Dict[str, float]
+
+
+@dataclass
+class Shopper:
+    fingerprint: str
+    payment_method_id: Optional[int] = None
+
+
+@dataclass
+class Recorder:
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    phases: Dict[str, Dict[str, List[float]]] = field(default_factory=lambda: defaultdict(lambda: defaultdict(list)))
+    statuses: Dict[str, Counter] = field(default_factory=lambda: defaultdict(Counter))
+    enabled: bool = False
+
+    def record(self, endpoint: str, elapsed_ms: float, response: Optional[httpx.Response]) -> None:
+        if not self.enabled:
+            return
+        self.latencies[endpoint].append(elapsed_ms)
+        self.statuses[endpoint][response.status_code if response is not None else "error"] += 1
+        if response is not None:
+            for name, duration in parse_server_timing(response.headers.get("server-timing")).items():
+                self.phases[endpoint][name].append(duration)
+
+    def report(self, elapsed: float) -> Dict:
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            ordered = sorted(values)
+            statuses = self.statuses[endpoint]
+            failures = sum(count for code, count in statuses.items() if code == "error" or code >= 500)
+            endpoints[endpoint] = {
+                "requests": len(ordered),
+                "throughput_rps": round(len(ordered) / elapsed, 1),
+                "failures": failures,
+                "statuses": {str(code): count for code, count in statuses.items()},
+                **{f"p{q}_ms": round(percentile(ordered, q), 1) for q in (50, 95, 99)},
+                "phases": {
+                    name: {f"p{q}_ms": round(percentile(sorted(durations), q), 1) for q in (50, 95, 99)}
+                    for name, durations in self.phases[endpoint].items()
+                },
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {"elapsed_seconds": round(elapsed, 1), "throughput_rps": round(total / elapsed, 1), "endpoints": endpoints}
+
+
+async def timed(client: httpx.AsyncClient, recorder: Recorder, endpoint: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    response = None
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+        pass
+    recorder.record(endpoint, (time.perf_counter() - started) * 1000, response)
+    return response
+
+
+async def seed(client: httpx.AsyncClient, args, rng: random.Random) -> Tuple[List[Merchant], List[Shopper]]:
+    """Merchants, inventory, customers and cards through the public API"""
+    run = uuid.uuid4().hex[:8]
+    password = "load-test-password"
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(url: str, payload: Dict, token: Optional[str] = None) -> Dict:
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        async with semaphore:
+            response = await client.post(url, json=payload, headers=headers)
+        if response.status_code >= 400:
+            sys.exit(f"Seeding failed: POST {url} -> {response.status_code} {response.text[:300]}")
+        return response.json()
+
+    async def add_merchant(number: int) -> Merchant:
+        token = (await post("/api/auth/register", {
+            "name": f"Load Merchant {number}",
+            "email": f"load-{run}-merchant{number}@example.com",
+            "password": password,
+            "company_name": f"Load Test Store {number}",
+        }))["access_token"]
+        barcodes = [f"{run}{number:04d}{item:06d}" for item in range(args.items)]
+        prices = {barcode: round(rng.uniform(0.5, 40.0), 2) for barcode in barcodes}
+        await asyncio.gather(*(
+            post("/api/inventory", {
+                "name": f"Item {barcode}", "barcode": barcode, "price": prices[barcode], "stock": 1_000_000
+            }, token)
+            for barcode in barcodes
+        ))
+        return Merchant(token=token, barcodes=barcodes, prices=prices)
+
+    async def add_shopper(number: int, with_card: bool) -> Shopper:
+        email = f"load-{run}-customer{number}@example.com"
+        shopper = Shopper(fingerprint=secrets.token_hex(32).upper())
+        token = None
+        if with_card:
+            # A customer login linked by email is what may save cards
+            token = (await post("/api/auth/register", {
+                "name": f"Load Customer {number}", "email": email, "password": password, "role": "customer"
+            }))["access_token"]
+        await post("/api/customers/register", {
+            "name": f"Load Customer {number}", "email": email, "fingerprint_hash": shopper.fingerprint
+        })
+        if with_card:
+            shopper.payment_method_id = (await post("/api/customers/payment-methods", {
+                "type": "credit_card", "name": "Visa", "last4": "4242",
+                "encrypted_data": "pm_card_visa", "is_default": True
+            }, token))["id"]
+        return shopper
+
+    merchants = await asyncio.gather(*(add_merchant(number) for number in range(args.merchants)))
+    shoppers = await asyncio.gather(*(
+        add_shopper(number, rng.random() < args.card_share) for number in range(args.customers)
+    ))
+    return list(merchants), list(shoppers)
+
+
+async def drive(client: httpx.AsyncClient, args, merchants: List[Merchant], shoppers: List[Shopper]) -> Dict:
+    weights = parse_weights(args.mix)
+    operations, operation_weights = list(weights), list(weights.values())
+    recorder = Recorder()
+    stop_at = time.perf_counter() + args.warmup + args.duration
+
+    async def verify(rng: random.Random) -> None:
+        known = rng.random() >= args.unknown_share
+        fingerprint = rng.choice(shoppers).fingerprint if known else secrets.token_hex(32).upper()
+        await timed(client, recorder, "verify", "POST", "/api/customers/verify-fingerprint",
+                    json={"fingerprint_hash": fingerprint})
+
+    async def checkout(rng: random.Random) -> None:
+        merchant, shopper = rng.choice(merchants), rng.choice(shoppers)
+        basket = rng.sample(merchant.barcodes, min(len(merchant.barcodes), rng.randint(1, 4)))
+        await timed(
+            client, recorder, "checkout", "POST", "/api/transactions/create",
+            json={
+                "cart": [{"barcode": barcode, "quantity": rng.randint(1, 3)} for barcode in basket],
+                "fingerprint_hash": shopper.fingerprint,
+                "payment_method_id": shopper.payment_method_id,
+                "pos_provider": args.provider,
+            },
+            headers={"Authorization": f"Bearer {merchant.token}", "Idempotency-Key": uuid.uuid4().hex},
+        )
+
+    async def barcode(rng: random.Random) -> None:
+        merchant = rng.choice(merchants)
+        await timed(client, recorder, "barcode", "GET", f"/api/inventory/barcode/{rng.choice(merchant.barcodes)}",
+                    headers={"Authorization": f"Bearer {merchant.token}"})
+
+    async def dashboard(rng: random.Random) -> None:
+        endpoint, path = rng.choice(list(DASHBOARD_PATHS.items()))
+        await timed(client, recorder, endpoint, "GET", path,
+                    headers={"Authorization": f"Bearer {rng.choice(merchants).token}"})
+
+    handlers = {"verify": verify, "checkout": checkout, "barcode": barcode, "dashboard": dashboard}
+    unknown = set(operations) - set(handlers)
+    if unknown:
+        sys.exit(f"Unknown operations in --mix: {', '.join(sorted(unknown))}")
+
+    async def client_loop(number: int) -> None:
+        rng = random.Random(args.seed * 1000 + number)
+        while time.perf_counter() < stop_at:
+            await handlers[rng.choices(operations, operation_weights)[0]](rng)
+            if args.think_ms:
+                await asyncio.sleep(rng.expovariate(1000 / args.think_ms))
+
+    async def start_recording() -> None:
+        await asyncio.sleep(args.warmup)
+        recorder.enabled = True
+
+    clients = [asyncio.ensure_future(client_loop(number)) for number in range(args.concurrency)]
+    await start_recording()
+    started = time.perf_counter()
+    await asyncio.gather(*clients)
+    return recorder.report(time.perf_counter() - started)
+
+
+def check_slos(report: Dict, slos: Dict[str, float]) -> List[str]:
+    breaches = []
+    for endpoint, target in slos.items():
+        observed = report["endpoints"].get(endpoint, {}).get("p99_ms")
+        if observed is not None and observed > target:
+            breaches.append(f"{endpoint} p99 {observed:.0f} ms exceeds the {target:.0f} ms SLO")
+    return breaches
+
+
+def print_report(report: Dict) -> None:
+    print(f"\n{report['throughput_rps']} req/s over {report['elapsed_seconds']} s")
+    print(f"{'endpoint':<24}{'reqs':>8}{'rps':>9}{'fail':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for endpoint, stats in report["endpoints"].items():
+        print(
+            f"{endpoint:<24}{stats['requests']:>8}{stats['throughput_rps']:>9}{stats['failures']:>7}"
+            f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}"
+        )
+        for name, phase in stats["phases"].items():
+            print(f"  {name:<30}{'':>15}{phase['p50_ms']:>9}{phase['p95_ms']:>9}{phase['p99_ms']:>9}")
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"{url} exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    sys.exit(f"{url} did not come up within {timeout:.0f} s")
+
+
+def spawn(args, processes: List[subprocess.Popen]) -> None:
+    """Provider stand-in plus the API on a scratch database, wired together"""
+    standin_url = f"http://127.0.0.1:{args.standin_port}"
+    api_port = int(args.base_url.rsplit(":", 1)[1])
+    standin = subprocess.Popen(
+        [
+            sys.executable, "-m", "benchmarks.provider_standin", "--port", str(args.standin_port),
+            "--latency", args.provider_latency, "--error-rate", str(args.provider_error_rate),
+            "--webhook-url", f"{args.base_url}/api/webhooks/stripe", "--webhook-secret", "whsec_standin",
+            "--seed", str(args.seed),
+        ],
+        cwd=BACKEND_DIR,
+    )
+    processes.append(standin)
+    wait_until_up(f"{standin_url}/_standin/stats", standin)
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{tempfile.mkdtemp()}/checkout_load.db",
+        "STRIPE_API_BASE": standin_url,
+        "SQUARE_API_BASE": standin_url,
+        "STRIPE_SECRET_KEY": "sk_test_standin",
+        "STRIPE_WEBHOOK_SECRET": "whsec_standin",
+        "SQUARE_ACCESS_TOKEN": "standin",
+        "SQUARE_LOCATION_ID": "standin",
+        "SERVER_TIMING": "true",
+    }
+    env.setdefault("PROTEGA_MASTER_KEY", secrets.token_hex(32))
+    for name in ("DATABASE_SHARD_URLS", "DATABASE_REPLICA_URLS"):
+        env.pop(name, None)
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+    )
+    processes.append(api)
+    wait_until_up(f"{args.base_url}/healthz", api)
+
+
+async def run(args) -> Dict:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        seeding_started = time.perf_counter()
+        merchants, shoppers = await seed(client, args, rng)
+        print(
+            f"Seeded {len(merchants)} merchants x {args.items} items and {len(shoppers)} customers "
+            f"in {time.perf_counter() - seeding_started:.1f} s"
+        )
+        return await drive(client, args, merchants, shoppers)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8100")
+    parser.add_argument("--spawn", action="store_true", help="start the provider stand-in and the API here")
+    parser.add_argument("--standin-port", type=int, default=12111)
+    parser.add_argument("--provider-latency", default="lognormal:80:0.4", help="stand-in latency with --spawn")
+    parser.add_argument("--provider-error-rate", type=float, default=0.0)
+    parser.add_argument("--provider", default="stripe", help="pos_provider for checkouts")
+    parser.add_argument("--merchants", type=int, default=10)
+    parser.add_argument("--items", type=int, default=50, help="inventory items per merchant")
+    parser.add_argument("--customers", type=int, default=200)
+    parser.add_argument("--card-share", type=float, default=0.1, help="customers seeded with a saved card")
+    parser.add_argument("--unknown-share", type=float, default=0.05, help="verifications with unenrolled prints")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation weights")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a client's requests")
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="unrecorded seconds before measuring")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--slo", help="p99 targets in ms, e.g. checkout=600,verify=50; breaches exit non-zero")
+    parser.add_argument("--json", help="also write the report here")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    processes: List[subprocess.Popen] = []
+    try:
+        if args.spawn:
+            spawn(args, processes)
+        report = asyncio.run(run(args))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(report, handle, indent=2)
+    breaches = check_slos(report, parse_weights(args.slo)) if args.slo else []
+    for breach in breaches:
+        print(f"FAIL: {breach}")
+    sys.exit(1 if breaches else 0)
+
+
+if __name__ == "__main__":
+    main()
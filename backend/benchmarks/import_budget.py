@@ -0,0 +1,76 @@
+"""
+Import-time budget for the API
+Imports `main` in fresh interpreters with `-X importtime`, prints the
+fastest run's total and the packages that cost the most, and exits non-zero
+when the total exceeds the budget or a module that should load lazily
+(provider SDKs, HTTP clients) was imported at startup. Run it in CI.
+
+Usage:
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --budget-ms 900 --runs 7 --top 15
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import Counter
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "1200"))
+# Loaded on first provider call, never at startup
+LAZY_MODULES = ("stripe", "stripe_service", "httpx", "requests", "h2")
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def profile(module: str) -> dict:
+    """One cold import of `module`; returns {name: (self_us, cumulative_us, depth)}"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        sys.exit(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    modules = {}
+    for line in completed.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+    return modules
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5, help="cold imports; the fastest one is reported")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10, help="packages to list by self time")
+    args = parser.parse_args()
+
+    runs = [profile(args.module) for _ in range(max(1, args.runs))]
+    fastest = min(runs, key=lambda modules: modules[args.module][1])
+    total_ms = fastest[args.module][1] / 1000
+
+    by_package = Counter()
+    for name, (self_us, _, _) in fastest.items():
+        by_package[name.split(".")[0]] += self_us
+    print(f"import {args.module}: {total_ms:.0f} ms (fastest of {len(runs)}, budget {args.budget_ms:.0f} ms)")
+    for package, self_us in by_package.most_common(args.top):
+        print(f"  {package:<24} {self_us / 1000:8.1f} ms")
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f"import time {total_ms:.0f} ms exceeds the {args.budget_ms:.0f} ms budget")
+    eager = sorted(name for name in LAZY_MODULES if name in fastest)
+    if eager:
+        failures.append(f"imported at startup but should load lazily: {', '.join(eager)}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Hot-path micro-benchmarks
+Times the primitives every request pays for (fingerprint hashing, template
+encryption, JWT issue/decode, password checks, response models, provider
+status mapping, barcode cache hits and adapter payloads) and compares each
+against the stored baselines in microbench_baselines.json. Each benchmark is
+calibrated to run for at least --min-time per repeat. Comparisons use the best
+repeat, which is far steadier than the median on shared machines; both are
+stored.
+
+Baselines are per machine: refresh them with --save on the machine that
+runs the comparison (CI runner, laptop) before relying on the deltas.
+
+Usage:
+    python -m benchmarks.microbench
+    python -m benchmarks.microbench --filter auth. --repeats 7
+    python -m benchmarks.microbench --save
+    python -m benchmarks.microbench --threshold 15 --fail-on-regression
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PROTEGA_MASTER_KEY", "microbench" * 8)
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_microbench")
+os.environ.setdefault("SQUARE_ACCESS_TOKEN", "microbench")
+os.environ.setdefault("SQUARE_LOCATION_ID", "microbench")
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baselines.json")
+FINGERPRINT = "A1B2C3D4" * 8
+STATUSES = ["succeeded", "requires_action", "processing", "canceled", "COMPLETED", "FAILED", "pending", None]
+
+# name -> setup returning the operation to time
+BENCHMARKS: Dict[str, Callable[[], Callable[[], object]]] = {}
+
+
+def benchmark(name: str):
+    def register(setup: Callable[[], Callable[[], object]]):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@benchmark("security.hash_fingerprint")
+def _hash_fingerprint():
+    from security_enclave import hash_fingerprint
+    return lambda: hash_fingerprint(FINGERPRINT)
+
+
+@benchmark("security.encrypt_sensitive")
+def _encrypt_sensitive():
+    from security_enclave import encrypt_sensitive
+    return lambda: encrypt_sensitive(FINGERPRINT)
+
+
+@benchmark("security.decrypt_sensitive")
+def _decrypt_sensitive():
+    from security_enclave import decrypt_sensitive, encrypt_sensitive
+    salt_b64, payload_b64 = encrypt_sensitive(FINGERPRINT)
+    return lambda: decrypt_sensitive(salt_b64, payload_b64)
+
+
+@benchmark("auth.create_access_token")
+def _create_access_token():
+    from auth import create_access_token
+    return lambda: create_access_token(data={"sub": "42"})
+
+
+@benchmark("auth.decode_access_token")
+def _decode_access_token():
+    from jose import jwt
+    from auth import ALGORITHM, SECRET_KEY, create_access_token
+    token = create_access_token(data={"sub": "42"})
+    return lambda: jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
+@benchmark("auth.verify_password")
+def _verify_password():
+    from auth import get_password_hash, verify_password
+    hashed = get_password_hash("correct horse battery staple")
+    return lambda: verify_password("correct horse battery staple", hashed)
+
+
+@benchmark("schemas.TransactionResponse")
+def _transaction_response():
+    from schemas import TransactionResponse
+    fields = {
+        "transaction_id": "TXN-06GNA070PJ776000",
+        "customer_id": "CUST-06GNA070PJ776000",
+        "amount": 18.5,
+        "total": 19.98,
+        "status": "completed",
+        "items": [{"name": f"Item {number}", "price": 4.625} for number in range(4)],
+        "timestamp": datetime(2025, 1, 1, 12, 0),
+        "payment_provider": "stripe",
+        "provider_transaction_id": "pi_3Nq",
+        "client_secret": None,
+    }
+    return lambda: TransactionResponse(**fields).model_dump(mode="json")
+
+
+@benchmark("schemas.InventoryResponse")
+def _inventory_response():
+    from types import SimpleNamespace
+    from schemas import InventoryResponse
+    # from_attributes path, as for ORM rows
+    row = SimpleNamespace(id=7, name="Sparkling Water", barcode="0123456789012", price=1.5, category="drinks", stock=40)
+    return lambda: InventoryResponse.model_validate(row).model_dump(mode="json")
+
+
+@benchmark("payment_status.map_provider_status")
+def _map_provider_status():
+    from payment_status import map_provider_status
+    return lambda: [map_provider_status(status) for status in STATUSES]
+
+
+@benchmark("inventory_search.memory_100k")
+def _inventory_search():
+    import itertools
+    import random
+    from inventory_search import MerchantIndex
+    rng = random.Random(7)
+    words = ["organic", "classic", "sparkling", "chocolate", "vanilla", "spicy", "roasted", "fresh", "whole",
+             "almond", "coffee", "cheddar", "tomato", "mango", "lemon", "garlic", "honey", "oat", "rice", "bean"]
+    nouns = ["bar", "juice", "water", "chips", "sauce", "milk", "bread", "soup", "cookies", "tea", "crackers", "jam"]
+    created = datetime(2025, 1, 1)
+    index = MerchantIndex()
+    index.apply(
+        (number, f"{rng.choice(words).title()} {rng.choice(words).title()} {rng.choice(nouns).title()} {number}",
+         f"{number:013d}", 2.5, rng.choice(["grocery", "drinks", "snacks", "dairy"]), 10, True, created)
+        for number in range(1, 100_001)
+    )
+    # Prefix, multi-word, misspelt and barcode lookups, as cashiers type them
+    queries = itertools.cycle(["choc", "sparkling water", "chedar", "almond mil", "00000000421", "honey oat bar", "mngo"])
+    return lambda: index.search(next(queries), 20)
+
+
+@benchmark("barcode_cache.lookup_hit")
+def _barcode_cache_hit():
+    from barcode_cache import BarcodeCache
+    cache = BarcodeCache()
+    _, _, token = cache.lookup(7, "0123456789012")
+    cache.store(7, "0123456789012", (1, "Sparkling Water", "0123456789012", 1.5, "drinks", 40), token)
+    return lambda: cache.lookup(7, "0123456789012")
+
+
+def _payment_request():
+    from pos import POSLineItem, POSPaymentRequest
+    return POSPaymentRequest(
+        amount=18.5,
+        total=19.98,
+        currency="usd",
+        customer_email="shopper@example.com",
+        customer_name="Shopper",
+        customer_reference="CUST-06GNA070PJ776000",
+        merchant_reference="MERCH-06GNA070PJ776000",
+        payment_method_token="pm_card_visa",
+        fingerprint_hash="F" * 64,
+        idempotency_key="MERCH-06GNA070PJ776000:TXN-06GNA070PJ776000",
+        metadata={"transaction_id": "TXN-06GNA070PJ776000"},
+        items=[POSLineItem(name=f"Item {number}", price=4.625) for number in range(4)],
+    )
+
+
+@benchmark("pos.stripe.prepare_payload")
+def _stripe_payload():
+    from pos.adapters.stripe_adapter import StripePOSAdapter
+    adapter, request = StripePOSAdapter(), _payment_request()
+    return lambda: adapter.prepare_payload(request)
+
+
+@benchmark("pos.square.prepare_payload")
+def _square_payload():
+    from pos.adapters.square_adapter import SquarePOSAdapter
+    adapter, request = SquarePOSAdapter(), _payment_request()
+    return lambda: adapter.prepare_payload(request)
+
+
+def measure(operation: Callable[[], object], repeats: int, min_time: float) -> Dict[str, float]:
+    """Median and best ns/op over `repeats` runs, each calibrated to last at least `min_time` seconds"""
+    operation()
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    samples: List[float] = [elapsed / number]
+    for _ in range(repeats - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            operation()
+        samples.append((time.perf_counter() - started) / number)
+    return {
+        "ns_per_op": round(statistics.median(samples) * 1e9, 1),
+        "best_ns_per_op": round(min(samples) * 1e9, 1),
+        "loops": number,
+    }
+
+
+def format_ns(value: float) -> str:
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if value >= scale:
+            return f"{value / scale:.2f} {unit}"
+    return f"{value:.0f} ns"
+
+
+def load_baselines(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", help="regex on benchmark names")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per repeat")
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--save", action="store_true", help="store these results as the new baselines")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.filter or re.search(args.filter, name)]
+    baselines = load_baselines(args.baselines).get("benchmarks", {})
+    results: Dict[str, Dict[str, float]] = {}
+    regressions = []
+
+    print(f"{'benchmark':<36}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name in names:
+        results[name] = measure(BENCHMARKS[name](), max(1, args.repeats), args.min_time)
+        current = results[name]["best_ns_per_op"]
+        baseline = baselines.get(name, {}).get("best_ns_per_op")
+        change, verdict = "", ""
+        if baseline:
+            delta = (current - baseline) / baseline * 100
+            change = f"{delta:+.1f}%"
+            if delta > args.threshold:
+                verdict = "  slower"
+                regressions.append(name)
+            elif delta < -args.threshold:
+                verdict = "  faster"
+        print(
+            f"{name:<36}{format_ns(baseline) if baseline else '-':>12}{format_ns(current):>12}{change:>10}{verdict}"
+        )
+
+    report = {
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} {platform.processor() or ''}".strip(),
+        "recorded_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "benchmarks": results,
+    }
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(report, handle, indent=2)
+    if args.save:
+        # Keep baselines for benchmarks that were filtered out of this run
+        report["benchmarks"] = {**baselines, **results}
+        with open(args.baselines, "w") as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+            handle.write("\n")
+        print(f"Saved baselines to {args.baselines}")
+    if regressions:
+        print(f"Slower than baseline by more than {args.threshold:.0f}%: {', '.join(regressions)}")
+    sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+POS fairness drill
+One large merchant floods a provider while small merchants keep trading;
+prints each merchant's throughput and queue time behind the provider
+bulkhead, plus the bulkhead metrics
+
+Usage:
+    python -m benchmarks.pos_fairness --limit 8 --big-clients 40 --small-merchants 5
+    python -m benchmarks.pos_fairness --weights MERCH-BIG=4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pos import POSPaymentRequest  # noqa: E402
+from pos.adapters.fake_adapter import FakePOSAdapter  # noqa: E402
+from pos.scheduler import FairBulkhead, parse_mapping  # noqa: E402
+
+
+async def client(bulkhead: FairBulkhead, adapter: FakePOSAdapter, merchant: str, deadline: float, results) -> None:
+    request = POSPaymentRequest(amount=10.0, total=10.8, merchant_reference=merchant)
+    while time.monotonic() < deadline:
+        async with bulkhead.slot(merchant) as waited:
+            await adapter.aprocess(request)
+        results[merchant].append(waited)
+
+
+async def drill(args) -> None:
+    adapter = FakePOSAdapter({"latency_ms": args.latency_ms, "jitter_ms": 0})
+    bulkhead = FairBulkhead("fake", limit=args.limit, weights=parse_mapping(args.weights), queue_timeout=60)
+    results = defaultdict(list)
+    deadline = time.monotonic() + args.seconds
+
+    clients = [client(bulkhead, adapter, "MERCH-BIG", deadline, results) for _ in range(args.big_clients)]
+    clients += [
+        client(bulkhead, adapter, f"MERCH-SMALL-{index}", deadline, results)
+        for index in range(args.small_merchants)
+    ]
+    await asyncio.gather(*clients)
+
+    for merchant, waits in sorted(results.items()):
+        waits.sort()
+        print(json.dumps({
+            "merchant": merchant,
+            "payments_per_second": round(len(waits) / args.seconds, 1),
+            "queue_p50_ms": round(waits[len(waits) // 2] * 1000, 1),
+            "queue_p95_ms": round(waits[int(len(waits) * 0.95)] * 1000, 1),
+        }))
+    print(json.dumps(bulkhead.metrics(), indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=8, help="provider concurrency limit")
+    parser.add_argument("--big-clients", type=int, default=40)
+    parser.add_argument("--small-merchants", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--weights", default="", help="e.g. MERCH-BIG=4,MERCH-SMALL-0=2")
+    args = parser.parse_args()
+    asyncio.run(drill(args))
+
+
+if __name__ == "__main__":
+    main()
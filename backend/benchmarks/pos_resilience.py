@@ -0,0 +1,112 @@
+"""
+POS resilience drill
+Drives POSMiddleware against the local fake provider through a healthy
+phase, an outage and a recovery, and prints what checkouts saw in each
+phase alongside the adapter's breaker state and rolling stats
+
+Usage:
+    python -m benchmarks.pos_resilience --concurrency 20 --phase-seconds 5
+    python -m benchmarks.pos_resilience --outage-error-rate 0.6 --latency-ms 120
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pos import POSAdapterError, POSCircuitOpenError, POSPaymentRequest, POSTransientError  # noqa: E402
+from pos.adapters.fake_adapter import FakePOSAdapter  # noqa: E402
+from pos.middleware import POSMiddleware  # noqa: E402
+from pos.resilience import AdapterGuard  # noqa: E402
+
+
+async def checkout(middleware: POSMiddleware, number: int, outcomes: Counter, latencies: list) -> None:
+    request = POSPaymentRequest(
+        amount=10.0,
+        total=10.8,
+        idempotency_key=f"drill-{number}",
+        metadata={"transaction_id": f"TXN-DRILL-{number}"},
+    )
+    started = time.perf_counter()
+    try:
+        await middleware.process_payment("fake", request)
+        outcome = "ok"
+    except POSCircuitOpenError:
+        outcome = "fast_fail"
+    except POSTransientError:
+        outcome = "unavailable"
+    except POSAdapterError:
+        outcome = "declined"
+    latencies.append(time.perf_counter() - started)
+    outcomes[outcome] += 1
+    if outcome == "fast_fail":
+        # Terminals back off on 503 + Retry-After rather than spinning
+        await asyncio.sleep(0.1)
+
+
+async def run_phase(middleware: POSMiddleware, name: str, seconds: float, concurrency: int, counter) -> dict:
+    outcomes: Counter = Counter()
+    latencies: list = []
+    deadline = time.monotonic() + seconds
+    states = Counter()
+
+    async def client() -> None:
+        while time.monotonic() < deadline:
+            await checkout(middleware, next(counter), outcomes, latencies)
+            states[middleware.health()["fake"]["state"]] += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    latencies.sort()
+    return {
+        "phase": name,
+        "checkouts": sum(outcomes.values()),
+        **dict(outcomes),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 1) if latencies else None,
+        "breaker_states": dict(states),
+    }
+
+
+async def drill(args) -> None:
+    adapter = FakePOSAdapter({"latency_ms": args.latency_ms, "jitter_ms": args.latency_ms / 4})
+    middleware = POSMiddleware()
+    guard = AdapterGuard("fake")
+    guard.breaker.reset_timeout = args.reset_seconds
+    middleware.register_adapter(adapter, guard)
+    counter = iter(range(1, 10 ** 9))
+
+    phases = [
+        ("healthy", {"error_rate": 0.0, "timeout_rate": 0.0}),
+        ("outage", {"error_rate": args.outage_error_rate, "timeout_rate": args.outage_timeout_rate}),
+        ("recovery", {"error_rate": 0.0, "timeout_rate": 0.0}),
+    ]
+    for name, behaviour in phases:
+        adapter.configure(**behaviour)
+        report = await run_phase(middleware, name, args.phase_seconds, args.concurrency, counter)
+        print(json.dumps(report))
+
+    print(json.dumps({
+        "provider_calls": adapter.calls,
+        "charges": adapter.charges,
+        "health": middleware.health()["fake"],
+    }, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--phase-seconds", type=float, default=5.0)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--outage-error-rate", type=float, default=0.9)
+    parser.add_argument("--outage-timeout-rate", type=float, default=0.1)
+    parser.add_argument("--reset-seconds", type=float, default=2.0, help="breaker open -> half-open delay")
+    args = parser.parse_args()
+    asyncio.run(drill(args))
+
+
+if __name__ == "__main__":
+    main()
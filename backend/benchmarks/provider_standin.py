@@ -0,0 +1,465 @@
+"""
+Provider stand-in
+Local stand-in for the parts of Stripe and Square the API uses, so checkout
+can be load-tested without provider sandboxes. Covers Stripe customers
+(list/create), PaymentIntents (create/retrieve/confirm/list), PaymentMethod
+attach and signed webhook delivery, and Square /v2/payments
+(create/retrieve/list). Latency, error, rate-limit, timeout, decline and
+async-processing rates and the webhook delay are configurable, and can be
+changed while running through POST /_standin/config.
+
+Latency and delay distributions (milliseconds):
+    fixed:50  uniform:20:120  lognormal:80:0.5 (median, sigma)  exponential:60 (mean)
+
+Usage:
+    python -m benchmarks.provider_standin --port 12111 --latency lognormal:80:0.4
+    python -m benchmarks.provider_standin --error-rate 0.05 --processing-rate 0.2 \\
+        --webhook-url http://127.0.0.1:8000/api/webhooks/stripe --webhook-secret whsec_standin
+Point the API at it with:
+    STRIPE_API_BASE=http://127.0.0.1:12111 SQUARE_API_BASE=http://127.0.0.1:12111
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+Distribution = Callable[[random.Random], float]
+
+
+def parse_distribution(spec: str) -> Distribution:
+    """'lognormal:80:0.5' -> sampler returning milliseconds"""
+    kind, _, raw = spec.partition(":")
+    values = [float(value) for value in raw.split(":") if value]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"Unknown distribution {spec!r}")
+
+
+def parse_form(pairs: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """Stripe's bracket encoding: metadata[transaction_id]=x -> {'metadata': {'transaction_id': 'x'}}"""
+    parsed: Dict[str, Any] = {}
+    for key, value in pairs:
+        parts = key.replace("]", "").split("[")
+        target = parsed
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return parsed
+
+
+class StandIn:
+    """Provider state, behaviour knobs and counters."""
+
+    DEFAULTS = {
+        "latency": "lognormal:60:0.4",
+        "error_rate": 0.0,
+        "rate_limit_rate": 0.0,
+        "timeout_rate": 0.0,
+        "timeout_ms": 30000.0,
+        "decline_rate": 0.0,
+        "processing_rate": 0.0,
+        "webhook_delay": "lognormal:300:0.6",
+        "webhook_url": None,
+        "webhook_secret": "whsec_standin",
+    }
+
+    def __init__(self, seed: Optional[int] = None) -> None:
+        self.rng = random.Random(seed)
+        self.config: Dict[str, Any] = {}
+        self.configure(**self.DEFAULTS)
+        self.reset()
+
+    def configure(self, **changes: Any) -> None:
+        for key, value in changes.items():
+            if key not in self.DEFAULTS:
+                raise ValueError(f"Unknown setting {key}")
+            if key in {"latency", "webhook_delay"}:
+                setattr(self, f"_{key}", parse_distribution(value))
+            self.config[key] = value
+
+    def reset(self) -> None:
+        self.customers: Dict[str, Dict] = {}
+        self.intents: Dict[str, Dict] = {}
+        self.square_payments: Dict[str, Dict] = {}
+        self.replays: Dict[Tuple[str, str], Tuple[int, Dict]] = {}
+        self.requests: Counter = Counter()
+        self.outcomes: Counter = Counter()
+        self.ids = itertools.count(1)
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}_standin{next(self.ids):010d}"
+
+    async def fault(self, provider: str, route: str) -> Optional[JSONResponse]:
+        """Sleep the sampled latency, then maybe fail the call the way the provider would."""
+        self.requests[f"{provider} {route}"] += 1
+        await asyncio.sleep(max(0.0, self._latency(self.rng)) / 1000)
+        roll = self.rng.random()
+        error_rate = float(self.config["error_rate"])
+        rate_limit_rate = float(self.config["rate_limit_rate"])
+        if roll < error_rate:
+            self.outcomes["error"] += 1
+            return provider_error(provider, 503, "api_error", "Service unavailable")
+        if roll < error_rate + rate_limit_rate:
+            self.outcomes["rate_limited"] += 1
+            return provider_error(provider, 429, "rate_limit", "Too many requests")
+        if roll < error_rate + rate_limit_rate + float(self.config["timeout_rate"]):
+            self.outcomes["timeout"] += 1
+            await asyncio.sleep(float(self.config["timeout_ms"]) / 1000)
+        return None
+
+    def declines(self) -> bool:
+        return self.rng.random() < float(self.config["decline_rate"])
+
+    def settles_later(self) -> bool:
+        return self.rng.random() < float(self.config["processing_rate"])
+
+    async def replay(self, scope: str, key: Optional[str], handler) -> JSONResponse:
+        """Serve a stored response for a repeated idempotency key, like both providers do"""
+        if key and (scope, key) in self.replays:
+            self.outcomes["replayed"] += 1
+            status_code, body = self.replays[(scope, key)]
+            return JSONResponse(body, status_code=status_code)
+        status_code, body = await handler()
+        if key and status_code < 500:
+            self.replays[(scope, key)] = (status_code, body)
+        return JSONResponse(body, status_code=status_code)
+
+    def schedule_webhook(self, event_type: str, intent: Dict, delay_ms: Optional[float] = None) -> None:
+        if not self.config["webhook_url"]:
+            return
+        delay = self._webhook_delay(self.rng) if delay_ms is None else delay_ms
+        asyncio.get_running_loop().create_task(self._deliver(event_type, dict(intent), delay))
+
+    async def _deliver(self, event_type: str, intent: Dict, delay_ms: float) -> None:
+        await asyncio.sleep(max(0.0, delay_ms) / 1000)
+        event = {
+            "id": self.new_id("evt"),
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "data": {"object": intent},
+        }
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(
+            str(self.config["webhook_secret"]).encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256
+        ).hexdigest()
+        headers = {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+        async with httpx.AsyncClient(timeout=10) as client:
+            # Stripe retries failed deliveries with backoff; three tries is enough locally
+            for attempt in range(3):
+                try:
+                    response = await client.post(self.config["webhook_url"], content=payload, headers=headers)
+                    if response.status_code < 300:
+                        self.outcomes["webhooks_delivered"] += 1
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(2 ** attempt)
+        self.outcomes["webhooks_failed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "config": self.config,
+            "requests": dict(self.requests),
+            "outcomes": dict(self.outcomes),
+            "customers": len(self.customers),
+            "payment_intents": len(self.intents),
+            "square_payments": len(self.square_payments),
+        }
+
+
+def provider_error(provider: str, status_code: int, code: str, message: str) -> JSONResponse:
+    if provider == "square":
+        category = "RATE_LIMIT_ERROR" if status_code == 429 else "API_ERROR"
+        return JSONResponse({"errors": [{"category": category, "code": code.upper(), "detail": message}]}, status_code)
+    error_type = "invalid_request_error" if status_code == 429 else "api_error"
+    return JSONResponse({"error": {"type": error_type, "code": code, "message": message}}, status_code)
+
+
+def stripe_error(status_code: int, error_type: str, code: str, message: str, **extra: Any) -> Tuple[int, Dict]:
+    return status_code, {"error": {"type": error_type, "code": code, "message": message, **extra}}
+
+
+def create_app(standin: StandIn) -> FastAPI:
+    app = FastAPI(title="Provider stand-in")
+
+    async def form(request: Request) -> Dict[str, Any]:
+        return parse_form(parse_qsl((await request.body()).decode()))
+
+    def query(request: Request) -> Dict[str, Any]:
+        return parse_form(list(request.query_params.multi_items()))
+
+    # ---------------- Stripe ----------------
+
+    @app.get("/v1/customers")
+    async def list_customers(request: Request):
+        if (failure := await standin.fault("stripe", "customers.list")):
+            return failure
+        params = query(request)
+        matches = [c for c in standin.customers.values() if c["email"] == params.get("email")]
+        limit = int(params.get("limit", 10))
+        return {"object": "list", "url": "/v1/customers", "data": matches[:limit], "has_more": len(matches) > limit}
+
+    @app.post("/v1/customers")
+    async def create_customer(request: Request):
+        if (failure := await standin.fault("stripe", "customers.create")):
+            return failure
+        params = await form(request)
+
+        async def handler():
+            customer = {
+                "id": standin.new_id("cus"),
+                "object": "customer",
+                "email": params.get("email"),
+                "name": params.get("name"),
+                "created": int(time.time()),
+            }
+            standin.customers[customer["id"]] = customer
+            return 200, customer
+
+        return await standin.replay("stripe", request.headers.get("idempotency-key"), handler)
+
+    @app.post("/v1/payment_intents")
+    async def create_intent(request: Request):
+        if (failure := await standin.fault("stripe", "payment_intents.create")):
+            return failure
+        params = await form(request)
+
+        async def handler():
+            intent_id = standin.new_id("pi")
+            intent = {
+                "id": intent_id,
+                "object": "payment_intent",
+                "amount": int(params["amount"]),
+                "currency": params.get("currency", "usd"),
+                "status": "requires_confirmation" if params.get("payment_method") else "requires_payment_method",
+                "client_secret": f"{intent_id}_secret_standin",
+                "payment_method": params.get("payment_method"),
+                "receipt_email": params.get("receipt_email"),
+                "metadata": params.get("metadata", {}),
+                "created": int(time.time()),
+                "livemode": False,
+            }
+            standin.intents[intent_id] = intent
+            return 200, intent
+
+        return await standin.replay("stripe", request.headers.get("idempotency-key"), handler)
+
+    @app.get("/v1/payment_intents")
+    async def list_intents(request: Request):
+        if (failure := await standin.fault("stripe", "payment_intents.list")):
+            return failure
+        params = query(request)
+        created = params.get("created", {})
+        matches = [
+            intent for intent in reversed(list(standin.intents.values()))
+            if int(created.get("gte", 0)) <= intent["created"] < int(created.get("lt", 2 ** 62))
+        ]
+        if params.get("starting_after"):
+            ids = [intent["id"] for intent in matches]
+            matches = matches[ids.index(params["starting_after"]) + 1:] if params["starting_after"] in ids else []
+        limit = int(params.get("limit", 10))
+        return {
+            "object": "list", "url": "/v1/payment_intents", "data": matches[:limit], "has_more": len(matches) > limit
+        }
+
+    @app.get("/v1/payment_intents/{intent_id}")
+    async def retrieve_intent(intent_id: str):
+        if (failure := await standin.fault("stripe", "payment_intents.retrieve")):
+            return failure
+        if intent_id not in standin.intents:
+            return JSONResponse(*reversed(stripe_error(
+                404, "invalid_request_error", "resource_missing", f"No such payment_intent: '{intent_id}'"
+            )))
+        return standin.intents[intent_id]
+
+    @app.post("/v1/payment_intents/{intent_id}/confirm")
+    async def confirm_intent(intent_id: str, request: Request):
+        if (failure := await standin.fault("stripe", "payment_intents.confirm")):
+            return failure
+        params = await form(request)
+
+        async def handler():
+            intent = standin.intents.get(intent_id)
+            if intent is None:
+                return stripe_error(404, "invalid_request_error", "resource_missing", f"No such payment_intent: '{intent_id}'")
+            intent["payment_method"] = params.get("payment_method", intent["payment_method"])
+            if standin.declines():
+                intent["status"] = "requires_payment_method"
+                intent["last_payment_error"] = {"code": "card_declined", "decline_code": "generic_decline"}
+                standin.outcomes["declined"] += 1
+                standin.schedule_webhook("payment_intent.payment_failed", intent)
+                return stripe_error(
+                    402, "card_error", "card_declined", "Your card was declined.",
+                    decline_code="generic_decline", payment_intent=dict(intent)
+                )
+            if standin.settles_later():
+                intent["status"] = "processing"
+                standin.outcomes["processing"] += 1
+                asyncio.get_running_loop().create_task(settle_later(intent))
+            else:
+                intent["status"] = "succeeded"
+                standin.outcomes["succeeded"] += 1
+                standin.schedule_webhook("payment_intent.succeeded", intent)
+            return 200, dict(intent)
+
+        return await standin.replay(f"stripe-confirm-{intent_id}", request.headers.get("idempotency-key"), handler)
+
+    async def settle_later(intent: Dict) -> None:
+        delay = standin._webhook_delay(standin.rng)
+        await asyncio.sleep(max(0.0, delay) / 1000)
+        intent["status"] = "succeeded"
+        standin.schedule_webhook("payment_intent.succeeded", intent)
+
+    @app.post("/v1/payment_methods/{payment_method_id}/attach")
+    async def attach_payment_method(payment_method_id: str, request: Request):
+        if (failure := await standin.fault("stripe", "payment_methods.attach")):
+            return failure
+        params = await form(request)
+        return {
+            "id": payment_method_id,
+            "object": "payment_method",
+            "type": "card",
+            "customer": params.get("customer"),
+            "card": {"brand": "visa", "last4": "4242", "exp_month": 12, "exp_year": 2030},
+        }
+
+    # ---------------- Square ----------------
+
+    @app.post("/v2/payments")
+    async def create_square_payment(request: Request):
+        if (failure := await standin.fault("square", "payments.create")):
+            return failure
+        body = await request.json()
+
+        async def handler():
+            if standin.declines():
+                standin.outcomes["declined"] += 1
+                return 400, {"errors": [{"category": "PAYMENT_METHOD_ERROR", "code": "GENERIC_DECLINE"}]}
+            now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+            payment = {
+                "id": standin.new_id("sq"),
+                "status": "COMPLETED" if body.get("autocomplete", True) else "APPROVED",
+                "amount_money": body.get("amount_money", {}),
+                "reference_id": body.get("reference_id"),
+                "source_type": "CARD",
+                "created_at": now,
+                "updated_at": now,
+            }
+            standin.square_payments[payment["id"]] = payment
+            standin.outcomes["succeeded"] += 1
+            return 200, {"payment": payment}
+
+        return await standin.replay("square", body.get("idempotency_key"), handler)
+
+    @app.get("/v2/payments")
+    async def list_square_payments(request: Request):
+        if (failure := await standin.fault("square", "payments.list")):
+            return failure
+        params = request.query_params
+        begin = params.get("begin_time", "")
+        end = params.get("end_time", "9999")
+
+        def in_window(payment: Dict) -> bool:
+            created = datetime.fromisoformat(payment["created_at"])
+            return (
+                (not begin or created >= datetime.fromisoformat(begin))
+                and (end == "9999" or created < datetime.fromisoformat(end))
+            )
+
+        matches = [payment for payment in standin.square_payments.values() if in_window(payment)]
+        offset = int(params.get("cursor") or 0)
+        limit = int(params.get("limit", 100))
+        page = {"payments": matches[offset:offset + limit]}
+        if offset + limit < len(matches):
+            page["cursor"] = str(offset + limit)
+        return page
+
+    @app.get("/v2/payments/{payment_id}")
+    async def retrieve_square_payment(payment_id: str):
+        if (failure := await standin.fault("square", "payments.retrieve")):
+            return failure
+        if payment_id not in standin.square_payments:
+            return JSONResponse({"errors": [{"category": "INVALID_REQUEST_ERROR", "code": "NOT_FOUND"}]}, 404)
+        return {"payment": standin.square_payments[payment_id]}
+
+    # ---------------- Control ----------------
+
+    @app.get("/_standin/stats")
+    async def stats():
+        return standin.stats()
+
+    @app.post("/_standin/config")
+    async def configure(request: Request):
+        try:
+            standin.configure(**(await request.json()))
+        except ValueError as exc:
+            return JSONResponse({"detail": str(exc)}, 400)
+        return standin.stats()
+
+    @app.post("/_standin/reset")
+    async def reset():
+        standin.reset()
+        return standin.stats()
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency", default=StandIn.DEFAULTS["latency"], help="per-call latency distribution")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of calls answered 429")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of calls that hang")
+    parser.add_argument("--timeout-ms", type=float, default=30000.0)
+    parser.add_argument("--decline-rate", type=float, default=0.0)
+    parser.add_argument("--processing-rate", type=float, default=0.0,
+                        help="share of Stripe confirmations left processing until a later webhook")
+    parser.add_argument("--webhook-url", help="where to deliver signed Stripe events (off when unset)")
+    parser.add_argument("--webhook-secret", default=StandIn.DEFAULTS["webhook_secret"])
+    parser.add_argument("--webhook-delay", default=StandIn.DEFAULTS["webhook_delay"])
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    standin = StandIn(seed=args.seed)
+    standin.configure(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_ms=args.timeout_ms,
+        decline_rate=args.decline_rate,
+        processing_rate=args.processing_rate,
+        webhook_url=args.webhook_url,
+        webhook_secret=args.webhook_secret,
+        webhook_delay=args.webhook_delay,
+    )
+    uvicorn.run(create_app(standin), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
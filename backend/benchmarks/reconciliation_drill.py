@@ -0,0 +1,105 @@
+"""
+Reconciliation drill
+Charges the local fake provider, writes matching transactions to a scratch
+SQLite database with some drift injected (wrong statuses, missing provider
+ids, rows the provider never saw) and runs the reconciliation job over it,
+printing the report and how long it took
+
+Usage:
+    python -m benchmarks.reconciliation_drill --payments 5000 --drift 0.05
+    python -m benchmarks.reconciliation_drill --payments 20000 --concurrency 8 --latency-ms 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Never point the drill at a real database
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/reconciliation_drill.db"
+os.environ.pop("DATABASE_SHARD_URLS", None)
+os.environ.pop("DATABASE_REPLICA_URLS", None)
+
+from sqlalchemy import insert  # noqa: E402
+
+from database import SessionLocal, init_db  # noqa: E402
+from models import Transaction  # noqa: E402
+from pos import POSPaymentRequest, pos_middleware  # noqa: E402
+from pos.adapters.fake_adapter import FakePOSAdapter  # noqa: E402
+from reconciliation import reconcile  # noqa: E402
+
+
+def seed(adapter: FakePOSAdapter, payments: int, drift: float, rng: random.Random) -> dict:
+    """Charge the fake provider and write local rows, injecting drift; returns what was injected"""
+    injected = {"wrong_status": 0, "unlinked": 0, "missing_locally": 0}
+    rows = []
+    for number in range(payments):
+        transaction_id = f"TXN-DRILL{number:08d}"
+        result = adapter.process(POSPaymentRequest(
+            amount=10.0, total=10.8, idempotency_key=transaction_id, metadata={"transaction_id": transaction_id}
+        ))
+        row = {
+            "transaction_id": transaction_id,
+            "customer_id": 1,
+            "merchant_id": 1,
+            "amount": 10.0,
+            "total": 10.8,
+            "template_hash": "drill",
+            "payment_provider": "fake",
+            "provider_transaction_id": result.transaction_reference,
+            "status": "completed",
+            "created_at": datetime.utcnow(),
+        }
+        roll = rng.random()
+        if roll < drift / 3:
+            row["status"] = rng.choice(["processing", "failed"])
+            injected["wrong_status"] += 1
+        elif roll < 2 * drift / 3:
+            row["provider_transaction_id"] = None
+            row["status"] = "processing"
+            injected["unlinked"] += 1
+        elif roll < drift:
+            injected["missing_locally"] += 1
+            continue
+        rows.append(row)
+
+    with SessionLocal() as db:
+        for offset in range(0, len(rows), 1000):
+            db.execute(insert(Transaction), rows[offset:offset + 1000])
+        db.commit()
+    return injected
+
+
+async def drill(args) -> None:
+    init_db()
+    adapter = FakePOSAdapter({"latency_ms": 0, "jitter_ms": 0})
+    pos_middleware.register_adapter(adapter)
+    injected = seed(adapter, args.payments, args.drift, random.Random(args.seed))
+    adapter.configure(latency_ms=args.latency_ms, jitter_ms=args.latency_ms / 4)
+
+    end = datetime.utcnow() + timedelta(seconds=1)
+    start = end - timedelta(hours=1)
+    report = await reconcile("fake", start, end, concurrency=args.concurrency, slice_minutes=args.slice_minutes)
+    summary = report.to_dict()
+    summary.pop("samples")
+    print(json.dumps({"injected": injected, "report": summary}, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payments", type=int, default=5000)
+    parser.add_argument("--drift", type=float, default=0.05, help="share of payments with injected drift")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--slice-minutes", type=float, default=5.0)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="fake provider latency per list call")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    asyncio.run(drill(args))
+
+
+if __name__ == "__main__":
+    main()
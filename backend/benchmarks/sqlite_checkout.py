@@ -0,0 +1,197 @@
+"""
+SQLite checkout throughput benchmark
+Compares the legacy SQLite configuration against the edge profile
+
+Each worker replays the database side of POST /api/transactions/create
+(fingerprint verification bump, customer lookup, transaction insert, commit,
+provider round trip, status update) while reader threads hammer the
+dashboard queries.
+
+Usage:
+    python -m benchmarks.sqlite_checkout --workers 16 --duration 10
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, insert, select, update  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import create_engines  # noqa: E402
+from models import Base, Customer, Fingerprint, Merchant, Transaction, User  # noqa: E402
+
+CUSTOMERS = 200
+
+
+def seed(session_factory) -> int:
+    db = session_factory()
+    user_id = db.execute(
+        insert(User).values(email="bench@protega.cloud", hashed_password="x").returning(User.id)
+    ).scalar()
+    merchant_id = db.execute(
+        insert(Merchant)
+        .values(user_id=user_id, name="Bench", email="bench@protega.cloud")
+        .returning(Merchant.id)
+    ).scalar()
+    for i in range(CUSTOMERS):
+        customer_id = db.execute(
+            insert(Customer).values(name=f"C{i}", email=f"c{i}@bench.local").returning(Customer.id)
+        ).scalar()
+        db.execute(
+            insert(Fingerprint).values(
+                customer_id=customer_id,
+                salt_b64="c2FsdA==",
+                encrypted_template="x",
+                template_hash=f"hash-{i}",
+            )
+        )
+    db.commit()
+    db.close()
+    return merchant_id
+
+
+def checkout(session_factory, merchant_id: int, n: int, provider_latency: float) -> None:
+    db = session_factory()
+    try:
+        customer_id = db.execute(
+            update(Fingerprint)
+            .where(Fingerprint.template_hash == f"hash-{n % CUSTOMERS}")
+            .values(
+                last_verified_at=datetime.utcnow(),
+                verification_count=func.coalesce(Fingerprint.verification_count, 0) + 1,
+            )
+            .returning(Fingerprint.customer_id)
+        ).scalar()
+        db.execute(select(Customer.customer_id, Customer.email).where(Customer.id == customer_id)).first()
+        transaction_pk = db.execute(
+            insert(Transaction)
+            .values(
+                customer_id=customer_id,
+                merchant_id=merchant_id,
+                amount=10.0,
+                tax=0.8,
+                total=10.8,
+                items=[{"name": "item", "price": 10.0}],
+                template_hash=f"hash-{n % CUSTOMERS}",
+                status="processing",
+            )
+            .returning(Transaction.id)
+        ).scalar()
+        db.commit()
+        if provider_latency:
+            time.sleep(provider_latency)
+        db.execute(
+            update(Transaction)
+            .where(Transaction.id == transaction_pk)
+            .values(status="completed", provider_transaction_id=f"pi_{n}")
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def dashboard_read(session_factory, merchant_id: int) -> None:
+    db = session_factory()
+    try:
+        db.execute(
+            select(Transaction)
+            .where(Transaction.merchant_id == merchant_id)
+            .order_by(Transaction.created_at.desc())
+            .limit(100)
+        ).all()
+    finally:
+        db.close()
+
+
+def run_profile(profile: str, args) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"protega-bench-{profile}-")
+    url = f"sqlite:///{workdir}/bench.db"
+    write_engine, read_engine = create_engines(url, sqlite_profile=profile)
+    Base.metadata.create_all(bind=write_engine)
+    WriteSession = sessionmaker(bind=write_engine, autoflush=False)
+    ReadSession = sessionmaker(bind=read_engine, autoflush=False)
+    merchant_id = seed(WriteSession)
+
+    latencies = []
+    reads = [0]
+    errors = [0]
+    counter = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def writer():
+        while time.perf_counter() < deadline:
+            with lock:
+                counter[0] += 1
+                n = counter[0]
+            started = time.perf_counter()
+            try:
+                checkout(WriteSession, merchant_id, n, args.provider_latency / 1000)
+            except OperationalError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    def reader():
+        while time.perf_counter() < deadline:
+            try:
+                dashboard_read(ReadSession, merchant_id)
+            except OperationalError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                reads[0] += 1
+
+    threads = [threading.Thread(target=writer) for _ in range(args.workers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    write_engine.dispose()
+    read_engine.dispose()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "profile": profile,
+        "checkouts_per_sec": len(latencies) / args.duration,
+        "reads_per_sec": reads[0] / args.duration,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0,
+        "errors": errors[0],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8, help="concurrent checkout threads")
+    parser.add_argument("--readers", type=int, default=4, help="concurrent dashboard reader threads")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per profile")
+    parser.add_argument("--provider-latency", type=float, default=0.0, help="simulated provider call in ms")
+    args = parser.parse_args()
+
+    results = [run_profile(profile, args) for profile in ("legacy", "edge")]
+    print(f"{'profile':<8} {'checkout/s':>11} {'reads/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for r in results:
+        print(
+            f"{r['profile']:<8} {r['checkouts_per_sec']:>11.1f} {r['reads_per_sec']:>9.1f} "
+            f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
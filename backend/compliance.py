@@ -7,6 +7,7 @@ from datetime import datetime
 from typing import Optional
 from fastapi import HTTPException, status
 
+from database import shards
 from models import User, Customer, Fingerprint, PaymentMethod, Transaction, Consent
 
 def record_user_consent(
@@ -153,10 +154,13 @@ def export_user_data(user_id: int, db: Session) -> dict:
     }
     
     if customer:
-        # Get transactions (amounts only, no sensitive data)
-        transactions = db.query(Transaction).filter(
-            Transaction.customer_id == customer.id
-        ).all()
+        # Count transactions across every merchant shard (amounts only, no sensitive data)
+        transactions_count = 0
+        with shards.all_sessions(db, for_write=False) as shard_dbs:
+            for shard_db in shard_dbs:
+                transactions_count += shard_db.query(Transaction).filter(
+                    Transaction.customer_id == customer.id
+                ).count()
         
         data["customer_data"] = {
             "customer_id": customer.customer_id,
@@ -168,7 +172,7 @@ def export_user_data(user_id: int, db: Session) -> dict:
             # Note: Fingerprint template is NOT exported (biometric data)
         }
         
-        data["transactions_count"] = len(transactions)
+        data["transactions_count"] = transactions_count
     
     return data
 
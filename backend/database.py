@@ -1,19 +1,423 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Index, MetaData, Table, create_engine, event, func, inspect, select, text
+from sqlalchemy.orm import Session, sessionmaker
+from contextlib import contextmanager
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
+import hashlib
+import itertools
+import logging
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from fastapi import Depends, Request
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./protega.db")
 
-# Handle PostgreSQL vs SQLite
-if DATABASE_URL.startswith("postgresql"):
-    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-else:
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# SQLite profile: "edge" (WAL, tuned pragmas, single writer + read pool) or "legacy"
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "edge").lower()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "65536"))  # 64 MiB page cache
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))
+SQLITE_WRITE_QUEUE_TIMEOUT = float(os.getenv("SQLITE_WRITE_QUEUE_TIMEOUT", "30"))
+
+# Read replicas for lag-tolerant dashboard reads (comma-separated URLs)
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "2"))
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Merchant-keyed shards for transactions and inventory (comma-separated URLs).
+# List the primary DATABASE_URL first to keep existing merchants on shard 0.
+DATABASE_SHARD_URLS = [u.strip() for u in os.getenv("DATABASE_SHARD_URLS", "").split(",") if u.strip()]
+SHARD_DIRECTORY_TTL = float(os.getenv("SHARD_DIRECTORY_TTL", "5"))
+SHARD_ID_RANGE_BITS = 40  # each shard allocates primary keys from its own 2**40 range
+
+logger = logging.getLogger(__name__)
+
+
+def _apply_sqlite_pragmas(engine, read_only: bool = False) -> None:
+    """Apply the edge profile pragmas to every new SQLite connection"""
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KIB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+def create_engines(url: str, sqlite_profile: str = SQLITE_PROFILE):
+    """
+    Build the (write_engine, read_engine) pair for a database URL.
+    
+    PostgreSQL and legacy/in-memory SQLite share one engine for both roles.
+    The SQLite edge profile runs in WAL mode with a single pooled writer
+    connection - concurrent writers queue for it instead of failing with
+    "database is locked" - and a separate pool of query-only readers that
+    WAL lets proceed alongside the writer.
+    """
+    if url.startswith("postgresql"):
+        engine = create_engine(url, pool_pre_ping=True)
+        return engine, engine
+
+    connect_args = {"check_same_thread": False}
+    in_memory = url in {"sqlite://", "sqlite:///:memory:"} or "mode=memory" in url
+    if not url.startswith("sqlite") or sqlite_profile != "edge" or in_memory:
+        engine = create_engine(url, connect_args=connect_args)
+        return engine, engine
+
+    connect_args["timeout"] = SQLITE_BUSY_TIMEOUT_MS / 1000
+    write_engine = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=SQLITE_WRITE_QUEUE_TIMEOUT,
+    )
+    _apply_sqlite_pragmas(write_engine)
+    read_engine = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=SQLITE_READ_POOL_SIZE,
+        max_overflow=SQLITE_READ_POOL_SIZE,
+    )
+    _apply_sqlite_pragmas(read_engine, read_only=True)
+    return write_engine, read_engine
+
+
+engine, read_engine = create_engines(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+class _Replica:
+    """A read replica with a cached replication-lag probe"""
+
+    # Zero when the replica has replayed everything it received, otherwise
+    # the age of the last replayed transaction
+    LAG_QUERY = text(
+        "SELECT CASE "
+        "WHEN NOT pg_is_in_recovery() THEN 0 "
+        "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+    )
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        if url.startswith("postgresql"):
+            self.engine = create_engine(url, pool_pre_ping=True, connect_args={"connect_timeout": 2})
+        else:
+            self.engine = create_engine(url, connect_args={"check_same_thread": False})
+        self.sessions = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.lag: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _probe(self) -> Optional[float]:
+        if self.engine.dialect.name != "postgresql":
+            return 0.0
+        try:
+            with self.engine.connect() as conn:
+                return float(conn.execute(self.LAG_QUERY).scalar() or 0)
+        except Exception as exc:
+            logger.warning("Replica lag probe failed for %s: %s", self.engine.url.host, exc)
+            return None
+
+    def healthy(self) -> bool:
+        now = time.monotonic()
+        if now - self._checked_at >= REPLICA_LAG_CHECK_INTERVAL and self._lock.acquire(blocking=False):
+            try:
+                self.lag = self._probe()
+                self._checked_at = time.monotonic()
+            finally:
+                self._lock.release()
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG_SECONDS
+
+
+class ReplicaSet:
+    """
+    Round-robin routing across read replicas.
+    Replicas lagging beyond REPLICA_MAX_LAG_SECONDS are skipped, and clients
+    that wrote within READ_YOUR_WRITES_SECONDS are pinned to the primary.
+    """
+
+    def __init__(self, urls: List[str]) -> None:
+        self.replicas = [_Replica(url) for url in urls]
+        self._cursor = itertools.count()
+        self._recent_writes: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def note_write(self, client: Optional[str]) -> None:
+        if not client or not self.replicas:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes[client] = now
+            if len(self._recent_writes) > 10_000:
+                cutoff = now - READ_YOUR_WRITES_SECONDS
+                self._recent_writes = {k: t for k, t in self._recent_writes.items() if t >= cutoff}
+
+    def wrote_recently(self, client: Optional[str]) -> bool:
+        if not client:
+            return False
+        written_at = self._recent_writes.get(client)
+        return written_at is not None and time.monotonic() - written_at < READ_YOUR_WRITES_SECONDS
+
+    def pick(self, client: Optional[str] = None) -> Optional[sessionmaker]:
+        """Return a healthy replica's session factory, or None to use the primary"""
+        if not self.replicas or self.wrote_recently(client):
+            return None
+        start = next(self._cursor)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.healthy():
+                return replica.sessions
+        return None
+
+    def status(self) -> list:
+        return [
+            {"host": replica.engine.url.host or replica.engine.url.database, "lag_seconds": replica.lag}
+            for replica in self.replicas
+        ]
+
+
+replicas = ReplicaSet(DATABASE_REPLICA_URLS)
+
+
+def client_key(request: Request) -> Optional[str]:
+    """Stable per-client key for read-your-writes tracking"""
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return hashlib.sha256(authorization.encode("utf-8")).hexdigest()
+    return request.client.host if request.client else None
+
+class ShardMovingError(Exception):
+    """Raised when a merchant is mid-move between shards and writes must wait."""
+
+
+class ShardRouter:
+    """
+    Maps merchants to the database holding their transactions and inventory.
+    
+    The merchant_shards directory lives in the global database next to users,
+    merchants, customers and fingerprints. Lookups are cached for
+    SHARD_DIRECTORY_TTL seconds; shard_tool waits out that TTL around moves.
+    Without DATABASE_SHARD_URLS there is a single implicit shard: the primary.
+    """
+
+    def __init__(self, urls: List[str]) -> None:
+        self.enabled = bool(urls)
+        pairs = [(engine, read_engine) if url == DATABASE_URL else create_engines(url) for url in urls]
+        self.engines = [pair[0] for pair in pairs] or [engine]
+        self.read_engines = [pair[1] for pair in pairs] or [read_engine]
+        self.sessions = [sessionmaker(autocommit=False, autoflush=False, bind=e) for e in self.engines]
+        self.read_sessions = [sessionmaker(autocommit=False, autoflush=False, bind=e) for e in self.read_engines]
+        self._directory: Dict[int, Tuple[int, str, float]] = {}
+        self._moving: Tuple[FrozenSet[int], float] = (frozenset(), float("-inf"))
+
+    def assign(self, merchant_id: int) -> int:
+        """Initial shard for a newly registered merchant"""
+        return merchant_id % len(self.engines)
+
+    def lookup(self, merchant_id: int) -> Tuple[int, str]:
+        """Return (shard index, status) for a merchant's primary key"""
+        if not self.enabled:
+            return 0, "active"
+        cached = self._directory.get(merchant_id)
+        if cached and time.monotonic() - cached[2] < SHARD_DIRECTORY_TTL:
+            return cached[0], cached[1]
+        from models import MerchantShard
+        with ReadSessionLocal() as db:
+            row = db.execute(
+                select(MerchantShard.shard, MerchantShard.status)
+                .where(MerchantShard.merchant_id == merchant_id)
+            ).first()
+        # Merchants that predate the directory stay on shard 0
+        shard, status = (row.shard, row.status) if row else (0, "active")
+        self._directory[merchant_id] = (shard, status, time.monotonic())
+        return shard, status
+
+    def moving_merchants(self) -> FrozenSet[int]:
+        """
+        Merchants mid-move, cached like lookup(). Fan-out writers skip their
+        rows: shard_tool's delta copy only sees what was written before it ran.
+        """
+        if not self.enabled:
+            return frozenset()
+        merchants, fetched = self._moving
+        if time.monotonic() - fetched < SHARD_DIRECTORY_TTL:
+            return merchants
+        from models import MerchantShard
+        with ReadSessionLocal() as db:
+            merchants = frozenset(db.execute(
+                select(MerchantShard.merchant_id).where(MerchantShard.status == "moving")
+            ).scalars())
+        self._moving = (merchants, time.monotonic())
+        return merchants
+
+    def invalidate(self, merchant_id: int) -> None:
+        self._directory.pop(merchant_id, None)
+
+    def _session(self, shard: int, default: Optional[Session], for_write: bool) -> Tuple[Session, bool]:
+        """Return (session, owned); reuses `default` when it is already bound to the shard"""
+        engines, factories = (self.engines, self.sessions) if for_write else (self.read_engines, self.read_sessions)
+        if default is not None and default.get_bind() is engines[shard]:
+            return default, False
+        return factories[shard](), True
+
+    @contextmanager
+    def merchant_session(self, merchant_id: int, default: Session, for_write: bool = False) -> Iterator[Session]:
+        """
+        Session on the merchant's shard, or `default` when sharding is off.
+        Raises ShardMovingError for writes while the merchant is being moved.
+        """
+        if not self.enabled:
+            yield default
+            return
+        shard, status = self.lookup(merchant_id)
+        if for_write and status == "moving":
+            raise ShardMovingError(f"Merchant {merchant_id} is moving between shards")
+        db, owned = self._session(shard, default, for_write)
+        try:
+            yield db
+        finally:
+            if owned:
+                db.close()
+
+    @contextmanager
+    def all_sessions(self, default: Session, for_write: bool = True) -> Iterator[List[Session]]:
+        """One session per shard for fan-out queries, or [default] when sharding is off"""
+        if not self.enabled:
+            yield [default]
+            return
+        pairs = [self._session(shard, default, for_write) for shard in range(len(self.engines))]
+        try:
+            yield [db for db, _ in pairs]
+        finally:
+            for db, owned in pairs:
+                if owned:
+                    db.close()
+
+
+shards = ShardRouter(DATABASE_SHARD_URLS)
+
+
+def shard_metadata() -> MetaData:
+    """
+    DDL-only copies of the merchant-owned tables for shard databases.
+    Foreign keys are dropped because users, merchants and customers live in
+    the global database.
+    """
+    from models import Base
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        if not table.info.get("sharded"):
+            continue
+        copy = Table(
+            table.name,
+            metadata,
+            *[Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable) for c in table.columns],
+            sqlite_autoincrement=True
+        )
+        for index in table.indexes:
+            Index(index.name, *[copy.c[c.name] for c in index.columns], unique=index.unique)
+    return metadata
+
+
+def _reserve_id_range(shard_engine, metadata: MetaData, shard: int) -> None:
+    """
+    Start each shard's sequences at shard << SHARD_ID_RANGE_BITS so primary
+    keys stay unique across shards and rows keep their ids when moved.
+    """
+    if shard == 0:
+        return
+    floor = shard << SHARD_ID_RANGE_BITS
+    with shard_engine.begin() as conn:
+        if shard_engine.dialect.name == "sqlite":
+            for table in metadata.sorted_tables:
+                conn.execute(
+                    text(
+                        "INSERT INTO sqlite_sequence (name, seq) SELECT :table, :seq "
+                        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :table)"
+                    ),
+                    {"table": table.name, "seq": floor - 1}
+                )
+            return
+        for table in metadata.sorted_tables:
+            sequence = conn.execute(
+                text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table.name}
+            ).scalar()
+            if not sequence:
+                continue
+            last_value = conn.execute(text(f"SELECT last_value FROM {sequence}")).scalar()
+            if last_value < floor:
+                conn.execute(text("SELECT setval(:sequence, :floor, false)"), {"sequence": sequence, "floor": floor})
+
+def _has_duplicates(target_engine, index: Index) -> bool:
+    """Whether rows already repeat a value an index is about to make unique (NULLs never clash)"""
+    columns = list(index.columns)
+    with target_engine.connect() as conn:
+        return conn.execute(
+            select(*columns)
+            .where(*[column.isnot(None) for column in columns])
+            .group_by(*columns)
+            .having(func.count() > 1)
+            .limit(1)
+        ).first() is not None
+
+
+def _upgrade_schema(target_engine, metadata: MetaData) -> None:
+    """
+    create_all never alters existing tables; add the nullable columns and
+    indexes introduced since the database was first created, and rebuild
+    indexes that have since become unique.
+    """
+    inspector = inspect(target_engine)
+    statements = []
+    rebuilt = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                logger.warning("Skipping non-nullable column %s.%s; migrate it manually", table.name, column.name)
+                continue
+            column_type = column.type.compile(dialect=target_engine.dialect)
+            statements.append(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+        existing_indexes = {index["name"]: index for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            existing = existing_indexes.get(index.name)
+            if existing is None:
+                statements.append(index)
+            elif index.unique and not existing["unique"]:
+                if _has_duplicates(target_engine, index):
+                    logger.warning("Duplicate values block unique index %s; deduplicate and restart", index.name)
+                    continue
+                rebuilt.append(index)
+    if not statements and not rebuilt:
+        return
+    with target_engine.begin() as conn:
+        for index in rebuilt:
+            index.drop(conn)
+            index.create(conn)
+        for statement in statements:
+            if isinstance(statement, Index):
+                statement.create(conn)
+            else:
+                conn.execute(statement)
+
 
 def get_db():
     """Dependency for getting database session"""
@@ -23,10 +427,70 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    """Dependency for read-only endpoints; uses the read pool when one is configured"""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_replica_db(request: Request):
+    """
+    Dependency for lag-tolerant read-only endpoints.
+    Load-balances across healthy replicas; falls back to the primary read pool
+    when no replica is configured, all are lagging, or the client wrote recently.
+    """
+    factory = replicas.pick(client_key(request)) or ReadSessionLocal
+    db = factory()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_all_shard_dbs(db: Session = Depends(get_db)):
+    """Dependency yielding one session per shard for lookups not keyed by merchant"""
+    with shards.all_sessions(db) as sessions:
+        yield sessions
+
+def insert_for(db, model):
+    """
+    Dialect-specific INSERT for the session's bind.
+    Supports ON CONFLICT DO NOTHING/UPDATE and RETURNING on PostgreSQL and SQLite.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise RuntimeError(f"Unsupported database dialect for upserts: {dialect}")
+    return insert(model)
+
+def _create_search_indexes(target_engine) -> None:
+    """pg_trgm GIN indexes behind inventory search; other databases search in memory"""
+    if target_engine.dialect.name != "postgresql":
+        return
+    with target_engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        for column in ("name", "barcode", "category"):
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_inventory_{column}_trgm ON inventory USING gin ({column} gin_trgm_ops)"
+            ))
+
 def init_db():
     """Initialize database tables"""
     from models import Base
     Base.metadata.create_all(bind=engine)
+    _upgrade_schema(engine, Base.metadata)
+    _create_search_indexes(engine)
+    if shards.enabled:
+        metadata = shard_metadata()
+        for index, shard_engine in enumerate(shards.engines):
+            metadata.create_all(bind=shard_engine)
+            _upgrade_schema(shard_engine, metadata)
+            _reserve_id_range(shard_engine, metadata, index)
+            _create_search_indexes(shard_engine)
 
 
 
@@ -0,0 +1,214 @@
+"""
+Idempotency - Idempotency-Key support for transaction creation
+A retried checkout gets the original response instead of creating a second
+transaction and a second provider charge.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.orm import Session
+
+from database import insert_for
+from models import IdempotencyKey
+
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# An in-flight key older than this belongs to a request that died (crashed
+# worker); longer than a checkout can take with provider retries and queueing
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "120"))
+MAX_KEY_LENGTH = 255
+
+
+@dataclass
+class StoredResponse:
+    status_code: int
+    body: Dict[str, Any]
+
+
+def request_hash(payload: Dict[str, Any]) -> str:
+    """Stable hash of a request body so a reused key with a different request is rejected"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def provider_key(merchant_reference: str, key: str) -> str:
+    """
+    Provider-level idempotency key. All merchants share one provider account,
+    so client keys are namespaced by merchant; 40 hex characters fit Square's
+    45-character limit.
+    """
+    return hashlib.sha256(f"{merchant_reference}:{key}".encode()).hexdigest()[:40]
+
+
+class IdempotencyStore:
+    """idempotency_keys table with a process-level LRU of completed responses"""
+
+    def __init__(self, maxsize: int = IDEMPOTENCY_CACHE_SIZE):
+        self.maxsize = maxsize
+        # (merchant, key) -> (request hash, response, expires_at)
+        self._cache: "OrderedDict[Tuple[int, str], Tuple[str, StoredResponse, datetime]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(
+        self, merchant_pk: int, key: str, body_hash: str, response: StoredResponse, expires_at: datetime
+    ) -> None:
+        with self._lock:
+            self._cache[(merchant_pk, key)] = (body_hash, response, expires_at)
+            self._cache.move_to_end((merchant_pk, key))
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def _cached(self, merchant_pk: int, key: str) -> Optional[Tuple[str, StoredResponse, datetime]]:
+        with self._lock:
+            entry = self._cache.get((merchant_pk, key))
+            if entry is None:
+                return None
+            # Past expiry the row may be purged or reclaimed by a new request
+            if entry[2] < datetime.utcnow():
+                del self._cache[(merchant_pk, key)]
+                return None
+            self._cache.move_to_end((merchant_pk, key))
+            return entry
+
+    @staticmethod
+    def _check_hash(stored_hash: str, body_hash: str) -> None:
+        if stored_hash != body_hash:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Idempotency-Key was already used with a different request"
+            )
+
+    def begin(self, db: Session, merchant_pk: int, key: str, body_hash: str) -> Optional[StoredResponse]:
+        """
+        Claim a key for a new request. Returns the stored response for a
+        completed duplicate, None when the caller should process the request.
+        """
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+        cached = self._cached(merchant_pk, key)
+        if cached is not None:
+            self._check_hash(cached[0], body_hash)
+            return cached[1]
+
+        now = datetime.utcnow()
+        claimed = db.execute(
+            insert_for(db, IdempotencyKey)
+            .values(
+                merchant_id=merchant_pk,
+                key=key,
+                request_hash=body_hash,
+                status="in_flight",
+                created_at=now,
+                expires_at=now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+            )
+            .on_conflict_do_nothing(index_elements=[IdempotencyKey.merchant_id, IdempotencyKey.key])
+            .returning(IdempotencyKey.id)
+        ).scalar()
+        if claimed is None:
+            # Expired keys are reused as if they were new. An in-flight key
+            # is leased from its created_at: past the lease its request is
+            # gone and the key is taken over. The provider key derives from
+            # the client key, so a charge the dead request made is not repeated.
+            claimed = db.execute(
+                update(IdempotencyKey)
+                .where(
+                    IdempotencyKey.merchant_id == merchant_pk,
+                    IdempotencyKey.key == key,
+                    or_(
+                        IdempotencyKey.expires_at < now,
+                        and_(
+                            IdempotencyKey.status == "in_flight",
+                            IdempotencyKey.request_hash == body_hash,
+                            IdempotencyKey.created_at < now - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+                        )
+                    )
+                )
+                .values(
+                    request_hash=body_hash,
+                    status="in_flight",
+                    transaction_id=None,
+                    response_code=None,
+                    response_body=None,
+                    created_at=now,
+                    expires_at=now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+                )
+                .returning(IdempotencyKey.id)
+                .execution_options(synchronize_session=False)
+            ).scalar()
+        if claimed is not None:
+            db.commit()
+            return None
+
+        existing = db.execute(
+            select(
+                IdempotencyKey.request_hash, IdempotencyKey.status,
+                IdempotencyKey.response_code, IdempotencyKey.response_body, IdempotencyKey.expires_at
+            ).where(IdempotencyKey.merchant_id == merchant_pk, IdempotencyKey.key == key)
+        ).first()
+        db.rollback()
+        self._check_hash(existing.request_hash, body_hash)
+        if existing.status != "completed":
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="A request with this Idempotency-Key is still being processed",
+                headers={"Retry-After": "1"}
+            )
+        response = StoredResponse(existing.response_code, existing.response_body)
+        self._remember(merchant_pk, key, body_hash, response, existing.expires_at)
+        return response
+
+    def complete(
+        self,
+        db: Session,
+        merchant_pk: int,
+        key: str,
+        status_code: int,
+        body: Dict[str, Any],
+        transaction_id: Optional[str] = None
+    ) -> None:
+        """Store the response that duplicates of this key will receive"""
+        stored = db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.merchant_id == merchant_pk, IdempotencyKey.key == key)
+            .values(
+                status="completed",
+                transaction_id=transaction_id,
+                response_code=status_code,
+                response_body=body,
+            )
+            .returning(IdempotencyKey.request_hash, IdempotencyKey.expires_at)
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.commit()
+        if stored is not None:
+            self._remember(merchant_pk, key, stored.request_hash, StoredResponse(status_code, body), stored.expires_at)
+
+    def release(self, db: Session, merchant_pk: int, key: str) -> None:
+        """Forget an in-flight key whose request failed before reaching the provider"""
+        db.rollback()
+        db.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.merchant_id == merchant_pk,
+                IdempotencyKey.key == key,
+                IdempotencyKey.status == "in_flight"
+            )
+        )
+        db.commit()
+
+    def purge_expired(self, db: Session) -> int:
+        purged = db.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.expires_at < datetime.utcnow())
+        ).rowcount
+        db.commit()
+        return purged
+
+
+idempotency_store = IdempotencyStore()
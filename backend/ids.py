@@ -0,0 +1,205 @@
+"""
+Public Identifier Service - time-ordered, collision-safe IDs
+Generates k-sortable identifiers for transactions, customers and merchants
+"""
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+import time
+from typing import IO, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 48-bit millisecond timestamp | 16-bit node | 16-bit sequence = 80 bits,
+# rendered as 16 Crockford base32 characters. Fixed width keeps the string
+# order identical to the numeric (creation time) order, so new rows append
+# to the tail of the unique index instead of landing at random B-tree pages.
+TIMESTAMP_BITS = 48
+NODE_BITS = 16
+SEQUENCE_BITS = 16
+ENCODED_LENGTH = 16
+
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"  # Crockford base32
+# Derived node ids are a host id followed by a worker slot on that host
+HOST_BITS = 10
+SLOT_BITS = NODE_BITS - HOST_BITS
+
+_MAX_NODE = (1 << NODE_BITS) - 1
+_MAX_HOST = (1 << HOST_BITS) - 1
+_MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Workers hold an exclusive lock on <node id>.lock here for as long as they run
+NODE_LOCK_DIR = os.getenv("PROTEGA_NODE_LOCK_DIR", os.path.join(tempfile.gettempdir(), "protega-node-ids"))
+
+
+def _configured(name: str, maximum: int) -> Optional[int]:
+    value = os.getenv(name)
+    if not value:
+        return None
+    number = int(value)
+    if not 0 <= number <= maximum:
+        raise ValueError(f"{name} must be between 0 and {maximum}")
+    return number
+
+
+def _lease(node_id: int) -> Optional[IO]:
+    """Lock this node id for the process; None when another generator on the host holds it"""
+    os.makedirs(NODE_LOCK_DIR, exist_ok=True)
+    handle = open(os.path.join(NODE_LOCK_DIR, f"{node_id}.lock"), "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return None
+    return handle
+
+
+def _claim_node_id() -> Tuple[int, Optional[IO]]:
+    """
+    Node id for a generator in this process, with the lock file that keeps it
+    exclusive on this host. PROTEGA_NODE_ID pins it (0-65535) and fails fast
+    if another process on the host already runs with it. Otherwise the id is
+    PROTEGA_HOST_ID (0-1023, hashed from the hostname when unset) followed by
+    the first free worker slot. Hosts are only distinct by configuration:
+    give each machine its own PROTEGA_HOST_ID when several run.
+    """
+    node_id = _configured("PROTEGA_NODE_ID", _MAX_NODE)
+    if node_id is not None:
+        lease = _lease(node_id) if fcntl else None
+        if fcntl and lease is None:
+            raise RuntimeError(f"PROTEGA_NODE_ID={node_id} is already used by another process on this host")
+        return node_id, lease
+
+    host_id = _configured("PROTEGA_HOST_ID", _MAX_HOST)
+    if host_id is None:
+        host_id = int.from_bytes(hashlib.sha256(socket.gethostname().encode("utf-8")).digest()[:2], "big") & _MAX_HOST
+    base = host_id << SLOT_BITS
+    if fcntl is None:
+        # No advisory locks to claim a slot with; set PROTEGA_NODE_ID per worker on these platforms
+        return base | (os.getpid() & ((1 << SLOT_BITS) - 1)), None
+    for slot in range(1 << SLOT_BITS):
+        lease = _lease(base | slot)
+        if lease is not None:
+            return base | slot, lease
+    raise RuntimeError(
+        f"All {1 << SLOT_BITS} worker slots of host {host_id} are in use; set PROTEGA_NODE_ID or PROTEGA_HOST_ID"
+    )
+
+
+def _encode(value: int) -> str:
+    chars = []
+    for _ in range(ENCODED_LENGTH):
+        chars.append(_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+class IdGenerator:
+    """Thread-safe k-sortable id generator (timestamp + node + sequence)"""
+
+    def __init__(self, node_id: int | None = None) -> None:
+        self._lease: Optional[IO] = None
+        if node_id is None:
+            node_id, self._lease = _claim_node_id()
+        self.node_id: Optional[int] = node_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def _ensure_node(self) -> int:
+        if self.node_id is None:
+            self.node_id, self._lease = _claim_node_id()
+        return self.node_id
+
+    def ensure_node(self) -> int:
+        """This process's node id, claiming one if needed; raises when none is free"""
+        with self._lock:
+            return self._ensure_node()
+
+    def next_int(self) -> int:
+        with self._lock:
+            node_id = self._ensure_node()
+            now_ms = time.time_ns() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # Same millisecond or the clock stepped backwards: keep counting
+                # from the last issued timestamp so ids stay unique and ordered
+                self._sequence += 1
+                if self._sequence > _MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return (
+                (self._last_ms << (NODE_BITS + SEQUENCE_BITS))
+                | (node_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+    def next_id(self, prefix: str) -> str:
+        return f"{prefix}-{_encode(self.next_int())}"
+
+    def reset_node(self) -> None:
+        """
+        Drop the parent's node id in a forked worker; the child claims its own
+        on first use (or at startup via ensure_node_id), where a failure can raise.
+        """
+        # A parent thread may have held the mutex at fork time
+        self._lock = threading.Lock()
+        # The inherited descriptor shares the parent's file lock; closing it here leaves the parent's held
+        if self._lease is not None:
+            self._lease.close()
+        self._lease = None
+        self.node_id = None
+
+
+_generator = IdGenerator()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_generator.reset_node)
+
+
+def ensure_node_id() -> int:
+    """Claim this process's node id now, so a clash fails at startup rather than on the first insert"""
+    return _generator.ensure_node()
+
+
+def new_public_id(prefix: str) -> str:
+    """
+    Generate a public identifier such as TXN-01JAB3Y8Q2M4Z7K0.
+    
+    Args:
+        prefix: Entity prefix (TXN, CUST, MERCH)
+    
+    Returns:
+        Prefixed, time-ordered identifier
+    """
+    return _generator.next_id(prefix)
+
+
+def public_id_at(prefix: str, timestamp_ms: int, node_id: int, sequence: int) -> str:
+    """Identifier built from explicit parts, for backfills and synthetic data"""
+    return f"{prefix}-{_encode((timestamp_ms << (NODE_BITS + SEQUENCE_BITS)) | (node_id << SEQUENCE_BITS) | sequence)}"
+
+
+def id_timestamp(public_id: str) -> float:
+    """Creation time (Unix seconds) embedded in a public identifier"""
+    value = 0
+    for char in public_id.rsplit("-", 1)[-1]:
+        value = (value << 5) | _ALPHABET.index(char)
+    return (value >> (NODE_BITS + SEQUENCE_BITS)) / 1000
+
+
+def display_suffix(public_id: str, length: int = 3) -> str:
+    """
+    Short stable label for a public identifier (e.g. "Customer #K7Q"). Hashed
+    rather than sliced, so it does not depend on the bit layout; consecutive
+    ids would otherwise share their timestamp or sequence characters.
+    """
+    digest = int.from_bytes(hashlib.sha256(public_id.encode("utf-8")).digest()[:8], "big")
+    return _encode(digest)[-length:]
@@ -0,0 +1,275 @@
+"""
+Inventory Import/Export - streaming CSV and NDJSON catalogs
+Imports are parsed as the request body arrives, validated row by row and
+upserted on barcode in batches through a staging table (COPY on PostgreSQL),
+so a catalog of any size is never held in memory. Exports stream from a
+server-side cursor.
+"""
+import codecs
+import csv
+import io
+import json
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, exists, insert, literal, select, update
+from sqlalchemy.orm import Session
+
+from auth import merchant_moving_error
+from barcode_cache import barcode_cache
+from database import ReadSessionLocal, SessionLocal, ShardMovingError, shards
+from models import Inventory
+from schemas import InventoryCreate
+
+IMPORT_BATCH_SIZE = int(os.getenv("INVENTORY_IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("INVENTORY_IMPORT_MAX_ERRORS", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("INVENTORY_EXPORT_BATCH_SIZE", "1000"))
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_COLUMNS = ("id", "name", "barcode", "price", "category", "stock")
+IMPORT_COLUMNS = ("barcode", "name", "price", "category", "stock")
+
+# Per-batch staging table; created and dropped inside each batch's transaction
+_staging = Table(
+    "inventory_import",
+    MetaData(),
+    Column("barcode", String, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("price", Float, nullable=False),
+    Column("category", String),
+    Column("stock", Integer, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    error_count: int = 0
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+
+    def reject(self, line: int, message: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < IMPORT_MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+
+def detect_format(requested: Optional[str], content_type: Optional[str]) -> Optional[str]:
+    if requested:
+        return requested.lower() if requested.lower() in FORMATS else None
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in {"application/x-ndjson", "application/ndjson", "application/jsonl"}:
+        return "ndjson"
+    if content_type in {"text/csv", "application/csv", "text/plain", ""}:
+        return "csv"
+    return None
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, str]]:
+    """Decode the body incrementally into (line number, line) pairs"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    number = 0
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        for line in complete:
+            number += 1
+            yield number, line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield number + 1, pending
+
+
+async def _csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """CSV rows keyed by the lower-cased header; quoted fields may span lines"""
+    header = None
+    record, start = "", 0
+    async for number, line in _lines(chunks):
+        if not record:
+            start = number
+        record += line + "\n"
+        if record.count('"') % 2:
+            continue  # inside a quoted field
+        text, record = record, ""
+        if not text.strip():
+            continue
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [name.strip().lower() for name in values]
+            continue
+        yield start, dict(zip(header, values))
+    if record.strip():
+        yield start, {"_error": "Unterminated quoted field"}
+
+
+async def _ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    async for number, line in _lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError as exc:
+            yield number, {"_error": f"Invalid JSON: {exc}"}
+            continue
+        yield number, value if isinstance(value, dict) else {"_error": "Each line must be a JSON object"}
+
+
+def _validate(record: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Row ready for staging, or the reason it was rejected"""
+    if "_error" in record:
+        return None, record["_error"]
+    # CSV leaves optional cells empty rather than absent
+    values = {key: value for key, value in record.items() if key in IMPORT_COLUMNS and value not in ("", None)}
+    try:
+        item = InventoryCreate(**values)
+    except ValidationError as exc:
+        return None, "; ".join(
+            f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in exc.errors()
+        )
+    if not item.barcode or not item.barcode.strip():
+        return None, "barcode: required to match existing items"
+    if not item.name.strip():
+        return None, "name: must not be empty"
+    if item.price < 0 or item.stock < 0:
+        return None, "price and stock must not be negative"
+    return {
+        "barcode": item.barcode.strip(),
+        "name": item.name.strip(),
+        "price": item.price,
+        "category": item.category,
+        "stock": item.stock,
+    }, None
+
+
+def _copy_into_staging(session: Session, rows: List[Dict[str, Any]]) -> None:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[name] for name in IMPORT_COLUMNS])
+    buffer.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {_staging.name} ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer
+    )
+
+
+def merge_batch(session: Session, merchant_pk: int, rows: List[Dict[str, Any]]) -> Tuple[int, int]:
+    """
+    Upsert one batch on (merchant, barcode) through the staging table;
+    returns (inserted, updated). Imported rows are reactivated and their
+    stock is set, not adjusted.
+    """
+    connection = session.connection()
+    # SQLite runs DDL outside the transaction, so a failed batch can leave the table behind
+    _staging.drop(connection, checkfirst=True)
+    _staging.create(connection)
+    if connection.dialect.name == "postgresql" and connection.dialect.driver == "psycopg2":
+        _copy_into_staging(session, rows)
+    else:
+        session.execute(insert(_staging), rows)
+
+    now = datetime.utcnow()
+    updated = session.execute(
+        update(Inventory)
+        .where(Inventory.merchant_id == merchant_pk, Inventory.barcode == _staging.c.barcode)
+        .values(
+            name=_staging.c.name,
+            price=_staging.c.price,
+            category=_staging.c.category,
+            stock=_staging.c.stock,
+            is_active=True,
+            updated_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    inserted = session.execute(
+        insert(Inventory).from_select(
+            ["merchant_id", "barcode", "name", "price", "category", "stock", "is_active", "created_at", "updated_at"],
+            select(
+                literal(merchant_pk), _staging.c.barcode, _staging.c.name, _staging.c.price,
+                _staging.c.category, _staging.c.stock, literal(True), literal(now), literal(now)
+            ).where(
+                ~exists().where(Inventory.merchant_id == merchant_pk, Inventory.barcode == _staging.c.barcode)
+            )
+        )
+    ).rowcount
+    _staging.drop(connection)
+    barcode_cache.invalidate_on_commit(session, merchant_pk, [row["barcode"] for row in rows])
+    return inserted, updated
+
+
+def _write_batch(merchant_pk: int, batch: Dict[str, Dict[str, Any]], report: ImportReport) -> None:
+    """Commit one batch with a short-lived session; nothing is held while the body streams in"""
+    db = SessionLocal()
+    try:
+        with shards.merchant_session(merchant_pk, db, for_write=True) as merchant_db:
+            inserted, updated = merge_batch(merchant_db, merchant_pk, list(batch.values()))
+            merchant_db.commit()
+    except ShardMovingError:
+        # Batches already written stay; the rows upsert on barcode, so the client resends the whole file
+        raise merchant_moving_error()
+    finally:
+        db.close()
+    report.inserted += inserted
+    report.updated += updated
+
+
+async def import_inventory(merchant_pk: int, chunks: AsyncIterator[bytes], fmt: str) -> ImportReport:
+    """
+    Stream an import into the merchant's inventory. Invalid rows are
+    reported with their line number and skipped; within a batch the last row
+    for a barcode wins.
+    """
+    report = ImportReport()
+    records = _csv_records(chunks) if fmt == "csv" else _ndjson_records(chunks)
+    batch: Dict[str, Dict[str, Any]] = {}
+    async for line, record in records:
+        report.rows += 1
+        row, error = _validate(record)
+        if error:
+            report.reject(line, error)
+            continue
+        batch[row["barcode"]] = row
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            _write_batch(merchant_pk, batch, report)
+            batch = {}
+    if batch:
+        _write_batch(merchant_pk, batch, report)
+    return report
+
+
+def export_inventory(merchant_pk: int, fmt: str) -> Iterator[str]:
+    """
+    Active inventory as CSV or NDJSON, read through a server-side cursor
+    (yield_per) and encoded one batch at a time.
+    """
+    db = ReadSessionLocal()
+    try:
+        with shards.merchant_session(merchant_pk, db) as merchant_db:
+            result = merchant_db.execute(
+                select(*[getattr(Inventory, name) for name in EXPORT_COLUMNS])
+                .where(Inventory.merchant_id == merchant_pk, Inventory.is_active == True)
+                .order_by(Inventory.id)
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            if fmt == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(EXPORT_COLUMNS)
+                for rows in result.partitions():
+                    writer.writerows(rows)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                yield buffer.getvalue()
+            else:
+                for rows in result.partitions():
+                    yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows)
+    finally:
+        db.close()
@@ -0,0 +1,345 @@
+"""
+Inventory Search - prefix and typo-tolerant lookup by name, category or barcode
+PostgreSQL answers from pg_trgm GIN indexes. Other databases (SQLite edge
+deployments) use a per-merchant in-memory index that is built once and kept
+current from the rows changed since the last search, read through the
+(merchant_id, updated_at) index.
+"""
+import heapq
+import math
+import os
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Collection, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, case, func, literal, or_, select
+from sqlalchemy.orm import Session
+
+from models import Inventory
+
+SEARCH_INDEX_MERCHANTS = int(os.getenv("INVENTORY_SEARCH_INDEX_MERCHANTS", "16"))
+# Share of the query's trigrams an item must contain to count as a fuzzy match
+FUZZY_THRESHOLD = float(os.getenv("INVENTORY_SEARCH_FUZZY_THRESHOLD", "0.5"))
+# Shorter tokens are not tried with adjacent letters swapped; two-letter swaps match too much
+TRANSPOSITION_MIN_LENGTH = 3
+# Changes are re-read this far back, for writes that committed after a later-stamped one
+LOOKBACK = timedelta(seconds=float(os.getenv("INVENTORY_SEARCH_LOOKBACK_SECONDS", "5")))
+BULK_ROWS = 1000
+
+# Rank tiers; fuzzy matches score their trigram overlap (below 1)
+BARCODE_EXACT = 4.0
+BARCODE_PREFIX = 3.0
+NAME_PREFIX = 2.0
+WORD_PREFIX = 1.5
+# Word prefixes once one pair of adjacent letters is swapped back ("itme" -> "item"); a swap
+# changes most trigrams of a short word, so the fuzzy tier misses these
+TRANSPOSED_PREFIX = 1.0
+
+COLUMNS = (Inventory.id, Inventory.name, Inventory.barcode, Inventory.price, Inventory.category, Inventory.stock)
+Hit = Tuple[float, tuple]  # (score, (id, name, barcode, price, category, stock))
+
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lower-case, accents stripped, punctuation folded to spaces"""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return _NON_WORD.sub(" ", "".join(char for char in decomposed if not unicodedata.combining(char))).strip()
+
+
+def trigrams(words: Iterable[str]) -> FrozenSet[str]:
+    """pg_trgm-style trigrams: each word padded with two leading blanks and one trailing"""
+    grams = set()
+    for word in words:
+        padded = f"  {word} "
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def spellings(token: str) -> List[str]:
+    """The token followed by its adjacent transpositions, for tokens long enough to try them"""
+    if len(token) < TRANSPOSITION_MIN_LENGTH:
+        return [token]
+    swapped = {token[:index] + token[index + 1] + token[index] + token[index + 2:] for index in range(len(token) - 1)}
+    swapped.discard(token)
+    return [token, *sorted(swapped)]
+
+
+class MerchantIndex:
+    """Searchable copy of one merchant's active catalog"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.rows: Dict[int, tuple] = {}
+        self.names: Dict[int, str] = {}
+        self.words: Dict[int, List[str]] = {}
+        self.vocabulary: Dict[str, Set[int]] = {}
+        self.postings: Dict[str, Set[int]] = {}
+        self.sorted_vocabulary: List[str] = []
+        self.sorted_names: List[Tuple[str, int]] = []
+        self.sorted_barcodes: List[Tuple[str, int]] = []
+        self.stamps: Dict[int, datetime] = {}
+        self.seen_until: Optional[datetime] = None
+
+    def _remove(self, item_id: int, bulk: bool) -> bool:
+        row = self.rows.pop(item_id, None)
+        if row is None:
+            return False
+        name = self.names.pop(item_id)
+        words = self.words.pop(item_id)
+        for word in words:
+            items = self.vocabulary[word]
+            items.discard(item_id)
+            if not items:
+                del self.vocabulary[word]
+                if not bulk:
+                    del self.sorted_vocabulary[bisect_left(self.sorted_vocabulary, word)]
+        if not bulk:
+            del self.sorted_names[bisect_left(self.sorted_names, (name, item_id))]
+            if row[2]:
+                del self.sorted_barcodes[bisect_left(self.sorted_barcodes, (row[2], item_id))]
+        for gram in trigrams(words):
+            postings = self.postings[gram]
+            postings.discard(item_id)
+            if not postings:
+                del self.postings[gram]
+        return True
+
+    def _add(self, row: tuple, bulk: bool) -> None:
+        item_id, name, barcode, _, category = row[:5]
+        name = normalize(name)
+        words = sorted(set(f"{name} {normalize(category)}".split()))
+        self.rows[item_id] = row
+        self.names[item_id] = name
+        self.words[item_id] = words
+        add = list.append if bulk else insort
+        for word in words:
+            if word not in self.vocabulary:
+                self.vocabulary[word] = set()
+                if not bulk:
+                    insort(self.sorted_vocabulary, word)
+            self.vocabulary[word].add(item_id)
+        add(self.sorted_names, (name, item_id))
+        if barcode:
+            add(self.sorted_barcodes, (barcode, item_id))
+        for gram in trigrams(words):
+            self.postings.setdefault(gram, set()).add(item_id)
+
+    def apply(self, rows: Iterable) -> None:
+        """Apply changed rows (id, name, barcode, price, category, stock, is_active, updated_at)"""
+        changed = [
+            row for row in rows
+            if row[7] is None or self.stamps.get(row[0]) != row[7]
+        ]
+        # Large batches (the first build, a catalog import) append and sort once
+        bulk = len(changed) > BULK_ROWS
+        removed = {row[0] for row in changed if self._remove(row[0], bulk)}
+        if removed and bulk:
+            self.sorted_names = [entry for entry in self.sorted_names if entry[1] not in removed]
+            self.sorted_barcodes = [entry for entry in self.sorted_barcodes if entry[1] not in removed]
+        for row in changed:
+            if row[6]:
+                self._add(tuple(row[:6]), bulk)
+            self.stamps[row[0]] = row[7]
+            if row[7] is not None and (self.seen_until is None or row[7] > self.seen_until):
+                self.seen_until = row[7]
+        if bulk:
+            self.sorted_vocabulary = sorted(self.vocabulary)
+            self.sorted_names.sort()
+            self.sorted_barcodes.sort()
+
+    @staticmethod
+    def _prefix_range(entries: list, prefix: str, key: tuple = ()) -> list:
+        start = bisect_left(entries, (prefix, *key) if key else prefix)
+        # Normalized text is ASCII, so every extension of the prefix sorts before this
+        upper = prefix + "\uffff"
+        return entries[start:bisect_left(entries, (upper,) if key else upper, start)]
+
+    def _first_by_name(self, ids: Set[int], needed: int) -> List[int]:
+        """The `needed` ids that sort first by (name, id)"""
+        # Walking the name order meets them every len(catalog) / len(ids) entries on average,
+        # cheaper than collecting every name once the set is large
+        if len(ids) ** 2 >= needed * len(self.sorted_names):
+            picked = []
+            for _, item_id in self.sorted_names:
+                if item_id in ids:
+                    picked.append(item_id)
+                    if len(picked) == needed:
+                        break
+            return picked
+        return [item_id for _, item_id in heapq.nsmallest(needed, [(self.names[item_id], item_id) for item_id in ids])]
+
+    def _word_match(self, groups: Iterable[List[str]]) -> Set[int]:
+        """Items where each group has a spelling that starts a word of the name or category"""
+        ranges = [
+            list(chain.from_iterable(self._prefix_range(self.sorted_vocabulary, spelling) for spelling in group))
+            for group in groups
+        ]
+        matched: Optional[Set[int]] = None
+        # Narrowest group first, so common words only filter a small set
+        for words in sorted(ranges, key=len):
+            items = set().union(*(self.vocabulary[word] for word in words))
+            matched = items if matched is None else matched & items
+            if not matched:
+                break
+        return matched or set()
+
+    def _fuzzy(self, tokens: List[str], exclude: Set[int]) -> Dict[float, Set[int]]:
+        """Items sharing at least FUZZY_THRESHOLD of the query's trigrams, grouped by score"""
+        query_grams = trigrams(tokens)
+        needed = math.ceil(FUZZY_THRESHOLD * len(query_grams))
+        lists = sorted((self.postings.get(gram, set()) for gram in query_grams), key=len)
+        # A match shares `needed` trigrams, so it appears in at least one of the rarest n - needed + 1 lists
+        candidates = set().union(*lists[:len(lists) - needed + 1]) - exclude
+        counts = Counter(chain.from_iterable(candidates.intersection(postings) for postings in lists))
+        levels: List[Set[int]] = [set() for _ in range(len(lists) + 1)]
+        for item_id, overlap in counts.items():
+            levels[overlap].add(item_id)
+        return {
+            round(overlap / len(lists) * 0.99, 4): levels[overlap]
+            for overlap in range(needed, len(lists) + 1)
+        }
+
+    def search(self, query: str, limit: int) -> List[Hit]:
+        """The best `limit` hits, highest score first"""
+        # (score, ids) from the best tier down, lists already in name order; an item is only listed in its best tier
+        tiers: List[Tuple[float, Collection[int]]] = []
+        seen: Set[int] = set()
+        raw = query.strip()
+        if raw:
+            barcodes = self._prefix_range(self.sorted_barcodes, raw, key=(-1,))
+            exact = {item_id for barcode, item_id in barcodes if barcode == raw}
+            tiers += [(BARCODE_EXACT, exact), (BARCODE_PREFIX, {item_id for _, item_id in barcodes} - exact)]
+            seen.update(item_id for _, item_id in barcodes)
+
+        text = normalize(query)
+        tokens = text.split()
+        if tokens:
+            name_prefix = [
+                item_id for _, item_id in self._prefix_range(self.sorted_names, text, key=(-1,)) if item_id not in seen
+            ]
+            seen.update(name_prefix)
+            word_prefix = self._word_match([token] for token in set(tokens)) - seen
+            tiers += [(NAME_PREFIX, name_prefix), (WORD_PREFIX, word_prefix)]
+            seen |= word_prefix
+            # Typo tiers stay below every prefix tier, so they are only needed to fill the page;
+            # single letters have too few trigrams to be matched loosely
+            if len(seen) < limit and len(text) >= 3:
+                transposed = self._word_match(spellings(token) for token in set(tokens)) - seen
+                tiers.append((TRANSPOSED_PREFIX, transposed))
+                seen |= transposed
+                tiers += sorted(self._fuzzy(tokens, seen).items(), reverse=True)
+
+        hits: List[Hit] = []
+        for score, ids in tiers:
+            needed = limit - len(hits)
+            if needed <= 0:
+                break
+            ordered = ids[:needed] if isinstance(ids, list) else self._first_by_name(ids, needed)
+            hits.extend((score, self.rows[item_id]) for item_id in ordered)
+        return hits
+
+
+class SearchIndexCache:
+    """LRU of merchant indexes for databases without pg_trgm"""
+
+    def __init__(self, max_merchants: int = SEARCH_INDEX_MERCHANTS) -> None:
+        self.max_merchants = max_merchants
+        self._lock = threading.Lock()
+        self._indexes: "OrderedDict[Tuple[str, int], MerchantIndex]" = OrderedDict()
+
+    def _index(self, session: Session, merchant_pk: int) -> MerchantIndex:
+        key = (str(session.get_bind().url), merchant_pk)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = MerchantIndex()
+                while len(self._indexes) > self.max_merchants:
+                    self._indexes.popitem(last=False)
+            self._indexes.move_to_end(key)
+        return index
+
+    def search(self, session: Session, merchant_pk: int, query: str, limit: int) -> List[Hit]:
+        index = self._index(session, merchant_pk)
+        with index.lock:
+            statement = select(*COLUMNS, Inventory.is_active, Inventory.updated_at).where(
+                Inventory.merchant_id == merchant_pk
+            )
+            if index.seen_until is None:
+                statement = statement.where(Inventory.is_active == True)
+            else:
+                # Re-read rows are skipped unless their stamp changed
+                statement = statement.where(Inventory.updated_at >= index.seen_until - LOOKBACK)
+            index.apply(session.execute(statement))
+            return index.search(query, limit)
+
+
+search_indexes = SearchIndexCache()
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _search_postgresql(session: Session, merchant_pk: int, query: str, limit: int, offset: int) -> List[Hit]:
+    """
+    The in-memory tiers in SQL. Normalized tokens are plain [0-9a-z] words,
+    so they go into the regular expressions unescaped; pg_trgm extracts
+    trigrams from the patterns to use the GIN indexes.
+    """
+    raw = query.strip()
+    prefix = _escape_like(raw) + "%"
+    text = normalize(query)
+    tokens = text.split()
+    scores = [
+        case((Inventory.barcode == raw, BARCODE_EXACT), (Inventory.barcode.like(prefix), BARCODE_PREFIX), else_=0.0)
+    ]
+    matches = [Inventory.barcode.like(prefix)] if raw else []
+    if tokens:
+        def starts_a_word(alternatives: List[str]):
+            pattern = "(^|[^[:alnum:]])(" + "|".join(alternatives) + ")"
+            return or_(Inventory.name.op("~*")(pattern), Inventory.category.op("~*")(pattern))
+
+        # Normalized name starts with the query / every token (or one of its
+        # adjacent transpositions) starts a word of the name or category
+        name_prefix = Inventory.name.op("~*")("^[^[:alnum:]]*" + "[^[:alnum:]]+".join(tokens))
+        word_prefix = and_(*[starts_a_word([token]) for token in tokens])
+        transposed_prefix = and_(*[starts_a_word(spellings(token)) for token in tokens])
+        scores.append(case(
+            (name_prefix, NAME_PREFIX), (word_prefix, WORD_PREFIX), (transposed_prefix, TRANSPOSED_PREFIX),
+            else_=0.0
+        ))
+        matches.append(transposed_prefix)
+        if len(text) >= 3:
+            # word_similarity over name and category, above the same threshold as in memory
+            session.execute(select(func.set_config("pg_trgm.word_similarity_threshold", str(FUZZY_THRESHOLD), True)))
+            scores.append(func.greatest(
+                func.word_similarity(literal(text), Inventory.name),
+                func.word_similarity(literal(text), func.coalesce(Inventory.category, "")),
+            ) * 0.99)
+            matches += [literal(text).op("<%")(Inventory.name), literal(text).op("<%")(Inventory.category)]
+    if not matches:
+        return []
+    score = func.greatest(*scores).label("score")
+    rows = session.execute(
+        select(score, *COLUMNS)
+        .where(Inventory.merchant_id == merchant_pk, Inventory.is_active == True, or_(*matches))
+        .order_by(score.desc(), func.lower(Inventory.name), Inventory.id)
+        .limit(limit)
+        .offset(offset)
+    ).all()
+    return [(round(float(row[0]), 4), tuple(row[1:])) for row in rows]
+
+
+def search_inventory(session: Session, merchant_pk: int, query: str, limit: int, offset: int) -> List[Hit]:
+    """Ranked hits for one page: barcode matches, then name and word prefixes, then fuzzy matches"""
+    if session.get_bind().dialect.name == "postgresql":
+        return _search_postgresql(session, merchant_pk, query, limit, offset)
+    return search_indexes.search(session, merchant_pk, query, offset + limit)[offset:]
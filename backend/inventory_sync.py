@@ -0,0 +1,134 @@
+"""
+Inventory Sync - incremental catalog downloads for terminals
+Terminals keep a server-issued sync token and fetch only the items created,
+updated or deleted since it, in (updated_at, id) pages off the
+(merchant_id, updated_at) index. Without a token (or after a 410) the active
+catalog is paged by id as a full resync, whose last page hands over a delta
+token from the moment it started. Deleted items are sent as tombstones for
+INVENTORY_SYNC_TOMBSTONE_DAYS; older tokens must resync in full.
+"""
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from jose import JWTError, jwt
+from sqlalchemy import delete, or_, select
+from sqlalchemy.orm import Session
+
+from auth import ALGORITHM, SECRET_KEY
+from models import Inventory
+
+SYNC_PAGE_SIZE = int(os.getenv("INVENTORY_SYNC_PAGE_SIZE", "500"))
+SYNC_MAX_PAGE_SIZE = int(os.getenv("INVENTORY_SYNC_MAX_PAGE_SIZE", "5000"))
+TOMBSTONE_RETENTION = timedelta(days=float(os.getenv("INVENTORY_SYNC_TOMBSTONE_DAYS", "30")))
+# Rows stamped more recently may still be committing, so tokens never move past now minus this
+SETTLE = timedelta(seconds=float(os.getenv("INVENTORY_SYNC_SETTLE_SECONDS", "5")))
+
+COLUMNS = (Inventory.id, Inventory.name, Inventory.barcode, Inventory.price, Inventory.category, Inventory.stock)
+
+
+@dataclass
+class SyncPage:
+    items: List[tuple] = field(default_factory=list)  # (id, name, barcode, price, category, stock)
+    deleted: List[int] = field(default_factory=list)
+    full: bool = False
+    has_more: bool = False
+    sync_token: str = ""
+
+
+def encode_token(merchant_pk: int, watermark: datetime, last_id: int, full: bool) -> str:
+    claims = {"m": merchant_pk, "w": watermark.isoformat(), "i": last_id}
+    if full:
+        claims["full"] = True
+    return jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def decode_token(token: str, merchant_pk: int) -> Tuple[datetime, int, bool]:
+    """(watermark, last id, full) from a token this server issued to the merchant"""
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        watermark, last_id = datetime.fromisoformat(claims["w"]), int(claims["i"])
+    except (JWTError, KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid sync token")
+    if claims.get("m") != merchant_pk:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Sync token belongs to another merchant")
+    if watermark < datetime.utcnow() - TOMBSTONE_RETENTION:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Sync token is older than the tombstone window; resync without a token"
+        )
+    return watermark, last_id, bool(claims.get("full"))
+
+
+def changes_since(merchant_pk: int, watermark: datetime, last_id: int, horizon: datetime, limit: int):
+    """Rows changed after (watermark, last_id) and before horizon, in (updated_at, id) order"""
+    return (
+        select(*COLUMNS, Inventory.is_active, Inventory.updated_at)
+        .where(
+            Inventory.merchant_id == merchant_pk,
+            Inventory.updated_at >= watermark,
+            or_(Inventory.updated_at > watermark, Inventory.id > last_id),
+            Inventory.updated_at < horizon,
+        )
+        .order_by(Inventory.updated_at, Inventory.id)
+        .limit(limit)
+    )
+
+
+def _full_page(session: Session, merchant_pk: int, started: datetime, last_id: int, limit: int) -> SyncPage:
+    rows = session.execute(
+        select(*COLUMNS)
+        .where(Inventory.merchant_id == merchant_pk, Inventory.is_active == True, Inventory.id > last_id)
+        .order_by(Inventory.id)
+        .limit(limit + 1)
+    ).all()
+    page = SyncPage(items=[tuple(row) for row in rows[:limit]], full=True, has_more=len(rows) > limit)
+    if page.has_more:
+        page.sync_token = encode_token(merchant_pk, started, page.items[-1][0], full=True)
+    else:
+        # Changes made while the catalog was paged are picked up by the first delta
+        page.sync_token = encode_token(merchant_pk, started, 0, full=False)
+    return page
+
+
+def sync_page(session: Session, merchant_pk: int, token: Optional[str], limit: int) -> SyncPage:
+    """
+    One page of changes since `token`, or of the full catalog when there is
+    none. Keep requesting with the returned token while has_more is set.
+    """
+    horizon = datetime.utcnow() - SETTLE
+    if not token:
+        return _full_page(session, merchant_pk, horizon, 0, limit)
+    watermark, last_id, full = decode_token(token, merchant_pk)
+    if full:
+        return _full_page(session, merchant_pk, watermark, last_id, limit)
+
+    rows = session.execute(changes_since(merchant_pk, watermark, last_id, horizon, limit + 1)).all()
+    page = SyncPage(has_more=len(rows) > limit)
+    for row in rows[:limit]:
+        if row.is_active:
+            page.items.append(tuple(row[:len(COLUMNS)]))
+        else:
+            page.deleted.append(row.id)
+    if page.has_more:
+        last = rows[limit - 1]
+        page.sync_token = encode_token(merchant_pk, last.updated_at, last.id, full=False)
+    elif horizon > watermark:
+        page.sync_token = encode_token(merchant_pk, horizon, 0, full=False)
+    else:
+        page.sync_token = encode_token(merchant_pk, watermark, last_id, full=False)
+    return page
+
+
+def purge_tombstones(session: Session) -> int:
+    """Hard-delete items deactivated before the tombstone window; tokens that old already get 410"""
+    purged = session.execute(
+        delete(Inventory).where(
+            Inventory.is_active == False,
+            Inventory.updated_at < datetime.utcnow() - TOMBSTONE_RETENTION
+        )
+    ).rowcount
+    session.commit()
+    return purged
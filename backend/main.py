@@ -1,54 +1,80 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from dataclasses import asdict, dataclass
 from datetime import datetime, timedelta
+import json
 import os
+import time
 from dotenv import load_dotenv
 import uuid
 
-from database import get_db, init_db
-from models import Base, User, Merchant, Customer, PaymentMethod, Transaction, Inventory, Fingerprint, Consent
+from database import (
+    get_db, get_read_db, get_replica_db, get_all_shard_dbs, init_db, insert_for,
+    client_key, replicas, shards, SessionLocal
+)
+from models import (
+    Base, User, Merchant, Customer, PaymentMethod, Transaction, Inventory, Fingerprint, Consent,
+    MerchantShard
+)
 from schemas import (
     Token, LoginRequest, RegisterRequest,
     CustomerCreate, CustomerResponse, CustomerProfile,
     PaymentMethodCreate, PaymentMethodResponse,
-    TransactionCreate, TransactionResponse,
-    MerchantStats, InventoryCreate, InventoryResponse,
+    TransactionCreate, TransactionResponse, CartPriceRequest, CartPriceResponse,
+    MerchantStats, InventoryCreate, InventoryResponse, InventorySearchHit, InventorySearchResponse,
+    InventorySyncResponse,
     FingerprintVerify, FingerprintVerifyResponse
 )
 from auth import (
     verify_password, get_password_hash, create_access_token,
-    get_current_user, get_current_merchant, get_current_customer
+    get_current_user, get_current_merchant, get_current_customer, get_cached_merchant,
+    get_merchant_db, get_merchant_read_db, merchant_moving_error
 )
-from security_enclave import encrypt_sensitive, hash_fingerprint
+from security_enclave import encrypt_sensitive, hash_fingerprint, master_key
 from auth_biometric import authenticate_with_fingerprint, check_fingerprint_exists
 from compliance import (
     record_user_consent, delete_biometric_data, get_user_consent_history,
     export_user_data, verify_user_consent
 )
-from stripe_service import (
-    create_payment_intent, confirm_payment_intent, retrieve_payment_intent,
-    create_or_retrieve_customer, attach_payment_method_to_customer
+from pos import POSAdapterError, POSLineItem, POSPaymentRequest, POSTransientError, pos_middleware
+from pos.clients import close_clients, run_blocking
+from payment_status import (
+    FINAL_STATUSES, apply_status_updates, remember_provider_customer, settle_after_provider_call
 )
-from pos import POSAdapterError, POSLineItem, POSPaymentRequest, pos_middleware
+from payment_queue import PAYMENT_STATUS_MAX_WAIT, enqueue_payment, payment_queue, wants_async
+from idempotency import idempotency_store, provider_key, request_hash
+from pricing import price_cart, price_client_cart
+from stock import OutOfStockError, reserve_stock
+from inventory_io import FORMATS, detect_format, export_inventory, import_inventory
+from inventory_search import search_inventory
+from ids import display_suffix, ensure_node_id
+from inventory_sync import SYNC_MAX_PAGE_SIZE, SYNC_PAGE_SIZE, purge_tombstones, sync_page
+from barcode_cache import barcode_cache
+from webhook_inbox import webhook_inbox
+from status_refresher import status_refresher
+from server_timing import SERVER_TIMING_ENABLED, header_value, phase, start_request
 
 load_dotenv()
 
 
-def _map_provider_status(status: Optional[str]) -> str:
-    if not status:
-        return "processing"
-    normalized = status.lower()
-    if normalized in {"succeeded", "paid", "completed", "captured"}:
-        return "completed"
-    if normalized in {"processing", "pending", "requires_action", "requires_payment_method"}:
-        return "processing"
-    if normalized in {"canceled", "cancelled"}:
-        return "cancelled"
-    if normalized in {"failed", "declined", "refused"}:
-        return "failed"
-    return "processing"
+def _find_transaction(shard_dbs: List[Session], *criteria):
+    """
+    Find a transaction on whichever shard holds it, to update it; returns
+    (transaction, session). 503 while its merchant is moving between shards.
+    """
+    for shard_db in shard_dbs:
+        transaction = shard_db.query(Transaction).filter(*criteria).first()
+        if transaction:
+            if shards.lookup(transaction.merchant_id)[1] == "moving":
+                raise merchant_moving_error()
+            return transaction, shard_db
+    return None, None
 
 
 app = FastAPI(
@@ -110,6 +136,23 @@ async def custom_cors_middleware(request: Request, call_next):
     
     return response
 
+# Read-your-writes: pin clients to the primary for a short window after a write
+@app.middleware("http")
+async def track_client_writes(request: Request, call_next):
+    response = await call_next(request)
+    if request.method not in {"GET", "HEAD", "OPTIONS"} and response.status_code < 400:
+        replicas.note_write(client_key(request))
+    return response
+
+if SERVER_TIMING_ENABLED:
+    @app.middleware("http")
+    async def server_timing(request: Request, call_next):
+        started = time.perf_counter()
+        phases = start_request()
+        response = await call_next(request)
+        response.headers["Server-Timing"] = header_value(phases, (time.perf_counter() - started) * 1000)
+        return response
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -121,7 +164,24 @@ app.add_middleware(
 # Initialize database on startup
 @app.on_event("startup")
 async def startup_event():
+    master_key()
+    ensure_node_id()
     init_db()
+    with SessionLocal() as db:
+        idempotency_store.purge_expired(db)
+        with shards.all_sessions(db) as shard_dbs:
+            for shard_db in shard_dbs:
+                purge_tombstones(shard_db)
+    await payment_queue.start()
+    await webhook_inbox.start()
+    await status_refresher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await status_refresher.stop()
+    await webhook_inbox.stop()
+    await payment_queue.stop()
+    await close_clients()
 
 # Root endpoint
 @app.get("/")
@@ -140,7 +200,15 @@ async def healthz():
         db = SessionLocal()
         db.execute(text("SELECT 1"))
         db.close()
-        return {"status": "ok", "database": "connected", "version": "2.0.0"}
+        health = {"status": "ok", "database": "connected", "version": "2.0.0"}
+        if replicas.replicas:
+            health["replicas"] = replicas.status()
+        health["payment_queue"] = payment_queue.metrics()
+        health["webhooks"] = webhook_inbox.metrics()
+        health["status_refresher"] = status_refresher.metrics()
+        health["pos"] = pos_middleware.health()
+        health["barcode_cache"] = barcode_cache.metrics()
+        return health
     except Exception as e:
         return {"status": "ok", "database": "disconnected", "error": str(e), "version": "2.0.0"}
 
@@ -153,41 +221,51 @@ async def health_check():
 @app.post("/api/auth/register", response_model=Token, status_code=status.HTTP_201_CREATED)
 async def register(request: RegisterRequest, db: Session = Depends(get_db)):
     """Register a new merchant or customer"""
-    # Check if user exists
-    existing_user = db.query(User).filter(User.email == request.email).first()
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
     role = request.role or "merchant"
     if role not in {"merchant", "customer"}:
         raise HTTPException(status_code=400, detail="Invalid role specified")
+    if role == "merchant" and not request.company_name:
+        raise HTTPException(status_code=400, detail="company_name is required for merchant registration")
 
-    # Create user
-    user = User(
-        email=request.email,
-        hashed_password=get_password_hash(request.password),
-        role=role
-    )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
-    
-    if role == "merchant":
-        if not request.company_name:
-            raise HTTPException(status_code=400, detail="company_name is required for merchant registration")
-        merchant = Merchant(
-            user_id=user.id,
-            name=request.name,
-            company_name=request.company_name,
+    # Create user; the unique email index detects duplicates atomically
+    user_id = db.execute(
+        insert_for(db, User)
+        .values(
             email=request.email,
-            phone=request.phone,
-            api_key=f"pk_live_{uuid.uuid4().hex[:32]}"
+            hashed_password=get_password_hash(request.password),
+            role=role
         )
-        db.add(merchant)
+        .on_conflict_do_nothing(index_elements=[User.email])
+        .returning(User.id)
+    ).scalar()
+    if user_id is None:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
+    if role == "merchant":
+        merchant_pk = db.execute(
+            insert(Merchant)
+            .values(
+                user_id=user_id,
+                name=request.name,
+                company_name=request.company_name,
+                email=request.email,
+                phone=request.phone,
+                api_key=f"pk_live_{uuid.uuid4().hex[:32]}"
+            )
+            .returning(Merchant.id)
+        ).scalar()
+        db.execute(insert(MerchantShard).values(merchant_id=merchant_pk, shard=shards.assign(merchant_pk)))
+    
+    # User and merchant profile commit together
+    try:
         db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = create_access_token(data={"sub": str(user_id)})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/api/auth/login", response_model=Token)
@@ -205,7 +283,7 @@ async def login(request: LoginRequest, db: Session = Depends(get_db)):
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Account is inactive")
     
-    access_token = create_access_token(data={"sub": user.id})
+    access_token = create_access_token(data={"sub": str(user.id)})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/api/auth/me")
@@ -237,46 +315,55 @@ async def register_customer(
     # Create hash for duplicate detection
     template_hash = hash_fingerprint(normalized_sample)
     
-    # Check for duplicate using hash (no decryption needed)
-    existing = db.query(Fingerprint).filter(Fingerprint.template_hash == template_hash).first()
-    if existing:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="Fingerprint already registered"
-        )
-    
     # Encrypt fingerprint template
     salt_b64, encrypted_template = encrypt_sensitive(normalized_sample)
     
-    # Create or update customer record
-    customer = db.query(Customer).filter(Customer.email == request.email).first()
-    if customer:
-        if customer.fingerprint:
-            raise HTTPException(status_code=409, detail="Customer already enrolled with fingerprint")
-        customer.name = request.name
-        customer.phone = request.phone
-    else:
-        customer = Customer(
+    # Link customer to existing user account if available
+    user_id = select(User.id).where(User.email == request.email).scalar_subquery()
+    
+    # Create or update the customer in one statement on the unique email index
+    customer = db.execute(
+        insert_for(db, Customer)
+        .values(
             name=request.name,
             email=request.email,
-            phone=request.phone
+            phone=request.phone,
+            user_id=user_id
+        )
+        .on_conflict_do_update(
+            index_elements=[Customer.email],
+            set_=dict(
+                name=request.name,
+                phone=request.phone,
+                user_id=func.coalesce(Customer.user_id, user_id),
+                updated_at=datetime.utcnow()
+            )
+        )
+        .returning(Customer.id, Customer.customer_id, Customer.enrolled_at, Customer.is_active)
+    ).first()
+    customer_pk, customer_id, enrolled_at, is_active = customer[:4]
+    
+    # Create encrypted fingerprint record in Secure Enclave.
+    # The unique template_hash and customer_id indexes reject duplicates (no
+    # decryption needed); the rollback also undoes the customer update.
+    fingerprint_id = db.execute(
+        insert_for(db, Fingerprint)
+        .values(
+            customer_id=customer_pk,
+            salt_b64=salt_b64,
+            encrypted_template=encrypted_template,
+            template_hash=template_hash
+        )
+        .on_conflict_do_nothing()
+        .returning(Fingerprint.id)
+    ).scalar()
+    if fingerprint_id is None:
+        db.rollback()
+        enrolled = db.execute(select(Fingerprint.id).where(Fingerprint.customer_id == customer_pk)).first()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Customer already enrolled with fingerprint" if enrolled else "Fingerprint already registered"
         )
-        db.add(customer)
-        db.flush()
-
-    # Link customer to existing user account if available
-    user = db.query(User).filter(User.email == request.email).first()
-    if user and not customer.user_id:
-        customer.user_id = user.id
-    
-    # Create encrypted fingerprint record in Secure Enclave
-    fingerprint = Fingerprint(
-        customer_id=customer.id,
-        salt_b64=salt_b64,
-        encrypted_template=encrypted_template,
-        template_hash=template_hash
-    )
-    db.add(fingerprint)
     
     # Record BIPA consent (required for biometric data)
     # Note: In production, get consent_text from request or predefined templates
@@ -298,14 +385,13 @@ async def register_customer(
         pass
     
     db.commit()
-    db.refresh(customer)
     
     return CustomerResponse(
-        customer_id=customer.customer_id,
-        name=customer.name,
-        email=customer.email,
-        enrolled_at=customer.enrolled_at,
-        is_active=customer.is_active
+        customer_id=customer_id,
+        name=request.name,
+        email=request.email,
+        enrolled_at=enrolled_at,
+        is_active=is_active
     )
 
 @app.post("/api/customers/verify-fingerprint", response_model=FingerprintVerifyResponse)
@@ -318,12 +404,14 @@ async def verify_fingerprint(
     Uses hash-based matching without decrypting stored templates.
     """
     # Check if fingerprint exists
-    check_result = check_fingerprint_exists(request.fingerprint_hash, db)
+    with phase("fingerprint"):
+        check_result = check_fingerprint_exists(request.fingerprint_hash, db)
     
     if check_result["exists"]:
         # Authenticate and get customer info
         try:
-            auth_result = authenticate_with_fingerprint(request.fingerprint_hash, db)
+            with phase("fingerprint"):
+                auth_result = authenticate_with_fingerprint(request.fingerprint_hash, db)
             
             return FingerprintVerifyResponse(
                 verified=True,
@@ -331,11 +419,14 @@ async def verify_fingerprint(
                 is_new=False
             )
         except HTTPException:
+            db.rollback()
             return FingerprintVerifyResponse(
                 verified=False,
                 is_new=True
             )
     else:
+        # End the read now; the session is only closed after the response is sent
+        db.rollback()
         return FingerprintVerifyResponse(
             verified=False,
             is_new=True
@@ -435,57 +526,184 @@ async def add_payment_method(
     if not request.encrypted_data or not request.encrypted_data.startswith("pm_"):
         raise HTTPException(status_code=400, detail="Invalid Stripe payment method token")
 
-    stripe_customer_id = create_or_retrieve_customer(
+    customer_pk, stored_stripe_id = customer.id, customer.stripe_customer_id
+    resolve_args = dict(
+        customer_reference=customer.customer_id,
         email=customer.email or f"customer_{customer.customer_id}@protega.cloud",
-        name=customer.name
+        name=customer.name,
+        stored_id=stored_stripe_id
     )
+    # Don't hold a database connection across the Stripe round trips
+    db.rollback()
+
+    # Imported on first use: the Stripe SDK is a large share of cold-start time
+    from stripe_service import attach_payment_method_to_customer, resolve_customer_id
 
     try:
-        attach_payment_method_to_customer(request.encrypted_data, stripe_customer_id)
+        stripe_customer_id = await run_blocking(resolve_customer_id, **resolve_args)
+        await run_blocking(attach_payment_method_to_customer, request.encrypted_data, stripe_customer_id)
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
+    if stored_stripe_id != stripe_customer_id:
+        db.execute(
+            update(Customer)
+            .where(Customer.id == customer_pk)
+            .values(stripe_customer_id=stripe_customer_id)
+            .execution_options(synchronize_session=False)
+        )
 
     # If setting as default, unset other defaults
     if request.is_default:
         db.query(PaymentMethod).filter(
-            PaymentMethod.customer_id == customer.id
+            PaymentMethod.customer_id == customer_pk
         ).update({"is_default": False})
 
-    payment_method = PaymentMethod(
-        customer_id=customer.id,
+    payment_method_id = db.execute(
+        insert(PaymentMethod)
+        .values(
+            customer_id=customer_pk,
+            type=request.type,
+            name=request.name,
+            last4=request.last4,
+            encrypted_data=request.encrypted_data,
+            is_default=request.is_default
+        )
+        .returning(PaymentMethod.id)
+    ).scalar()
+    db.commit()
+    
+    return PaymentMethodResponse(
+        id=payment_method_id,
         type=request.type,
         name=request.name,
         last4=request.last4,
-        encrypted_data=request.encrypted_data,
         is_default=request.is_default
     )
-    db.add(payment_method)
-    db.commit()
-    db.refresh(payment_method)
-    
-    return PaymentMethodResponse(
-        id=payment_method.id,
-        type=payment_method.type,
-        name=payment_method.name,
-        last4=payment_method.last4,
-        is_default=payment_method.is_default
-    )
 
 # ==================== TRANSACTION ENDPOINTS ====================
 
 @app.post("/api/transactions/create", response_model=TransactionResponse, status_code=status.HTTP_201_CREATED)
 async def create_transaction(
     request: TransactionCreate,
+    http_request: Request,
+    response: Response,
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    merchant_db: Session = Depends(get_merchant_db)
 ):
     """
     Create a new transaction using Secure Enclave fingerprint verification.
     Verifies fingerprint hash without decrypting stored template.
+    
+    With `Prefer: respond-async` (or ASYNC_CHECKOUT=true) the payment is queued
+    and the endpoint answers 202; follow it via /api/transactions/{id}/status.
+    
+    Retries carrying the same `Idempotency-Key` get the original response
+    without creating another transaction or contacting the provider.
     """
-    # Authenticate using fingerprint (Secure Enclave)
+    key = http_request.headers.get("Idempotency-Key")
+    if not key:
+        return await _checkout(request, http_request, response, current_merchant, db, merchant_db)
+
+    stored = idempotency_store.begin(db, current_merchant.id, key, request_hash(request.model_dump()))
+    if stored is not None:
+        if stored.status_code >= 400:
+            raise HTTPException(
+                status_code=stored.status_code,
+                detail=stored.body.get("detail"),
+                headers={"Idempotent-Replayed": "true"}
+            )
+        response.status_code = stored.status_code
+        response.headers["Idempotent-Replayed"] = "true"
+        return stored.body
+
+    progress = CheckoutProgress()
     try:
-        auth_result = authenticate_with_fingerprint(request.fingerprint_hash, db)
+        result = await _checkout(
+            request, http_request, response, current_merchant, db, merchant_db,
+            idempotency_key=provider_key(current_merchant.merchant_id, key), progress=progress
+        )
+    except PaymentInDoubtError as exc:
+        # The provider may hold the charge: retries get the original transaction to follow, not a second one
+        idempotency_store.complete(
+            db, current_merchant.id, key, status.HTTP_202_ACCEPTED,
+            jsonable_encoder(exc.transaction), exc.transaction.transaction_id
+        )
+        raise
+    except HTTPException as exc:
+        # Provider declines are final; the other errors _checkout raises
+        # leave no charge behind and may be retried
+        if exc.status_code == 402:
+            idempotency_store.complete(db, current_merchant.id, key, exc.status_code, {"detail": exc.detail})
+        else:
+            idempotency_store.release(db, current_merchant.id, key)
+        raise
+    except BaseException:
+        # Unexpected errors, client disconnects (CancelledError) and shutdown.
+        # Once the payment was submitted the provider may hold the charge,
+        # so retries follow the original transaction instead of charging again
+        if progress.submitted is None:
+            idempotency_store.release(db, current_merchant.id, key)
+        else:
+            db.rollback()
+            idempotency_store.complete(
+                db, current_merchant.id, key, status.HTTP_202_ACCEPTED,
+                jsonable_encoder(progress.submitted), progress.submitted.transaction_id
+            )
+        raise
+
+    idempotency_store.complete(
+        db, current_merchant.id, key,
+        response.status_code or status.HTTP_201_CREATED,
+        jsonable_encoder(result),
+        result.transaction_id
+    )
+    return result
+
+@dataclass
+class CheckoutProgress:
+    """How far a checkout got, for the idempotency handling around it"""
+    # The 'processing' transaction, set once the payment was handed to the provider or the queue
+    submitted: Optional[TransactionResponse] = None
+
+class PaymentInDoubtError(HTTPException):
+    """503 for a payment request the provider may have received; carries the 'processing' transaction"""
+
+    def __init__(self, transaction: TransactionResponse, detail: str, retry_after: float) -> None:
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(retry_after)))}
+        )
+        self.transaction = transaction
+
+async def _checkout(
+    request: TransactionCreate,
+    http_request: Request,
+    response: Response,
+    current_merchant: Merchant,
+    db: Session,
+    merchant_db: Session,
+    idempotency_key: Optional[str] = None,
+    progress: Optional["CheckoutProgress"] = None
+) -> TransactionResponse:
+    # Price the cart first so an unknown barcode fails before any fingerprint work
+    try:
+        with phase("db"):
+            if request.cart:
+                priced = price_cart(merchant_db, current_merchant.id, request.cart)
+            else:
+                priced = price_client_cart(request.amount, [item.dict() for item in request.items])
+    except HTTPException:
+        # End the read now; the session is only closed after the response is sent
+        merchant_db.rollback()
+        raise
+
+    # Authenticate using fingerprint (Secure Enclave); the verification
+    # metadata bump commits together with the transaction insert below
+    try:
+        with phase("fingerprint"):
+            auth_result = authenticate_with_fingerprint(request.fingerprint_hash, db, commit=False)
     except HTTPException as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -497,55 +715,69 @@ async def create_transaction(
     if not customer_id:
         raise HTTPException(status_code=404, detail="Customer not found")
     
-    customer = db.query(Customer).filter(Customer.id == customer_id).first()
+    customer = db.execute(
+        select(Customer.id, Customer.customer_id, Customer.email, Customer.name, Customer.stripe_customer_id)
+        .where(Customer.id == customer_id)
+    ).first()
     if not customer:
+        db.rollback()
         raise HTTPException(status_code=404, detail="Customer not found")
     
     # Get hash for transaction record (not encrypted template)
-    template_hash = hash_fingerprint(request.fingerprint_hash)
-    
-    # Calculate totals
-    tax = request.amount * 0.08  # 8% tax
-    total = request.amount + tax
-    
-    # Create transaction
-    transaction = Transaction(
-        customer_id=customer.id,
-        merchant_id=current_merchant.id,
-        payment_method_id=request.payment_method_id,
-        amount=request.amount,
-        tax=tax,
-        total=total,
-        items=[item.dict() for item in request.items],
-        template_hash=template_hash,  # Store hash, not encrypted template
-        status="processing"
-    )
-    db.add(transaction)
-    db.commit()
-    db.refresh(transaction)
+    template_hash = auth_result["template_hash"]
+    
+    total = priced.total
+    items = priced.items
+    
+    payment_method_token = None
+    if request.payment_method_id:
+        payment_method_token = db.execute(
+            select(PaymentMethod.encrypted_data).where(
+                PaymentMethod.id == request.payment_method_id,
+                PaymentMethod.customer_id == customer.id
+            )
+        ).scalar()
+    
+    # Create transaction on the merchant's shard; generated identifiers come back via RETURNING.
+    # Stock is taken in the same database transaction, so a rejected cart leaves no trace
+    with phase("db"):
+        try:
+            stock_reserved = reserve_stock(merchant_db, items)
+        except OutOfStockError as exc:
+            merchant_db.rollback()
+            if merchant_db is not db:
+                db.rollback()
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(exc))
+        transaction_pk, transaction_id, created_at = merchant_db.execute(
+            insert(Transaction)
+            .values(
+                customer_id=customer.id,
+                merchant_id=current_merchant.id,
+                payment_method_id=request.payment_method_id,
+                amount=priced.amount,
+                tax=priced.tax,
+                total=total,
+                items=items,
+                template_hash=template_hash,  # Store hash, not encrypted template
+                status="processing",
+                stock_reserved=stock_reserved or None
+            )
+            .returning(Transaction.id, Transaction.transaction_id, Transaction.created_at)
+        ).first()
     
     # Process payment through the POS middleware
     metadata = {
-        "transaction_id": transaction.transaction_id,
+        "transaction_id": transaction_id,
         "customer_id": customer.customer_id,
         "merchant_id": current_merchant.merchant_id,
         "fingerprint_hash": template_hash[:16],
     }
 
-    payment_method_token = None
-    if request.payment_method_id:
-        payment_method = db.query(PaymentMethod).filter(
-            PaymentMethod.id == request.payment_method_id,
-            PaymentMethod.customer_id == customer.id
-        ).first()
-        if payment_method and payment_method.encrypted_data:
-            payment_method_token = payment_method.encrypted_data
-
     provider = (request.pos_provider or os.getenv("DEFAULT_POS_PROVIDER", "stripe")).lower()
     currency = os.getenv("PAYMENT_CURRENCY", "usd")
 
     pos_request = POSPaymentRequest(
-        amount=request.amount,
+        amount=priced.amount,
         total=total,
         currency=currency,
         customer_email=customer.email,
@@ -554,46 +786,140 @@ async def create_transaction(
         merchant_reference=current_merchant.merchant_id,
         payment_method_token=payment_method_token,
         fingerprint_hash=template_hash,
+        provider_customer_id=customer.stripe_customer_id if provider == "stripe" else None,
+        # Without a client key the transaction itself keys provider retries
+        idempotency_key=idempotency_key or provider_key(current_merchant.merchant_id, transaction_id),
         metadata=metadata,
-        items=[POSLineItem(name=item.name, price=item.price) for item in request.items],
+        items=[
+            POSLineItem(name=item["name"], price=item["price"], quantity=item.get("quantity", 1))
+            for item in items
+        ],
+    )
+
+    run_async = wants_async(http_request.headers.get("prefer"))
+    if run_async:
+        enqueue_payment(
+            db, transaction_pk, transaction_id, current_merchant.id, customer.id, provider, pos_request
+        )
+
+    # The transaction commits before its queue entry so workers never see a job
+    # without its row; committing also releases the connection for the provider round trip
+    with phase("commit"):
+        merchant_db.commit()
+        if merchant_db is not db:
+            db.commit()
+
+    processing = TransactionResponse(
+        transaction_id=transaction_id,
+        customer_id=customer.customer_id,
+        amount=priced.amount,
+        total=total,
+        status="processing",
+        items=items,
+        timestamp=created_at,
+        payment_provider=provider,
     )
+    if run_async:
+        if progress is not None:
+            progress.submitted = processing
+        payment_queue.notify()
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers["Location"] = f"/api/transactions/{transaction_id}/status"
+        return processing
 
     pos_result = None
+    if progress is not None:
+        progress.submitted = processing
     try:
-        pos_result = pos_middleware.process_payment(provider, pos_request)
-        transaction.payment_provider = provider
-        transaction.provider_transaction_id = pos_result.transaction_reference
-        transaction.status = _map_provider_status(pos_result.status)
-        transaction.updated_at = datetime.utcnow()
-        db.commit()
+        with phase("provider"):
+            pos_result = await pos_middleware.process_payment(provider, pos_request)
+    except POSTransientError as exc:
+        retry_after = getattr(exc, "retry_after", 1.0)
+        # A call the provider may have received stays 'processing' until reconciled
+        if exc.request_sent:
+            raise PaymentInDoubtError(
+                processing,
+                detail=f"Payment provider '{provider}' did not confirm the payment: {str(exc)}",
+                retry_after=retry_after
+            )
+        await settle_after_provider_call(current_merchant.id, transaction_pk, provider)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Payment provider '{provider}' is unavailable: {str(exc)}",
+            headers={"Retry-After": str(max(1, int(retry_after)))}
+        )
     except POSAdapterError as exc:
-        transaction.status = "failed"
-        transaction.updated_at = datetime.utcnow()
-        db.commit()
+        await settle_after_provider_call(current_merchant.id, transaction_pk, provider)
         raise HTTPException(
             status_code=402,
             detail=f"Payment processing failed via '{provider}': {str(exc)}"
         )
     except Exception as exc:
-        transaction.status = "failed"
-        transaction.updated_at = datetime.utcnow()
-        db.commit()
+        await settle_after_provider_call(current_merchant.id, transaction_pk, provider)
         raise HTTPException(
             status_code=500,
             detail=f"Unexpected payment processing error: {str(exc)}"
         )
     
+    with phase("settle"):
+        transaction_status = await settle_after_provider_call(current_merchant.id, transaction_pk, provider, pos_result)
+        remember_provider_customer(db, customer.id, provider, pos_request, pos_result)
+    
     return TransactionResponse(
-        transaction_id=transaction.transaction_id,
+        transaction_id=transaction_id,
         customer_id=customer.customer_id,
-        amount=transaction.amount,
-        total=transaction.total,
-        status=transaction.status,
-        items=transaction.items,
-        timestamp=transaction.created_at,
-        payment_provider=transaction.payment_provider,
-        provider_transaction_id=transaction.provider_transaction_id,
-        client_secret=pos_result.client_secret if pos_result else None,
+        amount=priced.amount,
+        total=total,
+        status=transaction_status,
+        items=items,
+        timestamp=created_at,
+        payment_provider=provider,
+        provider_transaction_id=pos_result.transaction_reference,
+        client_secret=pos_result.client_secret,
+    )
+
+@app.get("/api/transactions/{transaction_id}/status")
+async def get_transaction_status(
+    transaction_id: str,
+    wait: float = 0,
+    current_merchant: Merchant = Depends(get_current_merchant),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Payment status for a checkout. With `wait` (seconds, max 30) the request
+    long-polls until the transaction leaves 'processing'.
+    """
+    merchant_pk = current_merchant.id
+    # Long polls must not pin a pooled connection
+    db.close()
+
+    latest = None
+    async for latest in payment_queue.watch(merchant_pk, transaction_id, min(max(wait, 0), PAYMENT_STATUS_MAX_WAIT)):
+        if latest is None:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+    return latest
+
+@app.get("/api/transactions/{transaction_id}/events")
+async def stream_transaction_status(
+    transaction_id: str,
+    current_merchant: Merchant = Depends(get_current_merchant),
+    db: Session = Depends(get_read_db)
+):
+    """Server-sent events with the transaction status; the stream ends once it settles"""
+    merchant_pk = current_merchant.id
+    db.close()
+
+    async def events():
+        async for latest in payment_queue.watch(merchant_pk, transaction_id, PAYMENT_STATUS_MAX_WAIT * 10):
+            if latest is None:
+                yield "event: error\ndata: {\"detail\": \"Transaction not found\"}\n\n"
+                return
+            yield f"event: status\ndata: {json.dumps(latest)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 @app.get("/api/transactions", response_model=List[TransactionResponse])
@@ -601,27 +927,41 @@ async def get_transactions(
     skip: int = 0,
     limit: int = 100,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_replica_db)
 ):
     """Get transaction history"""
     # Get merchant or customer
     merchant = db.query(Merchant).filter(Merchant.user_id == current_user.id).first()
     customer = db.query(Customer).filter(Customer.user_id == current_user.id).first()
     
-    query = db.query(Transaction)
-    
     if merchant:
-        query = query.filter(Transaction.merchant_id == merchant.id)
+        with shards.merchant_session(merchant.id, db) as merchant_db:
+            transactions = merchant_db.query(Transaction).filter(
+                Transaction.merchant_id == merchant.id
+            ).order_by(Transaction.created_at.desc()).offset(skip).limit(limit).all()
     elif customer:
-        query = query.filter(Transaction.customer_id == customer.id)
+        # A customer's transactions span every merchant shard
+        transactions = []
+        with shards.all_sessions(db, for_write=False) as shard_dbs:
+            for shard_db in shard_dbs:
+                transactions += shard_db.query(Transaction).filter(
+                    Transaction.customer_id == customer.id
+                ).order_by(Transaction.created_at.desc()).limit(skip + limit).all()
+        transactions.sort(key=lambda t: t.created_at, reverse=True)
+        transactions = transactions[skip:skip + limit]
     else:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    transactions = query.order_by(Transaction.created_at.desc()).offset(skip).limit(limit).all()
+    # Customers live in the global database
+    customer_ids = dict(
+        db.query(Customer.id, Customer.customer_id)
+        .filter(Customer.id.in_({t.customer_id for t in transactions}))
+        .all()
+    )
     
     return [TransactionResponse(
         transaction_id=t.transaction_id,
-        customer_id=t.customer.customer_id,
+        customer_id=customer_ids.get(t.customer_id, ""),
         amount=t.amount,
         total=t.total,
         status=t.status,
@@ -634,10 +974,11 @@ async def get_transactions(
 @app.get("/api/merchant/stats", response_model=MerchantStats)
 async def get_merchant_stats(
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_merchant_read_db)
 ):
     """Get merchant analytics and statistics"""
-    transactions = db.query(Transaction).filter(Transaction.merchant_id == current_merchant.id).all()
+    with phase("db"):
+        transactions = db.query(Transaction).filter(Transaction.merchant_id == current_merchant.id).all()
     
     completed = [t for t in transactions if t.status == "completed"]
     total_transactions = len(completed)
@@ -668,11 +1009,12 @@ async def get_merchant_customers(
     skip: int = 0,
     limit: int = 100,
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_replica_db),
+    merchant_db: Session = Depends(get_merchant_read_db)
 ):
     """Get customers who have transacted with this merchant"""
     # Get unique customers from transactions
-    transactions = db.query(Transaction).filter(
+    transactions = merchant_db.query(Transaction).filter(
         Transaction.merchant_id == current_merchant.id
     ).all()
     
@@ -687,7 +1029,7 @@ async def get_merchant_customers(
         
         result.append({
             "customer_id": customer.customer_id,
-            "name": f"Customer #{customer.customer_id[-3:]}",  # Anonymous
+            "name": f"Customer #{display_suffix(customer.customer_id)}",  # Anonymous
             "date_added": customer.enrolled_at,
             "transaction_count": len(completed_txns),
             "total_spent": sum(t.total for t in completed_txns)
@@ -700,7 +1042,7 @@ async def get_merchant_customers(
 @app.get("/api/inventory", response_model=List[InventoryResponse])
 async def get_inventory(
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_merchant_read_db)
 ):
     """Get merchant inventory"""
     items = db.query(Inventory).filter(
@@ -721,36 +1063,40 @@ async def get_inventory(
 async def create_inventory_item(
     request: InventoryCreate,
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_merchant_db)
 ):
     """Add item to merchant inventory"""
-    item = Inventory(
-        merchant_id=current_merchant.id,
+    item_id = db.execute(
+        insert(Inventory)
+        .values(
+            merchant_id=current_merchant.id,
+            name=request.name,
+            barcode=request.barcode,
+            price=request.price,
+            category=request.category,
+            stock=request.stock
+        )
+        .returning(Inventory.id)
+    ).scalar()
+    # A scan of this barcode may have cached "not found"
+    barcode_cache.invalidate_on_commit(db, current_merchant.id, [request.barcode])
+    db.commit()
+    
+    return InventoryResponse(
+        id=item_id,
         name=request.name,
         barcode=request.barcode,
         price=request.price,
         category=request.category,
         stock=request.stock
     )
-    db.add(item)
-    db.commit()
-    db.refresh(item)
-    
-    return InventoryResponse(
-        id=item.id,
-        name=item.name,
-        barcode=item.barcode,
-        price=item.price,
-        category=item.category,
-        stock=item.stock
-    )
 
 @app.put("/api/inventory/{item_id}", response_model=InventoryResponse)
 async def update_inventory_item(
     item_id: int,
     request: InventoryCreate,
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_merchant_db)
 ):
     """Update inventory item"""
     item = db.query(Inventory).filter(
@@ -761,6 +1107,7 @@ async def update_inventory_item(
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
     
+    barcode_cache.invalidate_on_commit(db, current_merchant.id, [item.barcode, request.barcode])
     item.name = request.name
     item.barcode = request.barcode
     item.price = request.price
@@ -784,7 +1131,7 @@ async def update_inventory_item(
 async def delete_inventory_item(
     item_id: int,
     current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_merchant_db)
 ):
     """Delete inventory item"""
     item = db.query(Inventory).filter(
@@ -796,6 +1143,7 @@ async def delete_inventory_item(
         raise HTTPException(status_code=404, detail="Item not found")
     
     item.is_active = False
+    barcode_cache.invalidate_on_commit(db, current_merchant.id, [item.barcode])
     db.commit()
     
     return {"message": "Item deleted successfully"}
@@ -803,28 +1151,145 @@ async def delete_inventory_item(
 @app.get("/api/inventory/barcode/{barcode}", response_model=InventoryResponse)
 async def get_inventory_by_barcode(
     barcode: str,
-    current_merchant: Merchant = Depends(get_current_merchant),
-    db: Session = Depends(get_db)
+    current_merchant: Merchant = Depends(get_cached_merchant),
+    db: Session = Depends(get_read_db)
 ):
-    """Get inventory item by barcode"""
-    item = db.query(Inventory).filter(
-        Inventory.barcode == barcode,
-        Inventory.merchant_id == current_merchant.id,
-        Inventory.is_active == True
-    ).first()
+    """
+    Get inventory item by barcode, from the barcode cache when warm.
+    Misses read the primary rather than a replica, so a lagging copy is never cached.
+    """
+    found, row, token = barcode_cache.lookup(current_merchant.id, barcode)
+    if not found:
+        with phase("db"), shards.merchant_session(current_merchant.id, db) as merchant_db:
+            row = merchant_db.execute(
+                select(
+                    Inventory.id, Inventory.name, Inventory.barcode,
+                    Inventory.price, Inventory.category, Inventory.stock
+                )
+                .where(
+                    Inventory.barcode == barcode,
+                    Inventory.merchant_id == current_merchant.id,
+                    Inventory.is_active == True
+                )
+                .order_by(Inventory.id)
+                .limit(1)
+            ).first()
+            row = tuple(row) if row else None
+        db.close()
+        barcode_cache.store(current_merchant.id, barcode, row, token)
     
-    if not item:
+    if row is None:
         raise HTTPException(status_code=404, detail="Item not found")
     
+    item_id, name, item_barcode, price, category, stock = row
     return InventoryResponse(
-        id=item.id,
-        name=item.name,
-        barcode=item.barcode,
-        price=item.price,
-        category=item.category,
-        stock=item.stock
+        id=item_id,
+        name=name,
+        barcode=item_barcode,
+        price=price,
+        category=category,
+        stock=stock
+    )
+
+@app.get("/api/inventory/search", response_model=InventorySearchResponse)
+async def search_inventory_items(
+    q: str,
+    skip: int = 0,
+    limit: int = 20,
+    current_merchant: Merchant = Depends(get_current_merchant),
+    db: Session = Depends(get_merchant_read_db)
+):
+    """
+    Find items by barcode prefix, name or category prefix, or a misspelt name.
+    Results are ranked best first; `has_more` tells whether another page exists.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="q must not be empty")
+    skip, limit = max(skip, 0), min(max(limit, 1), 100)
+    with phase("db"):
+        hits = search_inventory(db, current_merchant.id, q, limit + 1, skip)
+
+    return InventorySearchResponse(
+        items=[
+            InventorySearchHit(
+                id=item_id, name=name, barcode=barcode, price=price, category=category, stock=stock, score=score
+            )
+            for score, (item_id, name, barcode, price, category, stock) in hits[:limit]
+        ],
+        has_more=len(hits) > limit
+    )
+
+@app.get("/api/inventory/sync", response_model=InventorySyncResponse)
+async def sync_inventory(
+    sync_token: Optional[str] = None,
+    limit: int = SYNC_PAGE_SIZE,
+    current_merchant: Merchant = Depends(get_current_merchant),
+    db: Session = Depends(get_read_db)
+):
+    """
+    Catalog changes since `sync_token`: updated items plus ids deleted since.
+    Without a token the active catalog is sent as a full resync; a 410 means
+    the token outlived the tombstone window and the terminal must resync.
+    Reads the primary, since a lagging replica would let the token skip rows.
+    """
+    limit = min(max(limit, 1), SYNC_MAX_PAGE_SIZE)
+    with phase("db"), shards.merchant_session(current_merchant.id, db) as merchant_db:
+        page = sync_page(merchant_db, current_merchant.id, sync_token, limit)
+    
+    return InventorySyncResponse(
+        items=[
+            InventoryResponse(id=item_id, name=name, barcode=barcode, price=price, category=category, stock=stock)
+            for item_id, name, barcode, price, category, stock in page.items
+        ],
+        deleted=page.deleted,
+        full=page.full,
+        has_more=page.has_more,
+        sync_token=page.sync_token
     )
 
+@app.post("/api/inventory/import")
+async def import_inventory_items(
+    http_request: Request,
+    format: Optional[str] = None,
+    current_merchant: Merchant = Depends(get_current_merchant)
+):
+    """
+    Bulk upsert inventory on barcode from a CSV (header row) or NDJSON body,
+    streamed and written in batches. Invalid rows are skipped and reported.
+    """
+    fmt = detect_format(format, http_request.headers.get("content-type"))
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Send text/csv or application/x-ndjson")
+    report = await import_inventory(current_merchant.id, http_request.stream(), fmt)
+    return asdict(report)
+
+@app.get("/api/inventory/export")
+async def export_inventory_items(
+    format: str = "csv",
+    current_merchant: Merchant = Depends(get_current_merchant)
+):
+    """Stream the active catalog as CSV or NDJSON"""
+    fmt = detect_format(format, None)
+    if fmt is None:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    return StreamingResponse(
+        export_inventory(current_merchant.id, fmt),
+        media_type=FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="inventory.{fmt}"'}
+    )
+
+@app.post("/api/cart/price", response_model=CartPriceResponse)
+async def price_cart_items(
+    request: CartPriceRequest,
+    current_merchant: Merchant = Depends(get_current_merchant),
+    db: Session = Depends(get_merchant_read_db)
+):
+    """Resolve and price a whole cart of barcodes in one lookup (same pricing as checkout)"""
+    with phase("db"):
+        priced = price_cart(db, current_merchant.id, request.cart)
+
+    return CartPriceResponse(items=priced.items, amount=priced.amount, tax=priced.tax, total=priced.total)
+
 # ==================== SECURE ENCLAVE ENDPOINTS ====================
 
 @app.post("/api/biometric/enroll", status_code=status.HTTP_201_CREATED)
@@ -851,31 +1316,33 @@ async def enroll_fingerprint(
     # Hash for duplicate detection
     template_hash = hash_fingerprint(normalized)
     
-    # Check for duplicates
-    existing = db.query(Fingerprint).filter(Fingerprint.template_hash == template_hash).first()
-    if existing:
+    # Encrypt template
+    salt_b64, encrypted_template = encrypt_sensitive(normalized)
+    
+    # Store in Secure Enclave; unique constraints reject duplicates atomically
+    fingerprint_id = db.execute(
+        insert_for(db, Fingerprint)
+        .values(
+            customer_id=customer_id,
+            user_id=current_user.id,
+            salt_b64=salt_b64,
+            encrypted_template=encrypted_template,
+            template_hash=template_hash
+        )
+        .on_conflict_do_nothing()
+        .returning(Fingerprint.id)
+    ).scalar()
+    if fingerprint_id is None:
+        db.rollback()
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="Fingerprint already registered"
         )
-    
-    # Encrypt template
-    salt_b64, encrypted_template = encrypt_sensitive(normalized)
-    
-    # Store in Secure Enclave
-    fingerprint = Fingerprint(
-        customer_id=customer_id,
-        user_id=current_user.id,
-        salt_b64=salt_b64,
-        encrypted_template=encrypted_template,
-        template_hash=template_hash
-    )
-    db.add(fingerprint)
     db.commit()
     
     return {
         "status": "enrolled",
-        "fingerprint_id": fingerprint.id,
+        "fingerprint_id": fingerprint_id,
         "message": "Fingerprint encrypted and stored securely in Secure Enclave"
     }
 
@@ -930,7 +1397,7 @@ async def record_consent(
 @app.get("/api/privacy/consents")
 async def get_consents(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get user's consent history (GDPR right to access)"""
     consents = get_user_consent_history(current_user.id, db)
@@ -951,7 +1418,7 @@ async def delete_user_data(
 @app.get("/api/privacy/export")
 async def export_data(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_replica_db)
 ):
     """
     Export all user data (GDPR right to data portability).
@@ -967,19 +1434,24 @@ async def create_payment_intent_endpoint(
     amount: float,
     transaction_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    shard_dbs: List[Session] = Depends(get_all_shard_dbs)
 ):
     """
     Create a Stripe PaymentIntent for a transaction.
     Returns client_secret for frontend confirmation.
     """
+    from stripe_service import create_payment_intent
+    
     # Get transaction
-    transaction = db.query(Transaction).filter(
-        Transaction.transaction_id == transaction_id
-    ).first()
+    transaction, transaction_db = _find_transaction(
+        shard_dbs, Transaction.transaction_id == transaction_id
+    )
     
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
+    if transaction.status in FINAL_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Transaction is already {transaction.status}")
     
     # Verify user owns this transaction
     customer = db.query(Customer).filter(Customer.id == transaction.customer_id).first()
@@ -1000,11 +1472,16 @@ async def create_payment_intent_endpoint(
             }
         )
         
-        # Update transaction with Stripe PaymentIntent ID
-        transaction.provider_transaction_id = payment_intent["id"]
-        transaction.payment_provider = "stripe"
-        transaction.status = "processing"
-        db.commit()
+        # Record the PaymentIntent; the status change goes through
+        # apply_status_updates so held stock follows it
+        transaction_db.execute(
+            update(Transaction)
+            .where(Transaction.id == transaction.id)
+            .values(provider_transaction_id=payment_intent["id"], payment_provider="stripe")
+            .execution_options(synchronize_session=False)
+        )
+        apply_status_updates(transaction_db, {payment_intent["id"]: "processing"})
+        transaction_db.commit()
         
         return {
             "client_secret": payment_intent["client_secret"],
@@ -1024,16 +1501,19 @@ async def confirm_payment(
     payment_intent_id: str,
     transaction_id: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    shard_dbs: List[Session] = Depends(get_all_shard_dbs)
 ):
     """
     Confirm a Stripe PaymentIntent and update transaction status.
     """
+    from stripe_service import retrieve_payment_intent
+    
     # Get transaction
-    transaction = db.query(Transaction).filter(
+    transaction, db = _find_transaction(
+        shard_dbs,
         Transaction.transaction_id == transaction_id,
         Transaction.provider_transaction_id == payment_intent_id
-    ).first()
+    )
     
     if not transaction:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -1042,22 +1522,23 @@ async def confirm_payment(
         # Check PaymentIntent status
         intent_status = retrieve_payment_intent(payment_intent_id)
         
+        # Status changes go through apply_status_updates, which releases or
+        # retakes the sale's stock and never reopens a settled transaction
         if intent_status["status"] == "succeeded":
-            transaction.status = "completed"
-            transaction.updated_at = datetime.utcnow()
+            apply_status_updates(db, {payment_intent_id: "completed"})
             db.commit()
             return {"status": "completed", "message": "Payment successful"}
         elif intent_status["status"] in ["processing", "requires_action"]:
-            transaction.status = "processing"
+            apply_status_updates(db, {payment_intent_id: "processing"})
             db.commit()
             return {"status": "processing", "message": "Payment processing"}
         else:
-            transaction.status = "failed"
-            transaction.updated_at = datetime.utcnow()
+            apply_status_updates(db, {payment_intent_id: "failed"})
             db.commit()
             return {"status": "failed", "message": f"Payment {intent_status['status']}"}
     except Exception as e:
-        transaction.status = "failed"
+        db.rollback()
+        apply_status_updates(db, {payment_intent_id: "failed"})
         db.commit()
         raise HTTPException(
             status_code=500,
@@ -1069,7 +1550,9 @@ async def confirm_payment(
 async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
     """
     Handle Stripe webhook events.
-    Updates transaction status based on PaymentIntent events.
+    Verified events go to the webhook inbox and are acknowledged at once;
+    the inbox consumer applies PaymentIntent status changes in batches.
+    Redelivered events are recognised by id and dropped.
     """
     import stripe
     
@@ -1089,29 +1572,8 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
     except stripe.error.SignatureVerificationError:
         raise HTTPException(status_code=400, detail="Invalid signature")
     
-    # Handle the event
-    if event["type"] == "payment_intent.succeeded":
-        payment_intent = event["data"]["object"]
-        # Update transaction
-        transaction = db.query(Transaction).filter(
-            Transaction.provider_transaction_id == payment_intent["id"]
-        ).first()
-        if transaction:
-            transaction.status = "completed"
-            transaction.updated_at = datetime.utcnow()
-            db.commit()
-    
-    elif event["type"] == "payment_intent.payment_failed":
-        payment_intent = event["data"]["object"]
-        transaction = db.query(Transaction).filter(
-            Transaction.provider_transaction_id == payment_intent["id"]
-        ).first()
-        if transaction:
-            transaction.status = "failed"
-            transaction.updated_at = datetime.utcnow()
-            db.commit()
-    
-    return {"status": "success"}
+    recorded = webhook_inbox.record_stripe_event(db, event)
+    return {"status": "success", "duplicate": not recorded}
 
 if __name__ == "__main__":
     import uvicorn
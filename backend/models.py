@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, ForeignKey, Text, JSON, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
-import uuid
+
+from ids import new_public_id
 
 Base = declarative_base()
 
@@ -21,7 +22,7 @@ class Merchant(Base):
     __tablename__ = "merchants"
     
     id = Column(Integer, primary_key=True, index=True)
-    merchant_id = Column(String, unique=True, index=True, default=lambda: f"MERCH-{uuid.uuid4().hex[:8].upper()}")
+    merchant_id = Column(String, unique=True, index=True, default=lambda: new_public_id("MERCH"))
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     name = Column(String, nullable=False)
     company_name = Column(String)
@@ -39,15 +40,16 @@ class Customer(Base):
     __tablename__ = "customers"
     
     id = Column(Integer, primary_key=True, index=True)
-    customer_id = Column(String, unique=True, index=True, default=lambda: f"CUST-{uuid.uuid4().hex[:8].upper()}")
+    customer_id = Column(String, unique=True, index=True, default=lambda: new_public_id("CUST"))
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     name = Column(String)
-    email = Column(String, index=True)
+    email = Column(String, unique=True, index=True)
     phone = Column(String)
     address = Column(Text)
     city = Column(String)
     state = Column(String)
     zip_code = Column(String)
+    stripe_customer_id = Column(String, nullable=True, index=True)  # Resolved once, reused for every checkout
     enrolled_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -77,9 +79,13 @@ class PaymentMethod(Base):
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        Index("ix_transactions_status_updated_at", "status", "updated_at"),
+        {"info": {"sharded": True}},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    transaction_id = Column(String, unique=True, index=True, default=lambda: f"TXN-{uuid.uuid4().hex[:8].upper()}")
+    transaction_id = Column(String, unique=True, index=True, default=lambda: new_public_id("TXN"))
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
     merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=False)
     payment_method_id = Column(Integer, ForeignKey("payment_methods.id"), nullable=True)
@@ -91,6 +97,9 @@ class Transaction(Base):
     payment_provider = Column(String, default="stripe")  # stripe, plaid, etc.
     provider_transaction_id = Column(String)
     template_hash = Column(String, nullable=False)  # SHA-256 hash for verification (not encrypted template)
+    status_checks = Column(Integer, nullable=True)  # Provider status lookups while stuck in processing
+    next_status_check_at = Column(DateTime, nullable=True)
+    stock_reserved = Column(Boolean, nullable=True)  # True while the sale holds inventory, False once put back
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -145,6 +154,10 @@ class Consent(Base):
 
 class Inventory(Base):
     __tablename__ = "inventory"
+    __table_args__ = (
+        Index("ix_inventory_merchant_updated_at", "merchant_id", "updated_at"),
+        {"info": {"sharded": True}},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=False)
@@ -159,3 +172,79 @@ class Inventory(Base):
     
     merchant = relationship("Merchant")
 
+class MerchantShard(Base):
+    """
+    Sharding directory: which shard database holds a merchant's transactions
+    and inventory. Lives in the global database.
+    """
+    __tablename__ = "merchant_shards"
+    
+    merchant_id = Column(Integer, ForeignKey("merchants.id"), primary_key=True)
+    shard = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False, default="active")  # active, moving
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PaymentJob(Base):
+    """
+    Durable queue entry for asynchronous checkout. Lives in the global
+    database; transaction_pk points at the row on the merchant's shard.
+    """
+    __tablename__ = "payment_jobs"
+    __table_args__ = (Index("ix_payment_jobs_status_available", "status", "available_at"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    transaction_pk = Column(Integer, nullable=False)
+    transaction_id = Column(String, unique=True, nullable=False)  # Public TXN- id
+    merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=False)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    provider = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)  # Serialized POSPaymentRequest
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed, abandoned
+    attempts = Column(Integer, nullable=False, default=0)
+    result = Column(JSON, nullable=True)  # Provider status, reference and client secret once processed
+    last_error = Column(Text, nullable=True)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class IdempotencyKey(Base):
+    """
+    Client Idempotency-Key records for transaction creation. Holds the
+    in-flight marker and then the response to replay for duplicates.
+    """
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (UniqueConstraint("merchant_id", "key", name="uq_idempotency_keys_merchant_key"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    merchant_id = Column(Integer, ForeignKey("merchants.id"), nullable=False)
+    key = Column(String, nullable=False)
+    request_hash = Column(String, nullable=False)  # SHA-256 of the request body
+    status = Column(String, nullable=False, default="in_flight")  # in_flight, completed
+    transaction_id = Column(String, nullable=True)
+    response_code = Column(Integer, nullable=True)
+    response_body = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class WebhookEvent(Base):
+    """
+    Provider webhook inbox. Events are stored on receipt (keyed by the
+    provider's event id, so redeliveries are dropped) and applied to
+    transactions in batches by the webhook consumer.
+    """
+    __tablename__ = "webhook_events"
+    __table_args__ = (Index("ix_webhook_events_status_available", "status", "available_at"),)
+    
+    event_id = Column(String, primary_key=True)
+    provider = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    object_id = Column(String, nullable=True)  # Provider payment reference (PaymentIntent id)
+    target_status = Column(String, nullable=True)  # Transaction status the event implies
+    status = Column(String, nullable=False, default="pending")  # pending, applied, unmatched, ignored
+    event_created = Column(DateTime, nullable=True)  # When the provider created the event
+    received_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    applied_at = Column(DateTime, nullable=True)
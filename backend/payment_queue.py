@@ -0,0 +1,432 @@
+"""
+Payment Queue - durable, database-backed queue for asynchronous checkout
+The checkout endpoint persists the transaction, enqueues a job and answers
+202; workers drive the POS middleware and record the outcome.
+
+Workers run inside the API process (PAYMENT_WORKERS) or standalone:
+    PAYMENT_WORKERS=8 python payment_queue.py
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from dataclasses import asdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session
+
+from database import ReadSessionLocal, SessionLocal, init_db, shards
+from models import PaymentJob, Transaction
+from payment_status import remember_provider_customer, settle_after_provider_call
+from pos import (
+    POSAdapterError, POSLineItem, POSPaymentRequest, POSPaymentResult, POSTransientError, pos_middleware
+)
+from pos.clients import close_clients
+
+logger = logging.getLogger(__name__)
+
+ASYNC_CHECKOUT = os.getenv("ASYNC_CHECKOUT", "false").lower() == "true"
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "4"))
+PAYMENT_QUEUE_POLL_INTERVAL = float(os.getenv("PAYMENT_QUEUE_POLL_INTERVAL", "1.0"))
+# A job still claimed after this long belongs to a worker that died mid-payment
+PAYMENT_JOB_TIMEOUT = float(os.getenv("PAYMENT_JOB_TIMEOUT", "120"))
+PAYMENT_JOB_MAX_ATTEMPTS = int(os.getenv("PAYMENT_JOB_MAX_ATTEMPTS", "3"))
+PAYMENT_STATUS_POLL_INTERVAL = float(os.getenv("PAYMENT_STATUS_POLL_INTERVAL", "1.0"))
+PAYMENT_STATUS_MAX_WAIT = 30.0
+
+PENDING_STATUSES = {"pending", "processing"}
+
+
+def wants_async(prefer_header: Optional[str]) -> bool:
+    """Async checkout when the client sends `Prefer: respond-async` or it is the default"""
+    if prefer_header:
+        preferences = {p.strip().lower() for p in prefer_header.split(",")}
+        if "respond-async" in preferences:
+            return True
+        if "wait" in {p.split("=")[0] for p in preferences}:
+            return False
+    return ASYNC_CHECKOUT
+
+
+def serialize_request(request: POSPaymentRequest) -> Dict:
+    return asdict(request)
+
+
+def deserialize_request(payload: Dict) -> POSPaymentRequest:
+    values = dict(payload)
+    values["items"] = [POSLineItem(**item) for item in values.get("items", [])]
+    return POSPaymentRequest(**values)
+
+
+def enqueue_payment(
+    db: Session,
+    transaction_pk: int,
+    transaction_id: str,
+    merchant_pk: int,
+    customer_pk: int,
+    provider: str,
+    request: POSPaymentRequest
+) -> None:
+    """Add a payment job; it becomes visible to workers when the caller commits"""
+    db.execute(
+        insert(PaymentJob).values(
+            transaction_pk=transaction_pk,
+            transaction_id=transaction_id,
+            merchant_id=merchant_pk,
+            customer_id=customer_pk,
+            provider=provider,
+            payload=serialize_request(request),
+            status="queued",
+            available_at=datetime.utcnow(),
+        )
+    )
+
+
+class StatusNotifier:
+    """In-process wakeups for status streams; other processes fall back to polling"""
+
+    def __init__(self):
+        self._events: Dict[str, asyncio.Event] = {}
+        self._waiters: Dict[str, int] = {}
+
+    def publish(self, transaction_id: str) -> None:
+        event = self._events.get(transaction_id)
+        if event is not None:
+            event.set()
+
+    async def wait(self, transaction_id: str, timeout: float) -> None:
+        event = self._events.setdefault(transaction_id, asyncio.Event())
+        self._waiters[transaction_id] = self._waiters.get(transaction_id, 0) + 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiters[transaction_id] -= 1
+            if not self._waiters[transaction_id]:
+                del self._waiters[transaction_id]
+                del self._events[transaction_id]
+
+
+def read_status(merchant_pk: int, transaction_id: str) -> Optional[Dict]:
+    """Current status of a merchant's transaction, with the async job result when there is one"""
+    with ReadSessionLocal() as db:
+        with shards.merchant_session(merchant_pk, db) as merchant_db:
+            transaction = merchant_db.execute(
+                select(
+                    Transaction.transaction_id, Transaction.status, Transaction.payment_provider,
+                    Transaction.provider_transaction_id, Transaction.updated_at
+                ).where(Transaction.transaction_id == transaction_id, Transaction.merchant_id == merchant_pk)
+            ).first()
+        if transaction is None:
+            return None
+        job = db.execute(
+            select(PaymentJob.status, PaymentJob.result, PaymentJob.last_error)
+            .where(PaymentJob.transaction_id == transaction_id)
+        ).first()
+
+    status = dict(transaction._mapping)
+    status["updated_at"] = status["updated_at"].isoformat() if status["updated_at"] else None
+    if job is not None:
+        status["queue_status"] = job.status
+        status["client_secret"] = (job.result or {}).get("client_secret")
+        status["error"] = job.last_error
+    return status
+
+
+class PaymentQueue:
+    """Worker pool draining payment_jobs through the POS middleware"""
+
+    def __init__(self, workers: int = PAYMENT_WORKERS, poll_interval: float = PAYMENT_QUEUE_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.notifier = StatusNotifier()
+        self.node = f"{socket.gethostname()}:{os.getpid()}"
+        self.counters = {
+            "completed": 0,
+            "failed": 0,
+            "abandoned": 0,
+            "requeued": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "processing_seconds_total": 0.0,
+        }
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_sweep = 0.0
+
+    def notify(self) -> None:
+        """Wake idle local workers after a commit that enqueued jobs"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        if self._tasks or self.workers <= 0:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._run_worker(f"{self.node}/{index}"))
+            for index in range(self.workers)
+        ]
+        logger.info("Started %d payment workers", self.workers)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run_worker(self, worker_id: str) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                processed = await self.run_once(worker_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Payment worker %s failed", worker_id)
+                processed = False
+            if not processed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _claim(self, worker_id: str) -> Optional[PaymentJob]:
+        """
+        Claim the next ready job. Runs in a worker thread; idle polls only
+        read, so they never wait for (or hold) SQLite's single writer.
+        """
+        now = datetime.utcnow()
+        if time.monotonic() - self._last_sweep > self.poll_interval:
+            self._last_sweep = time.monotonic()
+            self._sweep_abandoned(now)
+        with ReadSessionLocal() as db:
+            ready = db.execute(
+                select(PaymentJob.id)
+                .where(PaymentJob.status == "queued", PaymentJob.available_at <= now)
+                .limit(1)
+            ).first()
+        if ready is None:
+            return None
+        with SessionLocal() as db:
+            # FOR UPDATE SKIP LOCKED lets Postgres workers claim concurrently;
+            # SQLite drops the clause and serializes claims on its single writer
+            next_job = (
+                select(PaymentJob.id)
+                .where(PaymentJob.status == "queued", PaymentJob.available_at <= now)
+                .order_by(PaymentJob.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+            job = db.execute(
+                update(PaymentJob)
+                .where(PaymentJob.id == next_job, PaymentJob.status == "queued")
+                .values(
+                    status="running",
+                    locked_by=worker_id,
+                    locked_at=now,
+                    attempts=PaymentJob.attempts + 1,
+                    updated_at=now,
+                )
+                .returning(
+                    PaymentJob.id, PaymentJob.transaction_pk, PaymentJob.transaction_id,
+                    PaymentJob.merchant_id, PaymentJob.customer_id, PaymentJob.provider,
+                    PaymentJob.payload, PaymentJob.attempts, PaymentJob.created_at
+                )
+                .execution_options(synchronize_session=False)
+            ).first()
+            db.commit()
+        return job
+
+    def _sweep_abandoned(self, now: datetime) -> None:
+        """
+        Requeue jobs whose worker died mid-payment. The provider call may
+        already have gone through, so only jobs carrying a provider
+        idempotency key are retried; the rest are abandoned and the
+        transaction stays 'processing' until its provider status is reconciled.
+        """
+        cutoff = now - timedelta(seconds=PAYMENT_JOB_TIMEOUT)
+        with ReadSessionLocal() as db:
+            stale = db.execute(
+                select(PaymentJob.id, PaymentJob.transaction_id, PaymentJob.attempts, PaymentJob.payload)
+                .where(PaymentJob.status == "running", PaymentJob.locked_at < cutoff)
+            ).all()
+        if not stale:
+            return
+        abandoned = []
+        with SessionLocal() as db:
+            for job in stale:
+                retry = job.attempts < PAYMENT_JOB_MAX_ATTEMPTS and bool(job.payload.get("idempotency_key"))
+                db.execute(
+                    update(PaymentJob)
+                    .where(PaymentJob.id == job.id, PaymentJob.status == "running", PaymentJob.locked_at < cutoff)
+                    .values(
+                        status="queued" if retry else "abandoned",
+                        locked_by=None,
+                        available_at=now,
+                        last_error="Worker stopped before recording the outcome",
+                        updated_at=now,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                self.counters["requeued" if retry else "abandoned"] += 1
+                if not retry:
+                    abandoned.append(job.transaction_id)
+            db.commit()
+        if abandoned:
+            logger.warning("Abandoned %d payment jobs: %s", len(abandoned), ", ".join(abandoned))
+
+    async def run_once(self, worker_id: str) -> bool:
+        """Claim and process one job; returns False when the queue is empty"""
+        # Database work runs in threads: a wait for the writer must not stall the event loop
+        job = await asyncio.to_thread(self._claim, worker_id)
+        if job is None:
+            return False
+
+        waited = (datetime.utcnow() - job.created_at).total_seconds()
+        self.counters["wait_seconds_total"] += waited
+        self.counters["wait_seconds_max"] = max(self.counters["wait_seconds_max"], waited)
+
+        request = deserialize_request(job.payload)
+        started = time.perf_counter()
+        result: Optional[POSPaymentResult] = None
+        error = None
+        try:
+            result = await pos_middleware.process_payment(job.provider, request)
+        except POSTransientError as exc:
+            if job.attempts < PAYMENT_JOB_MAX_ATTEMPTS and (request.idempotency_key or not exc.request_sent):
+                self.counters["processing_seconds_total"] += time.perf_counter() - started
+                await asyncio.to_thread(self._retry_later, job, exc)
+                return True
+            error = f"Payment provider '{job.provider}' unavailable: {exc}"
+        except POSAdapterError as exc:
+            error = f"Payment processing failed via '{job.provider}': {exc}"
+        except Exception as exc:
+            error = f"Unexpected payment processing error: {exc}"
+        self.counters["processing_seconds_total"] += time.perf_counter() - started
+
+        await self._record(job, request, result, error)
+        self.counters["completed" if result is not None else "failed"] += 1
+        self.notifier.publish(job.transaction_id)
+        return True
+
+    def _retry_later(self, job, exc: POSTransientError) -> None:
+        """Provider unavailable: put the job back with backoff, honouring an open breaker"""
+        delay = max(getattr(exc, "retry_after", 0.0), min(60.0, 2.0 ** job.attempts))
+        with SessionLocal() as db:
+            db.execute(
+                update(PaymentJob)
+                .where(PaymentJob.id == job.id)
+                .values(
+                    status="queued",
+                    locked_by=None,
+                    available_at=datetime.utcnow() + timedelta(seconds=delay),
+                    last_error=str(exc),
+                    updated_at=datetime.utcnow(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+        self.counters["requeued"] += 1
+
+    async def _record(self, job, request: POSPaymentRequest, result: Optional[POSPaymentResult], error: Optional[str]):
+        # The payment already happened; during a shard move this waits for it to finish
+        status = await settle_after_provider_call(job.merchant_id, job.transaction_pk, job.provider, result)
+        await asyncio.to_thread(self._finish, job, request, result, error, status)
+
+    def _finish(
+        self, job, request: POSPaymentRequest, result: Optional[POSPaymentResult], error: Optional[str], status: str
+    ) -> None:
+        with SessionLocal() as db:
+            if result is not None:
+                remember_provider_customer(db, job.customer_id, job.provider, request, result)
+            db.execute(
+                update(PaymentJob)
+                .where(PaymentJob.id == job.id)
+                .values(
+                    status="done" if result is not None else "failed",
+                    result={
+                        "status": status,
+                        "provider_transaction_id": result.transaction_reference if result else None,
+                        "client_secret": result.client_secret if result else None,
+                    },
+                    last_error=error,
+                    locked_by=None,
+                    updated_at=datetime.utcnow(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+
+    async def watch(self, merchant_pk: int, transaction_id: str, timeout: float):
+        """
+        Yield the transaction status now and after every change until it
+        settles or the timeout passes.
+        """
+        deadline = time.monotonic() + timeout
+        previous = ...
+        while True:
+            status = read_status(merchant_pk, transaction_id)
+            if status != previous:
+                yield status
+                previous = status
+            if status is None or status["status"] not in PENDING_STATUSES:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await self.notifier.wait(transaction_id, min(remaining, PAYMENT_STATUS_POLL_INTERVAL))
+
+    def metrics(self) -> Dict:
+        """Queue depth and age from the database plus this process's worker counters"""
+        now = datetime.utcnow()
+        with ReadSessionLocal() as db:
+            depth = dict(
+                db.execute(
+                    select(PaymentJob.status, func.count())
+                    .where(PaymentJob.status.in_(["queued", "running"]))
+                    .group_by(PaymentJob.status)
+                ).all()
+            )
+            oldest = db.execute(
+                select(func.min(PaymentJob.created_at)).where(PaymentJob.status == "queued")
+            ).scalar()
+        processed = self.counters["completed"] + self.counters["failed"]
+        return {
+            "queued": depth.get("queued", 0),
+            "running": depth.get("running", 0),
+            "oldest_queued_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+            "workers": len(self._tasks),
+            "completed": self.counters["completed"],
+            "failed": self.counters["failed"],
+            "abandoned": self.counters["abandoned"],
+            "requeued": self.counters["requeued"],
+            "avg_wait_seconds": round(self.counters["wait_seconds_total"] / processed, 3) if processed else 0.0,
+            "max_wait_seconds": round(self.counters["wait_seconds_max"], 3),
+            "avg_processing_seconds": (
+                round(self.counters["processing_seconds_total"] / processed, 3) if processed else 0.0
+            ),
+        }
+
+
+payment_queue = PaymentQueue()
+
+
+async def _serve_forever() -> None:
+    init_db()
+    await payment_queue.start()
+    try:
+        await asyncio.gather(*payment_queue._tasks)
+    finally:
+        await payment_queue.stop()
+        await close_clients()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve_forever())
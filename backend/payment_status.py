@@ -0,0 +1,189 @@
+"""
+Payment Status - shared handling of provider payment outcomes
+Used by synchronous checkout, the payment queue workers, the webhook
+inbox and reconciliation
+"""
+import asyncio
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import String, column, literal, select, union_all, update, values
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, ShardMovingError, shards
+from models import Customer, Transaction
+from pos import POSPaymentRequest, POSPaymentResult
+from stock import RELEASED_STATUSES, release_stock, retake_stock
+
+
+def map_provider_status(status: Optional[str]) -> str:
+    if not status:
+        return "processing"
+    normalized = status.lower()
+    if normalized in {"succeeded", "paid", "completed", "captured"}:
+        return "completed"
+    if normalized in {"processing", "pending", "requires_action", "requires_payment_method"}:
+        return "processing"
+    if normalized in {"canceled", "cancelled"}:
+        return "cancelled"
+    if normalized in {"failed", "declined", "refused"}:
+        return "failed"
+    return "processing"
+
+
+# Final states a provider event may not move a transaction out of
+FINAL_STATUSES = ("completed", "cancelled")
+
+# SQLite caps compound SELECTs at 500 terms
+SQLITE_VALUES_CHUNK = 400
+
+
+def _batches(session: Session, rows: List[Tuple], names: Sequence[str]) -> Iterator:
+    """
+    Split rows into VALUES relations named `incoming` with the given string
+    columns. SQLite has no column list on a VALUES alias, so UNION ALL
+    builds the same relation there.
+    """
+    sqlite = session.get_bind().dialect.name == "sqlite"
+    chunk = SQLITE_VALUES_CHUNK if sqlite else max(len(rows), 1)
+    for offset in range(0, len(rows), chunk):
+        batch = rows[offset:offset + chunk]
+        if sqlite:
+            yield union_all(*[
+                select(*[literal(value, String).label(name) for name, value in zip(names, row)])
+                for row in batch
+            ]).subquery("incoming")
+        else:
+            yield values(*[column(name, String) for name in names], name="incoming").data(batch)
+
+
+def apply_status_updates(session: Session, updates: Dict[str, str]) -> int:
+    """
+    Apply provider_transaction_id -> status transitions with one
+    UPDATE ... FROM (VALUES ...) per batch; returns the rows changed.
+    Completed and cancelled transactions are never moved; inventory held by
+    the sales follows the new status.
+    """
+    changed = 0
+    for incoming in _batches(session, list(updates.items()), ("provider_transaction_id", "status")):
+        changed += session.execute(
+            update(Transaction)
+            .where(
+                Transaction.provider_transaction_id == incoming.c.provider_transaction_id,
+                Transaction.status != incoming.c.status,
+                Transaction.status.notin_(FINAL_STATUSES)
+            )
+            .values(status=incoming.c.status, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    released = [reference for reference, status in updates.items() if status in RELEASED_STATUSES]
+    if changed and released:
+        release_stock(session, Transaction.provider_transaction_id.in_(released))
+    completed = [reference for reference, status in updates.items() if status == "completed"]
+    if changed and completed:
+        retake_stock(session, Transaction.provider_transaction_id.in_(completed))
+    return changed
+
+
+def link_provider_references(session: Session, links: Dict[str, Tuple[str, str]]) -> int:
+    """
+    Record provider references for transactions that never got one (the
+    process died between the provider call and the commit).
+    `links` maps transaction_id -> (provider_transaction_id, status).
+    """
+    rows = [(transaction_id, reference, status) for transaction_id, (reference, status) in links.items()]
+    changed = 0
+    for incoming in _batches(session, rows, ("transaction_id", "provider_transaction_id", "status")):
+        changed += session.execute(
+            update(Transaction)
+            .where(
+                Transaction.transaction_id == incoming.c.transaction_id,
+                Transaction.provider_transaction_id.is_(None)
+            )
+            .values(
+                provider_transaction_id=incoming.c.provider_transaction_id,
+                status=incoming.c.status,
+                updated_at=datetime.utcnow()
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    released = [transaction_id for transaction_id, _, status in rows if status in RELEASED_STATUSES]
+    if changed and released:
+        release_stock(session, Transaction.transaction_id.in_(released))
+    return changed
+
+
+def settle_transaction(
+    merchant_db: Session,
+    transaction_pk: int,
+    provider: str,
+    result: Optional[POSPaymentResult] = None
+) -> str:
+    """Record a provider outcome on the transaction; no result means the call failed"""
+    if result is None:
+        values = {"status": "failed"}
+    else:
+        values = {
+            "payment_provider": provider,
+            "provider_transaction_id": result.transaction_reference,
+            "status": map_provider_status(result.status),
+        }
+    merchant_db.execute(
+        update(Transaction)
+        .where(Transaction.id == transaction_pk)
+        .values(updated_at=datetime.utcnow(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    if values["status"] in RELEASED_STATUSES:
+        release_stock(merchant_db, Transaction.id == transaction_pk)
+    merchant_db.commit()
+    return values["status"]
+
+
+def _settle_on_current_shard(
+    merchant_pk: int, transaction_pk: int, provider: str, result: Optional[POSPaymentResult]
+) -> str:
+    with SessionLocal() as db:
+        with shards.merchant_session(merchant_pk, db, for_write=True) as merchant_db:
+            return settle_transaction(merchant_db, transaction_pk, provider, result)
+
+
+async def settle_after_provider_call(
+    merchant_pk: int,
+    transaction_pk: int,
+    provider: str,
+    result: Optional[POSPaymentResult] = None
+) -> str:
+    """
+    settle_transaction on the shard that holds the merchant now, off the
+    event loop. A session resolved before the provider call may point at a
+    shard the merchant has since moved away from, so the shard is looked up
+    again; while a move is running the write waits for it to finish.
+    """
+    while True:
+        try:
+            return await asyncio.to_thread(_settle_on_current_shard, merchant_pk, transaction_pk, provider, result)
+        except ShardMovingError:
+            await asyncio.sleep(1)
+
+
+def remember_provider_customer(
+    db: Session,
+    customer_pk: int,
+    provider: str,
+    request: POSPaymentRequest,
+    result: POSPaymentResult
+) -> None:
+    """
+    First Stripe checkout for this customer: persist the mapping so later
+    checkouts skip the customer search entirely
+    """
+    if provider != "stripe" or not result.provider_customer_id or request.provider_customer_id:
+        return
+    db.execute(
+        update(Customer)
+        .where(Customer.id == customer_pk, Customer.stripe_customer_id.is_(None))
+        .values(stripe_customer_id=result.provider_customer_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
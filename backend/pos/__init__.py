@@ -3,19 +3,27 @@
 from .base import (
     POSAdapter,
     POSAdapterError,
+    POSCircuitOpenError,
     POSLineItem,
+    POSOverloadedError,
+    POSPaymentRecord,
     POSPaymentRequest,
     POSPaymentResult,
+    POSTransientError,
 )
 from .middleware import POSMiddleware, pos_middleware
 
 __all__ = [
     "POSAdapter",
     "POSAdapterError",
+    "POSCircuitOpenError",
     "POSLineItem",
     "POSMiddleware",
+    "POSOverloadedError",
+    "POSPaymentRecord",
     "POSPaymentRequest",
     "POSPaymentResult",
+    "POSTransientError",
     "pos_middleware",
 ]
 
@@ -1,8 +1,14 @@
 """POS adapter implementations."""
 
-from .stripe_adapter import StripePOSAdapter
-from .square_adapter import SquarePOSAdapter
+from importlib import import_module
 
 __all__ = ["StripePOSAdapter", "SquarePOSAdapter"]
 
+_MODULES = {"StripePOSAdapter": ".stripe_adapter", "SquarePOSAdapter": ".square_adapter"}
 
+
+def __getattr__(name: str):
+    # Loaded on access so importing one adapter doesn't import every provider SDK
+    if name in _MODULES:
+        return getattr(import_module(_MODULES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
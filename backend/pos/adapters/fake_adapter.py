@@ -0,0 +1,140 @@
+"""Local fake provider for exercising breakers, retries and load without a real account."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from ..base import (
+    POSAdapter, POSAdapterError, POSPaymentRecord, POSPaymentRequest, POSPaymentResult, POSTransientError
+)
+
+
+class FakePOSAdapter(POSAdapter):
+    """
+    In-process provider with configurable latency, outage, timeout and
+    decline rates. Charges are idempotent per idempotency key, like the real
+    providers, so retry behaviour can be checked by counting `charges`.
+    """
+
+    name = "fake"
+
+    def __init__(self, config: Dict[str, object] | None = None) -> None:
+        default_config = {
+            "latency_ms": float(os.getenv("POS_FAKE_LATENCY_MS", "50")),
+            "jitter_ms": float(os.getenv("POS_FAKE_JITTER_MS", "20")),
+            "error_rate": float(os.getenv("POS_FAKE_ERROR_RATE", "0")),
+            "timeout_rate": float(os.getenv("POS_FAKE_TIMEOUT_RATE", "0")),
+            "timeout_ms": float(os.getenv("POS_FAKE_TIMEOUT_MS", "1000")),
+            "decline_rate": float(os.getenv("POS_FAKE_DECLINE_RATE", "0")),
+        }
+        super().__init__({**default_config, **(config or {})})
+        self._random = random.Random(os.getenv("POS_FAKE_SEED"))
+        self._results: Dict[str, Dict[str, object]] = {}
+        self.payments: Dict[str, POSPaymentRecord] = {}
+        self.charges = 0
+        self.calls = 0
+
+    def configure(self, **overrides: float) -> None:
+        """Change behaviour at runtime, e.g. `configure(error_rate=1.0)` for an outage."""
+        self.config.update(overrides)
+
+    def prepare_payload(self, request: POSPaymentRequest) -> Dict[str, object]:
+        return {
+            "amount": request.total,
+            "currency": request.currency,
+            "idempotency_key": request.idempotency_key,
+            "reference": request.metadata.get("transaction_id"),
+        }
+
+    def _delay(self) -> float:
+        jitter = self._random.uniform(-1, 1) * float(self.config["jitter_ms"])
+        return max(0.0, float(self.config["latency_ms"]) + jitter) / 1000
+
+    def _roll(self) -> str:
+        """Pick the fate of one call: 'error', 'timeout' or 'ok'."""
+        self.calls += 1
+        roll = self._random.random()
+        if roll < float(self.config["error_rate"]):
+            return "error"
+        if roll < float(self.config["error_rate"]) + float(self.config["timeout_rate"]):
+            return "timeout"
+        return "ok"
+
+    def _charge(self, payload: Dict[str, object]) -> Dict[str, object]:
+        key = payload.get("idempotency_key")
+        if key and key in self._results:
+            return self._results[key]
+
+        self.charges += 1
+        if self._random.random() < float(self.config["decline_rate"]):
+            raise POSAdapterError("Fake provider declined the card")
+        response = {"id": f"fake_{self.charges}", "status": "succeeded", "amount": payload["amount"]}
+        if key:
+            self._results[key] = response
+        self.payments[response["id"]] = POSPaymentRecord(
+            transaction_reference=response["id"],
+            status="succeeded",
+            created_at=datetime.utcnow(),
+            amount=payload["amount"],
+            transaction_id=payload.get("reference"),
+        )
+        return response
+
+    def send_payment(self, payload: Dict[str, object]) -> Dict[str, object]:
+        time.sleep(self._delay())
+        fate = self._roll()
+        if fate == "error":
+            raise POSTransientError("Fake provider unavailable (503)")
+        if fate == "timeout":
+            time.sleep(float(self.config["timeout_ms"]) / 1000)
+            raise POSTransientError("Fake provider timed out")
+        return self._charge(payload)
+
+    async def asend_payment(self, payload: Dict[str, object]) -> Dict[str, object]:
+        await asyncio.sleep(self._delay())
+        fate = self._roll()
+        if fate == "error":
+            raise POSTransientError("Fake provider unavailable (503)")
+        if fate == "timeout":
+            await asyncio.sleep(float(self.config["timeout_ms"]) / 1000)
+            raise POSTransientError("Fake provider timed out")
+        return self._charge(payload)
+
+    def parse_response(self, response: Dict[str, object]) -> POSPaymentResult:
+        return POSPaymentResult(
+            status=str(response.get("status", "processing")),
+            transaction_reference=str(response.get("id")) if response.get("id") else None,
+            raw_response=response,
+        )
+
+    def list_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None, page_size: int = 100
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        matching = [p for p in self.payments.values() if start <= p.created_at < end]
+        offset = int(cursor or 0)
+        page = matching[offset:offset + page_size]
+        return page, (str(offset + page_size) if offset + page_size < len(matching) else None)
+
+    async def alist_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        await asyncio.sleep(self._delay())
+        if self._roll() == "error":
+            raise POSTransientError("Fake provider unavailable (503)")
+        return self.list_payments(start, end, cursor)
+
+    def retrieve_payment(self, reference: str) -> POSPaymentRecord:
+        if reference not in self.payments:
+            raise POSAdapterError(f"Fake provider has no payment {reference}")
+        return self.payments[reference]
+
+    async def aretrieve_payment(self, reference: str) -> POSPaymentRecord:
+        await asyncio.sleep(self._delay())
+        if self._roll() == "error":
+            raise POSTransientError("Fake provider unavailable (503)")
+        return self.retrieve_payment(reference)
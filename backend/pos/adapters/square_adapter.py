@@ -3,11 +3,16 @@
 from __future__ import annotations
 
 import os
-from typing import Dict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 
+import httpx
 import requests
 
-from ..base import POSAdapter, POSAdapterError, POSPaymentRequest, POSPaymentResult
+from ..base import (
+    POSAdapter, POSAdapterError, POSPaymentRecord, POSPaymentRequest, POSPaymentResult, POSTransientError
+)
+from ..clients import get_async_client, get_sync_session, sync_timeout
 
 
 class SquarePOSAdapter(POSAdapter):
@@ -19,7 +24,7 @@ class SquarePOSAdapter(POSAdapter):
         default_config = {
             "access_token": os.getenv("SQUARE_ACCESS_TOKEN"),
             "location_id": os.getenv("SQUARE_LOCATION_ID"),
-            "api_base": "https://connect.squareupsandbox.com",
+            "api_base": os.getenv("SQUARE_API_BASE", "https://connect.squareupsandbox.com"),
         }
         merged = {**default_config, **(config or {})}
         self._configured = False
@@ -51,7 +56,7 @@ class SquarePOSAdapter(POSAdapter):
         ]
 
         return {
-            "idempotency_key": request.metadata.get("transaction_id"),
+            "idempotency_key": request.idempotency_key or request.metadata.get("transaction_id"),
             "source_id": request.payment_method_token,
             "amount_money": {
                 "amount": int(request.total * 100),
@@ -59,34 +64,60 @@ class SquarePOSAdapter(POSAdapter):
             },
             "autocomplete": True,
             "customer_id": request.metadata.get("square_customer_id"),
+            "reference_id": request.metadata.get("transaction_id"),
             "line_items": line_items,
         }
 
-    def send_payment(self, payload: Dict[str, object]) -> Dict[str, object]:
+    def _headers(self) -> Dict[str, str]:
         if not self._configured:
             raise POSAdapterError(
                 "Square adapter is not configured. Update environment variables to enable it."
             )
-
-        headers = {
+        return {
             "Square-Version": "2023-12-13",
             "Authorization": f"Bearer {self.config['access_token']}",
             "Content-Type": "application/json",
         }
 
-        response = requests.post(
-            f"{self.config['api_base']}/v2/payments",
-            json=payload,
-            headers=headers,
-            timeout=30,
-        )
-
-        if response.status_code >= 400:
-            raise POSAdapterError(
-                f"Square payment error ({response.status_code}): {response.text}"
+    def send_payment(self, payload: Dict[str, object]) -> Dict[str, object]:
+        headers = self._headers()
+        try:
+            response = get_sync_session(self.name).post(
+                f"{self.config['api_base']}/v2/payments",
+                json=payload,
+                headers=headers,
+                timeout=sync_timeout(),
             )
-
-        return response.json()
+        except requests.ConnectTimeout as exc:
+            raise POSTransientError(f"Square request failed: {exc}", request_sent=False) from exc
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            raise POSTransientError(f"Square request failed: {exc}") from exc
+        except requests.RequestException as exc:
+            raise POSAdapterError(f"Square request failed: {exc}") from exc
+
+        return self._check_response(response.status_code, response.text, response.json)
+
+    async def asend_payment(self, payload: Dict[str, object]) -> Dict[str, object]:
+        headers = self._headers()
+        client = get_async_client(self.name, self.config["api_base"])
+        try:
+            response = await client.post("/v2/payments", json=payload, headers=headers)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as exc:
+            raise POSTransientError(f"Square request failed: {exc}", request_sent=False) from exc
+        except httpx.TransportError as exc:
+            raise POSTransientError(f"Square request failed: {exc}") from exc
+        except httpx.HTTPError as exc:
+            raise POSAdapterError(f"Square request failed: {exc}") from exc
+
+        return self._check_response(response.status_code, response.text, response.json)
+
+    @staticmethod
+    def _check_response(status_code: int, text: str, load_json) -> Dict[str, object]:
+        if status_code == 429 or status_code >= 500:
+            raise POSTransientError(f"Square unavailable ({status_code}): {text}")
+        if status_code >= 400:
+            raise POSAdapterError(f"Square payment error ({status_code}): {text}")
+        return load_json()
 
     def parse_response(self, response: Dict[str, object]) -> POSPaymentResult:
         payment = response.get("payment", {})
@@ -97,4 +128,87 @@ class SquarePOSAdapter(POSAdapter):
             raw_response=response,
         )
 
+    def _list_params(self, start: datetime, end: datetime, cursor: Optional[str]) -> Dict[str, object]:
+        params = {
+            "begin_time": start.replace(tzinfo=timezone.utc).isoformat(),
+            "end_time": end.replace(tzinfo=timezone.utc).isoformat(),
+            "location_id": self.config.get("location_id"),
+            "limit": 100,
+        }
+        if cursor:
+            params["cursor"] = cursor
+        return params
+
+    @staticmethod
+    def _record(payment: Dict[str, object]) -> POSPaymentRecord:
+        return POSPaymentRecord(
+            transaction_reference=payment["id"],
+            status=payment.get("status", "PENDING"),
+            created_at=datetime.fromisoformat(payment["created_at"]).astimezone(timezone.utc).replace(tzinfo=None),
+            amount=payment.get("amount_money", {}).get("amount", 0) / 100,
+            transaction_id=payment.get("reference_id"),
+        )
 
+    @classmethod
+    def _parse_page(cls, response: Dict[str, object]) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        return [cls._record(payment) for payment in response.get("payments", [])], response.get("cursor")
+
+    def list_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        headers = self._headers()
+        try:
+            response = get_sync_session(self.name).get(
+                f"{self.config['api_base']}/v2/payments",
+                params=self._list_params(start, end, cursor),
+                headers=headers,
+                timeout=sync_timeout(),
+            )
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            raise POSTransientError(f"Square request failed: {exc}", request_sent=False) from exc
+        except requests.RequestException as exc:
+            raise POSAdapterError(f"Square request failed: {exc}") from exc
+
+        return self._parse_page(self._check_response(response.status_code, response.text, response.json))
+
+    async def alist_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        headers = self._headers()
+        client = get_async_client(self.name, self.config["api_base"])
+        try:
+            response = await client.get("/v2/payments", params=self._list_params(start, end, cursor), headers=headers)
+        except httpx.TransportError as exc:
+            # Listing has no side effects, so every transport failure is retryable
+            raise POSTransientError(f"Square request failed: {exc}", request_sent=False) from exc
+        except httpx.HTTPError as exc:
+            raise POSAdapterError(f"Square request failed: {exc}") from exc
+
+        return self._parse_page(self._check_response(response.status_code, response.text, response.json))
+
+    def retrieve_payment(self, reference: str) -> POSPaymentRecord:
+        headers = self._headers()
+        try:
+            response = get_sync_session(self.name).get(
+                f"{self.config['api_base']}/v2/payments/{reference}",
+                headers=headers,
+                timeout=sync_timeout(),
+            )
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            raise POSTransientError(f"Square request failed: {exc}", request_sent=False) from exc
+        except requests.RequestException as exc:
+            raise POSAdapterError(f"Square request failed: {exc}") from exc
+
+        return self._record(self._check_response(response.status_code, response.text, response.json)["payment"])
+
+    async def aretrieve_payment(self, reference: str) -> POSPaymentRecord:
+        headers = self._headers()
+        client = get_async_client(self.name, self.config["api_base"])
+        try:
+            response = await client.get(f"/v2/payments/{reference}", headers=headers)
+        except httpx.TransportError as exc:
+            raise POSTransientError(f"Square request failed: {exc}", request_sent=False) from exc
+        except httpx.HTTPError as exc:
+            raise POSAdapterError(f"Square request failed: {exc}") from exc
+
+        return self._record(self._check_response(response.status_code, response.text, response.json)["payment"])
@@ -3,16 +3,22 @@
 from __future__ import annotations
 
 import os
-from typing import Dict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 
-from ..base import POSAdapter, POSAdapterError, POSPaymentRequest, POSPaymentResult
-from ...stripe_service import (
-    confirm_payment_intent,
-    create_or_retrieve_customer,
-    create_payment_intent,
+import stripe_service
+
+from ..base import (
+    POSAdapter, POSAdapterError, POSPaymentRecord, POSPaymentRequest, POSPaymentResult, POSTransientError
 )
 
 
+def _adapter_error(exc: ValueError) -> POSAdapterError:
+    if isinstance(exc, stripe_service.StripeTransientError):
+        return POSTransientError(str(exc), request_sent=exc.request_sent)
+    return POSAdapterError(str(exc))
+
+
 class StripePOSAdapter(POSAdapter):
     name = "stripe"
 
@@ -38,43 +44,51 @@ class StripePOSAdapter(POSAdapter):
             "currency": request.currency,
             "customer_email": request.customer_email,
             "customer_name": request.customer_name,
+            "customer_reference": request.customer_reference,
+            "stripe_customer_id": request.provider_customer_id,
+            "idempotency_key": request.idempotency_key,
             "payment_method_id": request.payment_method_token,
             "metadata": metadata,
         }
 
     def send_payment(self, payload: Dict[str, object]) -> Dict[str, object]:
         try:
-            customer_id = create_or_retrieve_customer(
+            customer_id = stripe_service.resolve_customer_id(
+                customer_reference=payload.get("customer_reference"),
                 email=payload.get("customer_email") or "anonymous@protega.cloud",
                 name=payload.get("customer_name"),
+                stored_id=payload.get("stripe_customer_id"),
             )
         except ValueError as exc:  # pragma: no cover - direct Stripe errors
-            raise POSAdapterError(str(exc)) from exc
+            raise _adapter_error(exc) from exc
 
         metadata = dict(payload.get("metadata", {}))
         metadata.setdefault("stripe_customer_id", customer_id)
+        idempotency_key = payload.get("idempotency_key")
 
         try:
-            payment_intent = create_payment_intent(
+            payment_intent = stripe_service.create_payment_intent(
                 amount=payload["amount"],
                 currency=payload.get("currency", "usd"),
                 customer_email=payload.get("customer_email"),
                 payment_method_id=payload.get("payment_method_id"),
                 metadata=metadata,
+                idempotency_key=f"{idempotency_key}-create" if idempotency_key else None,
             )
         except ValueError as exc:  # pragma: no cover
-            raise POSAdapterError(str(exc)) from exc
+            raise _adapter_error(exc) from exc
 
         payment_method_id = payload.get("payment_method_id")
         if payment_method_id:
             try:
-                confirmation = confirm_payment_intent(
+                confirmation = stripe_service.confirm_payment_intent(
                     payment_intent_id=payment_intent["id"],
                     payment_method_id=payment_method_id,
+                    idempotency_key=f"{idempotency_key}-confirm" if idempotency_key else None,
                 )
                 payment_intent["status"] = confirmation.get("status", payment_intent["status"])
             except ValueError as exc:  # pragma: no cover
-                raise POSAdapterError(str(exc)) from exc
+                raise _adapter_error(exc) from exc
 
         payment_intent["stripe_customer_id"] = customer_id
         return payment_intent
@@ -84,7 +98,42 @@ class StripePOSAdapter(POSAdapter):
             status=str(response.get("status", "processing")),
             transaction_reference=str(response.get("id")) if response.get("id") else None,
             client_secret=response.get("client_secret"),
+            provider_customer_id=response.get("stripe_customer_id"),
             raw_response=response,
         )
 
+    def list_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        try:
+            intents, has_more = stripe_service.list_payment_intents(
+                created_gte=int(start.replace(tzinfo=timezone.utc).timestamp()),
+                created_lt=int(end.replace(tzinfo=timezone.utc).timestamp()),
+                starting_after=cursor,
+            )
+        except ValueError as exc:
+            raise _adapter_error(exc) from exc
+        records = [
+            POSPaymentRecord(
+                transaction_reference=intent["id"],
+                status=intent["status"],
+                created_at=datetime.utcfromtimestamp(intent["created"]),
+                amount=intent["amount"],
+                transaction_id=intent["transaction_id"],
+            )
+            for intent in intents
+        ]
+        return records, (records[-1].transaction_reference if has_more and records else None)
 
+    def retrieve_payment(self, reference: str) -> POSPaymentRecord:
+        try:
+            intent = stripe_service.retrieve_payment_intent(reference)
+        except ValueError as exc:
+            raise _adapter_error(exc) from exc
+        return POSPaymentRecord(
+            transaction_reference=intent["id"],
+            status=intent["status"],
+            created_at=datetime.utcfromtimestamp(intent["created"]),
+            amount=intent["amount"],
+            transaction_id=intent["transaction_id"],
+        )
@@ -4,13 +4,44 @@ from __future__ import annotations
 
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .clients import run_blocking
 
 
 class POSAdapterError(Exception):
     """Raised when a POS adapter fails to process a request."""
 
 
+class POSTransientError(POSAdapterError):
+    """
+    Provider unreachable, overloaded or erroring (timeouts, 429, 5xx).
+    `request_sent=False` means the provider never saw the request, so it is
+    always safe to retry.
+    """
+
+    def __init__(self, message: str, request_sent: bool = True) -> None:
+        super().__init__(message)
+        self.request_sent = request_sent
+
+
+class POSOverloadedError(POSTransientError):
+    """Raised without calling the provider when its bulkhead queue is full or too slow."""
+
+    def __init__(self, message: str, retry_after: float = 1.0) -> None:
+        super().__init__(message, request_sent=False)
+        self.retry_after = retry_after
+
+
+class POSCircuitOpenError(POSTransientError):
+    """Raised without calling the provider while its circuit breaker is open."""
+
+    def __init__(self, message: str, retry_after: float = 1.0) -> None:
+        super().__init__(message, request_sent=False)
+        self.retry_after = retry_after
+
+
 @dataclass
 class POSLineItem:
     """Normalized line-item structure shared across adapters."""
@@ -42,6 +73,8 @@ class POSPaymentRequest:
     merchant_reference: Optional[str] = None
     payment_method_token: Optional[str] = None
     fingerprint_hash: Optional[str] = None
+    provider_customer_id: Optional[str] = None
+    idempotency_key: Optional[str] = None
     metadata: Dict[str, Any] = field(default_factory=dict)
     items: List[POSLineItem] = field(default_factory=list)
 
@@ -53,9 +86,21 @@ class POSPaymentResult:
     status: str
     transaction_reference: Optional[str]
     client_secret: Optional[str] = None
+    provider_customer_id: Optional[str] = None
     raw_response: Dict[str, Any] = field(default_factory=dict)
 
 
+@dataclass
+class POSPaymentRecord:
+    """A payment as the provider currently reports it, for reconciliation."""
+
+    transaction_reference: str
+    status: str
+    created_at: datetime
+    amount: Optional[float] = None
+    transaction_id: Optional[str] = None  # Our TXN- id when the provider echoes it back
+
+
 class POSAdapter(ABC):
     """Abstract base class for POS integrations."""
 
@@ -76,6 +121,10 @@ class POSAdapter(ABC):
     def send_payment(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """Execute the provider API call and return the raw response."""
 
+    async def asend_payment(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Async provider call. Sync adapters run `send_payment` on the shared POS executor."""
+        return await run_blocking(self.send_payment, payload)
+
     @abstractmethod
     def parse_response(self, response: Dict[str, Any]) -> POSPaymentResult:
         """Translate provider response into middleware result."""
@@ -85,4 +134,25 @@ class POSAdapter(ABC):
         response = self.send_payment(payload)
         return self.parse_response(response)
 
+    async def aprocess(self, request: POSPaymentRequest) -> POSPaymentResult:
+        payload = self.prepare_payload(request)
+        response = await self.asend_payment(payload)
+        return self.parse_response(response)
+
+    def list_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        """One page of payments created in [start, end) and the cursor for the next page."""
+        raise POSAdapterError(f"POS adapter '{self.name}' does not support listing payments")
+
+    async def alist_payments(
+        self, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        return await run_blocking(self.list_payments, start, end, cursor)
+
+    def retrieve_payment(self, reference: str) -> POSPaymentRecord:
+        """Current provider view of one payment."""
+        raise POSAdapterError(f"POS adapter '{self.name}' does not support payment lookups")
 
+    async def aretrieve_payment(self, reference: str) -> POSPaymentRecord:
+        return await run_blocking(self.retrieve_payment, reference)
@@ -0,0 +1,104 @@
+"""Shared, pooled transport for POS provider calls."""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, TypeVar
+
+# httpx and requests are imported when the first client is built; they are a
+# noticeable share of API cold-start time and only provider calls need them
+if TYPE_CHECKING:  # pragma: no cover
+    import httpx
+    import requests
+
+T = TypeVar("T")
+
+POS_HTTP_MAX_CONNECTIONS = int(os.getenv("POS_HTTP_MAX_CONNECTIONS", "100"))
+POS_HTTP_MAX_KEEPALIVE = int(os.getenv("POS_HTTP_MAX_KEEPALIVE", "20"))
+POS_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("POS_HTTP_KEEPALIVE_EXPIRY", "30"))
+POS_HTTP_CONNECT_TIMEOUT = float(os.getenv("POS_HTTP_CONNECT_TIMEOUT", "3"))
+POS_HTTP_READ_TIMEOUT = float(os.getenv("POS_HTTP_READ_TIMEOUT", "15"))
+POS_HTTP_WRITE_TIMEOUT = float(os.getenv("POS_HTTP_WRITE_TIMEOUT", "5"))
+POS_HTTP_POOL_TIMEOUT = float(os.getenv("POS_HTTP_POOL_TIMEOUT", "2"))
+POS_SYNC_WORKERS = int(os.getenv("POS_SYNC_WORKERS", "32"))
+
+# HTTP/2 needs the optional h2 package (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_async_clients: Dict[str, httpx.AsyncClient] = {}
+_sync_sessions: Dict[str, requests.Session] = {}
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def http_timeout() -> httpx.Timeout:
+    import httpx
+
+    return httpx.Timeout(
+        connect=POS_HTTP_CONNECT_TIMEOUT,
+        read=POS_HTTP_READ_TIMEOUT,
+        write=POS_HTTP_WRITE_TIMEOUT,
+        pool=POS_HTTP_POOL_TIMEOUT,
+    )
+
+
+def get_async_client(provider: str, base_url: str) -> httpx.AsyncClient:
+    """Return the shared keep-alive client for a provider, creating it on first use."""
+    client = _async_clients.get(provider)
+    if client is None or client.is_closed:
+        import httpx
+
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            http2=HTTP2_AVAILABLE,
+            timeout=http_timeout(),
+            limits=httpx.Limits(
+                max_connections=POS_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=POS_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=POS_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _async_clients[provider] = client
+    return client
+
+
+def get_sync_session(provider: str) -> requests.Session:
+    """Return a pooled keep-alive requests session for sync provider SDKs."""
+    session = _sync_sessions.get(provider)
+    if session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POS_SYNC_WORKERS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sync_sessions[provider] = session
+    return session
+
+
+def sync_timeout() -> tuple:
+    """(connect, read) timeout pair for requests-based calls."""
+    return (POS_HTTP_CONNECT_TIMEOUT, POS_HTTP_READ_TIMEOUT)
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking adapter call on the shared POS executor, off the event loop."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=POS_SYNC_WORKERS, thread_name_prefix="pos-sync")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def close_clients() -> None:
+    """Close pooled connections; called on application shutdown."""
+    for client in list(_async_clients.values()):
+        await client.aclose()
+    _async_clients.clear()
+    for session in list(_sync_sessions.values()):
+        session.close()
+    _sync_sessions.clear()
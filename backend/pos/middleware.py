@@ -2,9 +2,18 @@
 
 from __future__ import annotations
 
-from typing import Dict, Iterable
+import importlib
+import os
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-from .base import POSAdapter, POSAdapterError, POSPaymentRequest, POSPaymentResult
+from .base import POSAdapter, POSAdapterError, POSPaymentRecord, POSPaymentRequest, POSPaymentResult
+from .resilience import AdapterGuard
+from .scheduler import POS_DEFAULT_CONCURRENCY, POS_PROVIDER_CONCURRENCY, FairBulkhead
+
+# Bulkhead flow for background provider reads; weighted below any merchant by default
+RECONCILIATION_FLOW = "reconciliation"
+RECONCILIATION_WEIGHT = float(os.getenv("POS_RECONCILIATION_WEIGHT", "0.25"))
 
 
 class POSMiddleware:
@@ -12,51 +21,125 @@ class POSMiddleware:
 
     def __init__(self) -> None:
         self._adapters: Dict[str, POSAdapter] = {}
-
-    def register_adapter(self, adapter: POSAdapter) -> None:
+        self._factories: Dict[str, Callable[[], POSAdapter]] = {}
+        self._guards: Dict[str, AdapterGuard] = {}
+        self._bulkheads: Dict[str, FairBulkhead] = {}
+
+    def _add_controls(self, identifier: str, guard: Optional[AdapterGuard] = None) -> None:
+        self._guards[identifier] = guard or AdapterGuard(identifier)
+        self._bulkheads[identifier] = FairBulkhead(
+            identifier, int(POS_PROVIDER_CONCURRENCY.get(identifier, POS_DEFAULT_CONCURRENCY))
+        )
+        self._bulkheads[identifier].weights.setdefault(RECONCILIATION_FLOW, RECONCILIATION_WEIGHT)
+
+    def register_adapter(self, adapter: POSAdapter, guard: Optional[AdapterGuard] = None) -> None:
         identifier = adapter.name.lower()
         if not identifier or identifier in {"base", ""}:
             raise POSAdapterError("Adapter must define a unique name")
         self._adapters[identifier] = adapter
+        self._factories.pop(identifier, None)
+        self._add_controls(identifier, guard)
+
+    def register_factory(self, name: str, factory: Callable[[], POSAdapter]) -> None:
+        """
+        Register an adapter that is built on first use, so its provider SDK
+        is imported and its configuration validated only when needed.
+        """
+        identifier = name.lower()
+        self._factories[identifier] = factory
+        if identifier not in self._guards:
+            self._add_controls(identifier)
 
     def get_adapter(self, provider: str) -> POSAdapter:
-        adapter = self._adapters.get(provider.lower())
-        if not adapter:
-            available = ", ".join(sorted(self._adapters.keys())) or "none"
+        identifier = provider.lower()
+        adapter = self._adapters.get(identifier)
+        if adapter:
+            return adapter
+        factory = self._factories.get(identifier)
+        if not factory:
+            available = ", ".join(sorted(self.available_adapters())) or "none"
             raise POSAdapterError(
                 f"POS adapter '{provider}' is not registered. Available adapters: {available}."
             )
+        try:
+            adapter = factory()
+        except POSAdapterError as exc:
+            raise POSAdapterError(f"POS adapter '{provider}' is unavailable: {exc}") from exc
+        self._adapters[identifier] = adapter
+        self._factories.pop(identifier, None)
         return adapter
 
-    def process_payment(self, provider: str, request: POSPaymentRequest) -> POSPaymentResult:
+    async def process_payment(self, provider: str, request: POSPaymentRequest) -> POSPaymentResult:
+        adapter = self.get_adapter(provider)
+        guard = self._guards[adapter.name.lower()]
+        bulkhead = self._bulkheads[adapter.name.lower()]
+
+        async def attempt() -> POSPaymentResult:
+            # Slots are held per attempt, never across retry backoff
+            async with bulkhead.slot(request.merchant_reference):
+                return await adapter.aprocess(request)
+
+        return await guard.call(attempt, idempotent=bool(request.idempotency_key))
+
+    async def list_payments(
+        self, provider: str, start: datetime, end: datetime, cursor: Optional[str] = None
+    ) -> Tuple[List[POSPaymentRecord], Optional[str]]:
+        """
+        One page of provider payment records. Runs behind the same breaker and
+        bulkhead as checkout, queued as its own low-weight "reconciliation" flow.
+        """
         adapter = self.get_adapter(provider)
-        return adapter.process(request)
+        guard = self._guards[adapter.name.lower()]
+        bulkhead = self._bulkheads[adapter.name.lower()]
 
-    def available_adapters(self) -> Iterable[str]:
-        return self._adapters.keys()
+        async def attempt() -> Tuple[List[POSPaymentRecord], Optional[str]]:
+            async with bulkhead.slot(RECONCILIATION_FLOW):
+                return await adapter.alist_payments(start, end, cursor)
 
+        return await guard.call(attempt, idempotent=True)
 
-# Shared singleton used across the FastAPI application
-pos_middleware = POSMiddleware()
+    async def retrieve_payment(self, provider: str, reference: str) -> POSPaymentRecord:
+        """Provider view of one payment, queued in the same "reconciliation" flow as list calls."""
+        adapter = self.get_adapter(provider)
+        guard = self._guards[adapter.name.lower()]
+        bulkhead = self._bulkheads[adapter.name.lower()]
 
-# Register built-in adapters
-try:
-    from .adapters.stripe_adapter import StripePOSAdapter
+        async def attempt() -> POSPaymentRecord:
+            async with bulkhead.slot(RECONCILIATION_FLOW):
+                return await adapter.aretrieve_payment(reference)
 
-    pos_middleware.register_adapter(StripePOSAdapter())
-except Exception as exc:  # pragma: no cover - registration should not break app startup
-    # Deferred error: adapter-specific errors will surface when invoked
-    import logging
+        return await guard.call(attempt, idempotent=True)
 
-    logging.getLogger(__name__).warning("StripePOSAdapter registration failed: %s", exc)
+    def set_merchant_weight(self, merchant_reference: str, weight: float) -> None:
+        """Share of provider capacity a merchant gets under contention (default 1)."""
+        for bulkhead in self._bulkheads.values():
+            bulkhead.set_weight(merchant_reference, weight)
+
+    def health(self) -> Dict[str, Dict[str, Any]]:
+        """Breaker state, rolling latency/error stats and bulkhead queues per adapter."""
+        return {
+            name: {**guard.health(), "bulkhead": self._bulkheads[name].metrics()}
+            for name, guard in self._guards.items()
+        }
+
+    def available_adapters(self) -> Iterable[str]:
+        return self._adapters.keys() | self._factories.keys()
+
+
+# Shared singleton used across the FastAPI application
+pos_middleware = POSMiddleware()
 
-try:
-    from .adapters.square_adapter import SquarePOSAdapter
 
-    pos_middleware.register_adapter(SquarePOSAdapter())
-except Exception as exc:  # pragma: no cover
-    import logging
+def lazy_adapter(module: str, class_name: str) -> Callable[[], POSAdapter]:
+    """Factory that imports `module` (relative to this package) and builds the adapter."""
+    def factory() -> POSAdapter:
+        return getattr(importlib.import_module(module, __package__), class_name)()
+    return factory
 
-    logging.getLogger(__name__).info("SquarePOSAdapter registered as template: %s", exc)
 
+# Register built-in adapters; each loads on its first payment
+pos_middleware.register_factory("stripe", lazy_adapter(".adapters.stripe_adapter", "StripePOSAdapter"))
+pos_middleware.register_factory("square", lazy_adapter(".adapters.square_adapter", "SquarePOSAdapter"))
 
+if os.getenv("POS_ENABLE_FAKE", "false").lower() == "true":
+    pos_middleware.register_factory("fake", lazy_adapter(".adapters.fake_adapter", "FakePOSAdapter"))
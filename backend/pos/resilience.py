@@ -0,0 +1,217 @@
+"""Circuit breaking, retries and rolling health statistics for POS adapters."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from .base import POSAdapterError, POSCircuitOpenError, POSOverloadedError, POSTransientError
+
+T = TypeVar("T")
+
+POS_STATS_WINDOW_SECONDS = float(os.getenv("POS_STATS_WINDOW_SECONDS", "60"))
+POS_STATS_MAX_SAMPLES = int(os.getenv("POS_STATS_MAX_SAMPLES", "2048"))
+POS_BREAKER_FAILURE_THRESHOLD = int(os.getenv("POS_BREAKER_FAILURE_THRESHOLD", "5"))
+POS_BREAKER_ERROR_RATE = float(os.getenv("POS_BREAKER_ERROR_RATE", "0.5"))
+POS_BREAKER_MIN_REQUESTS = int(os.getenv("POS_BREAKER_MIN_REQUESTS", "20"))
+POS_BREAKER_RESET_SECONDS = float(os.getenv("POS_BREAKER_RESET_SECONDS", "30"))
+POS_RETRY_ATTEMPTS = int(os.getenv("POS_RETRY_ATTEMPTS", "3"))
+POS_RETRY_BASE_DELAY = float(os.getenv("POS_RETRY_BASE_DELAY", "0.1"))
+POS_RETRY_MAX_DELAY = float(os.getenv("POS_RETRY_MAX_DELAY", "1.0"))
+
+
+class RollingStats:
+    """Latency and error samples for the last `window` seconds."""
+
+    def __init__(self, window: float = POS_STATS_WINDOW_SECONDS, max_samples: int = POS_STATS_MAX_SAMPLES) -> None:
+        self.window = window
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=max_samples)
+
+    def record(self, latency: float, ok: bool) -> None:
+        self._samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self):
+        cutoff = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        return self._samples
+
+    def error_rate(self) -> Tuple[int, float]:
+        samples = self._recent()
+        if not samples:
+            return 0, 0.0
+        errors = sum(1 for _, _, ok in samples if not ok)
+        return len(samples), errors / len(samples)
+
+    def snapshot(self) -> Dict[str, Any]:
+        samples = self._recent()
+        latencies = sorted(latency for _, latency, _ in samples)
+        requests, error_rate = self.error_rate()
+
+        def percentile(fraction: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 1)
+
+        return {
+            "window_seconds": self.window,
+            "requests": requests,
+            "error_rate": round(error_rate, 4),
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+        }
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures or when the
+    windowed error rate crosses `error_rate` (with at least `min_requests`).
+    open -> half_open after `reset_timeout`; one probe call decides whether
+    it closes again.
+    """
+
+    def __init__(
+        self,
+        stats: RollingStats,
+        failure_threshold: int = POS_BREAKER_FAILURE_THRESHOLD,
+        error_rate: float = POS_BREAKER_ERROR_RATE,
+        min_requests: int = POS_BREAKER_MIN_REQUESTS,
+        reset_timeout: float = POS_BREAKER_RESET_SECONDS,
+    ) -> None:
+        self.stats = stats
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probe_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self) -> None:
+        if self.state == "open":
+            if self.retry_after() > 0:
+                raise POSCircuitOpenError("Provider circuit is open", retry_after=self.retry_after())
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                raise POSCircuitOpenError("Provider circuit is half-open; probe in progress", retry_after=1.0)
+            self._probe_in_flight = True
+
+    def on_success(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures = 0
+        self.state = "closed"
+
+    def on_failure(self) -> None:
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        requests, error_rate = self.stats.error_rate()
+        if (
+            self.state == "half_open"
+            or self.consecutive_failures >= self.failure_threshold
+            or (requests >= self.min_requests and error_rate >= self.error_rate)
+        ):
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def on_skipped(self) -> None:
+        """The call ended without an answer about provider health (shed by our bulkhead, or cancelled)"""
+        self._probe_in_flight = False
+
+    def on_neutral(self) -> None:
+        """Call finished without telling us anything about provider health (e.g. a decline)"""
+        self._probe_in_flight = False
+        if self.state == "half_open":
+            self.state = "closed"
+        self.consecutive_failures = 0
+
+
+class AdapterGuard:
+    """Breaker, bounded jittered retries and rolling stats around one adapter."""
+
+    def __init__(
+        self,
+        provider: str,
+        attempts: int = POS_RETRY_ATTEMPTS,
+        base_delay: float = POS_RETRY_BASE_DELAY,
+        max_delay: float = POS_RETRY_MAX_DELAY,
+    ) -> None:
+        self.provider = provider
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = RollingStats()
+        self.breaker = CircuitBreaker(self.stats)
+        self.retries = 0
+        self.rejected = 0
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform between 0 and the capped exponential delay."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, func: Callable[[], Awaitable[T]], idempotent: bool) -> T:
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except POSCircuitOpenError:
+                self.rejected += 1
+                raise
+
+            started = time.perf_counter()
+            try:
+                result = await func()
+            except POSOverloadedError:
+                self.breaker.on_skipped()
+                raise
+            except POSTransientError as exc:
+                self.stats.record(time.perf_counter() - started, ok=False)
+                self.breaker.on_failure()
+                attempt += 1
+                # Only retry when a repeat cannot double-charge
+                if attempt >= self.attempts or not (idempotent or not exc.request_sent):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            except POSAdapterError:
+                # Declines and validation errors: the provider answered
+                self.stats.record(time.perf_counter() - started, ok=True)
+                self.breaker.on_neutral()
+                raise
+            except Exception:
+                self.stats.record(time.perf_counter() - started, ok=False)
+                self.breaker.on_failure()
+                raise
+            except BaseException:
+                # Cancelled (client gone, shutdown): no verdict on the provider,
+                # but a half-open probe must not stay in flight forever
+                self.breaker.on_skipped()
+                raise
+
+            self.stats.record(time.perf_counter() - started, ok=True)
+            self.breaker.on_success()
+            return result
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            "state": self.breaker.state,
+            "retry_after_seconds": round(self.breaker.retry_after(), 1) if self.breaker.state == "open" else 0.0,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "trips": self.breaker.trips,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            **self.stats.snapshot(),
+        }
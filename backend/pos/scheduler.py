@@ -0,0 +1,168 @@
+"""Per-provider bulkheads and rate limits, with weighted fair queuing across merchants."""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from .base import POSOverloadedError
+from .resilience import RollingStats
+
+POS_DEFAULT_CONCURRENCY = int(os.getenv("POS_DEFAULT_CONCURRENCY", "32"))
+POS_MAX_QUEUE = int(os.getenv("POS_MAX_QUEUE", "500"))
+POS_QUEUE_TIMEOUT = float(os.getenv("POS_QUEUE_TIMEOUT", "10"))
+
+
+def parse_mapping(raw: Optional[str]) -> Dict[str, float]:
+    """'stripe=50,square=20' -> {'stripe': 50.0, 'square': 20.0}"""
+    mapping: Dict[str, float] = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        key, value = item.split("=", 1)
+        mapping[key.strip()] = float(value)
+    return mapping
+
+
+POS_PROVIDER_CONCURRENCY = parse_mapping(os.getenv("POS_PROVIDER_CONCURRENCY"))
+POS_MERCHANT_WEIGHTS = parse_mapping(os.getenv("POS_MERCHANT_WEIGHTS"))
+
+
+class RateLimiter:
+    """Token bucket: `rate` calls per second on average, bursts up to `burst`."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = max(rate, 0.01)
+        self.burst = max(burst or rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class FairBulkhead:
+    """
+    Caps concurrent calls to one provider. When every slot is busy, waiters
+    are ordered by start-time fair queuing: each merchant's requests get
+    virtual finish tags spaced 1/weight apart, so a merchant with a burst
+    only delays its own later requests and weight 2 gets twice the share of
+    weight 1 under contention.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        limit: int = POS_DEFAULT_CONCURRENCY,
+        weights: Optional[Dict[str, float]] = None,
+        max_queue: int = POS_MAX_QUEUE,
+        queue_timeout: float = POS_QUEUE_TIMEOUT,
+    ) -> None:
+        self.provider = provider
+        self.limit = max(1, limit)
+        self.weights = dict(POS_MERCHANT_WEIGHTS if weights is None else weights)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self.queue_stats = RollingStats()
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self._heap: List[Tuple[float, int, float, str, asyncio.Future]] = []
+        self._waiting: Counter = Counter()
+        self._sequence = itertools.count()
+
+    def set_weight(self, merchant: str, weight: float) -> None:
+        self.weights[merchant] = weight
+
+    def _weight(self, merchant: str) -> float:
+        return max(self.weights.get(merchant, 1.0), 0.01)
+
+    async def acquire(self, merchant: str) -> float:
+        """Wait for a slot; returns the seconds spent queued."""
+        if self.in_flight < self.limit and not self._heap:
+            self.in_flight += 1
+            self.queue_stats.record(0.0, ok=True)
+            return 0.0
+        if len(self._heap) >= self.max_queue:
+            self.rejected += 1
+            raise POSOverloadedError(f"{self.provider} queue is full ({self.max_queue} waiting)")
+
+        start = max(self._virtual_time, self._last_finish.get(merchant, 0.0))
+        finish = start + 1.0 / self._weight(merchant)
+        self._last_finish[merchant] = finish
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (finish, next(self._sequence), start, merchant, waiter))
+        self._waiting[merchant] += 1
+
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiting[merchant] -= 1
+            if isinstance(exc, asyncio.TimeoutError):
+                self.rejected += 1
+                raise POSOverloadedError(
+                    f"{self.provider} queue wait exceeded {self.queue_timeout:.0f}s"
+                ) from None
+            raise
+        waited = time.perf_counter() - queued_at
+        self.queue_stats.record(waited, ok=True)
+        return waited
+
+    def release(self) -> None:
+        """Hand the slot to the waiter with the smallest finish tag."""
+        while self._heap:
+            _, _, start, merchant, waiter = heapq.heappop(self._heap)
+            if waiter.cancelled():
+                continue
+            self._waiting[merchant] -= 1
+            self._virtual_time = max(self._virtual_time, start)
+            waiter.set_result(None)
+            return
+        self.in_flight -= 1
+        # Idle merchants' tags are behind virtual time; drop them
+        if not self._heap:
+            self._last_finish = {
+                m: f for m, f in self._last_finish.items() if f > self._virtual_time
+            }
+
+    @asynccontextmanager
+    async def slot(self, merchant: Optional[str]) -> AsyncIterator[float]:
+        waited = await self.acquire(merchant or "anonymous")
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    def metrics(self) -> Dict[str, Any]:
+        waiting = {merchant: count for merchant, count in self._waiting.items() if count > 0}
+        snapshot = self.queue_stats.snapshot()
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": sum(waiting.values()),
+            "waiting_by_merchant": dict(Counter(waiting).most_common(10)),
+            "rejected": self.rejected,
+            "queue_p50_ms": snapshot["p50_ms"],
+            "queue_p95_ms": snapshot["p95_ms"],
+            "queue_p99_ms": snapshot["p99_ms"],
+        }
@@ -0,0 +1,105 @@
+"""
+Cart Pricing - server-side line totals, tax and total for checkout
+Terminals send barcodes and quantities; every barcode in the cart is resolved
+with one IN-list query against the merchant's inventory, so a 30-item cart
+costs one lookup instead of 30 barcode requests, and prices come from the
+catalog rather than the client.
+"""
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Sequence
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models import Inventory
+
+TAX_RATE = float(os.getenv("TAX_RATE", "0.08"))
+# Legacy terminals send name/price items and an amount; set to false to require barcode carts
+CLIENT_PRICED_CARTS = os.getenv("CLIENT_PRICED_CARTS", "true").lower() == "true"
+
+
+@dataclass
+class PricedCart:
+    items: List[Dict[str, Any]]
+    amount: float
+    tax: float
+    total: float
+
+
+def _cents(value: float) -> int:
+    return int(round(value * 100))
+
+
+def _priced(items: List[Dict[str, Any]], amount_cents: int) -> PricedCart:
+    tax_cents = int(round(amount_cents * TAX_RATE))
+    return PricedCart(
+        items=items,
+        amount=amount_cents / 100,
+        tax=tax_cents / 100,
+        total=(amount_cents + tax_cents) / 100,
+    )
+
+
+def price_client_cart(amount: float, items: List[Dict[str, Any]]) -> PricedCart:
+    """Totals for a cart the terminal priced itself"""
+    if not CLIENT_PRICED_CARTS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Client-priced carts are disabled; send barcodes and quantities in 'cart'"
+        )
+    return _priced(items, _cents(amount))
+
+
+def resolve_barcodes(session: Session, merchant_pk: int, barcodes: Sequence[str]) -> Dict[str, Any]:
+    """Active inventory rows for the given barcodes in one query, keyed by barcode"""
+    rows = session.execute(
+        select(Inventory.id, Inventory.barcode, Inventory.name, Inventory.price)
+        .where(
+            Inventory.merchant_id == merchant_pk,
+            Inventory.barcode.in_(set(barcodes)),
+            Inventory.is_active == True
+        )
+        .order_by(Inventory.id)
+    ).all()
+    resolved: Dict[str, Any] = {}
+    for row in rows:
+        # Duplicate barcodes resolve to the oldest item, as the single-barcode lookup does
+        resolved.setdefault(row.barcode, row)
+    return resolved
+
+
+def price_cart(session: Session, merchant_pk: int, lines: Sequence) -> PricedCart:
+    """
+    Price a cart of barcode/quantity lines from the merchant's catalog.
+    Repeated barcodes are merged into one line; unknown or inactive barcodes
+    reject the whole cart with a 422 listing them.
+    """
+    quantities: Dict[str, int] = {}
+    for line in lines:
+        quantities[line.barcode] = quantities.get(line.barcode, 0) + line.quantity
+
+    resolved = resolve_barcodes(session, merchant_pk, list(quantities))
+    missing = [barcode for barcode in quantities if barcode not in resolved]
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown or inactive barcodes: {', '.join(missing)}"
+        )
+
+    items = []
+    amount_cents = 0
+    for barcode, quantity in quantities.items():
+        row = resolved[barcode]
+        line_cents = _cents(row.price) * quantity
+        amount_cents += line_cents
+        items.append({
+            "name": row.name,
+            "price": row.price,
+            "quantity": quantity,
+            "barcode": barcode,
+            "inventory_id": row.id,
+            "line_total": line_cents / 100,
+        })
+    return _priced(items, amount_cents)
@@ -0,0 +1,246 @@
+"""
+Reconciliation - bulk comparison of local transactions with provider records
+Pages through the provider's payment list for a time window (never one
+retrieve per transaction), diffs it against local transactions in memory
+and corrects statuses in bulk.
+
+Run it on a schedule or by hand:
+    python reconciliation.py --provider stripe --hours 24
+    python reconciliation.py --provider square --start 2025-01-01T00:00 --end 2025-01-02T00:00 --dry-run
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from database import SessionLocal, init_db, shards
+from models import Transaction
+from payment_status import FINAL_STATUSES, apply_status_updates, link_provider_references, map_provider_status
+from pos import POSPaymentRecord, pos_middleware
+from pos.clients import close_clients
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "4"))
+RECONCILE_SLICE_MINUTES = float(os.getenv("RECONCILE_SLICE_MINUTES", "60"))
+# Local created_at and the provider's creation time differ by the checkout round trip
+RECONCILE_CLOCK_SKEW_SECONDS = float(os.getenv("RECONCILE_CLOCK_SKEW_SECONDS", "600"))
+REPORT_SAMPLE_SIZE = 50
+
+
+@dataclass
+class ReconciliationReport:
+    provider: str
+    start: datetime
+    end: datetime
+    dry_run: bool
+    provider_records: int = 0
+    local_records: int = 0
+    pages: int = 0
+    matched: int = 0
+    corrected: int = 0
+    linked: int = 0
+    # Corrections held back because the merchant is moving between shards
+    deferred: int = 0
+    mismatched: List[Dict] = field(default_factory=list)
+    conflicts: List[Dict] = field(default_factory=list)
+    unlinked: List[Dict] = field(default_factory=list)
+    missing_locally: List[Dict] = field(default_factory=list)
+    missing_at_provider: List[Dict] = field(default_factory=list)
+    elapsed_seconds: float = 0.0
+
+    def to_dict(self) -> Dict:
+        """Counts for every discrepancy type plus a sample of each"""
+        discrepancies = ("mismatched", "conflicts", "unlinked", "missing_locally", "missing_at_provider")
+        return {
+            "provider": self.provider,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "dry_run": self.dry_run,
+            "provider_records": self.provider_records,
+            "local_records": self.local_records,
+            "pages": self.pages,
+            "matched": self.matched,
+            "corrected": self.corrected,
+            "linked": self.linked,
+            "deferred": self.deferred,
+            **{name: len(getattr(self, name)) for name in discrepancies},
+            "samples": {name: getattr(self, name)[:REPORT_SAMPLE_SIZE] for name in discrepancies},
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+        }
+
+
+async def fetch_provider_records(
+    provider: str,
+    start: datetime,
+    end: datetime,
+    concurrency: int = RECONCILE_CONCURRENCY,
+    slice_minutes: float = RECONCILE_SLICE_MINUTES
+) -> Tuple[Dict[str, POSPaymentRecord], int]:
+    """
+    All provider payments created in [start, end), keyed by provider reference.
+    The window is cut into slices paged concurrently, at most `concurrency`
+    list calls in flight.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    records: Dict[str, POSPaymentRecord] = {}
+    pages = 0
+
+    async def page_through(slice_start: datetime, slice_end: datetime) -> None:
+        nonlocal pages
+        cursor: Optional[str] = None
+        while True:
+            async with semaphore:
+                page, cursor = await pos_middleware.list_payments(provider, slice_start, slice_end, cursor)
+            pages += 1
+            for record in page:
+                records[record.transaction_reference] = record
+            if not cursor:
+                return
+
+    step = timedelta(minutes=slice_minutes)
+    slices = []
+    slice_start = start
+    while slice_start < end:
+        slices.append((slice_start, min(slice_start + step, end)))
+        slice_start += step
+    await asyncio.gather(*(page_through(s, e) for s, e in slices))
+    return records, pages
+
+
+def _entry(local=None, record: Optional[POSPaymentRecord] = None, provider_status: Optional[str] = None) -> Dict:
+    entry: Dict = {}
+    if local is not None:
+        entry.update(
+            transaction_id=local.transaction_id,
+            provider_transaction_id=local.provider_transaction_id,
+            local_status=local.status,
+        )
+    if record is not None:
+        entry.setdefault("transaction_id", record.transaction_id)
+        entry.update(
+            provider_transaction_id=record.transaction_reference,
+            provider_status=provider_status,
+            provider_created_at=record.created_at.isoformat(),
+        )
+    return entry
+
+
+async def reconcile(
+    provider: str,
+    start: datetime,
+    end: datetime,
+    dry_run: bool = False,
+    concurrency: int = RECONCILE_CONCURRENCY,
+    slice_minutes: float = RECONCILE_SLICE_MINUTES
+) -> ReconciliationReport:
+    """Diff one provider's records for [start, end) against local transactions and fix what drifted"""
+    started = time.perf_counter()
+    report = ReconciliationReport(provider=provider, start=start, end=end, dry_run=dry_run)
+    # Provider calls first: no database session is held across them
+    records, report.pages = await fetch_provider_records(provider, start, end, concurrency, slice_minutes)
+    report.provider_records = len(records)
+
+    skew = timedelta(seconds=RECONCILE_CLOCK_SKEW_SECONDS)
+    with SessionLocal() as db, shards.all_sessions(db, for_write=True) as shard_dbs:
+        by_reference: Dict[str, Tuple[int, object]] = {}
+        by_transaction_id: Dict[str, Tuple[int, object]] = {}
+        for index, shard_db in enumerate(shard_dbs):
+            for local in shard_db.execute(
+                select(
+                    Transaction.transaction_id, Transaction.provider_transaction_id,
+                    Transaction.status, Transaction.created_at, Transaction.merchant_id
+                ).where(
+                    Transaction.payment_provider == provider,
+                    Transaction.created_at >= start - skew,
+                    Transaction.created_at < end + skew
+                )
+            ):
+                report.local_records += 1
+                if local.provider_transaction_id:
+                    by_reference[local.provider_transaction_id] = (index, local)
+                else:
+                    by_transaction_id[local.transaction_id] = (index, local)
+
+        # Writes to a merchant mid-move could miss shard_tool's delta copy;
+        # they are reported and left for the next run
+        moving = shards.moving_merchants()
+        updates: Dict[int, Dict[str, str]] = defaultdict(dict)
+        links: Dict[int, Dict[str, Tuple[str, str]]] = defaultdict(dict)
+        for reference, record in records.items():
+            provider_status = map_provider_status(record.status)
+            if reference in by_reference:
+                index, local = by_reference.pop(reference)
+                if local.status == provider_status:
+                    report.matched += 1
+                elif local.status in FINAL_STATUSES:
+                    # Never rewritten automatically; needs a person to look at it
+                    report.conflicts.append(_entry(local, record, provider_status))
+                else:
+                    report.mismatched.append(_entry(local, record, provider_status))
+                    if local.merchant_id in moving:
+                        report.deferred += 1
+                    else:
+                        updates[index][reference] = provider_status
+            elif record.transaction_id in by_transaction_id:
+                index, local = by_transaction_id.pop(record.transaction_id)
+                report.unlinked.append(_entry(local, record, provider_status))
+                if local.merchant_id in moving:
+                    report.deferred += 1
+                else:
+                    links[index][local.transaction_id] = (reference, provider_status)
+            else:
+                report.missing_locally.append(_entry(record=record, provider_status=provider_status))
+
+        # Local payments the provider never reported; skip rows too close to
+        # the window end, whose provider record may fall just outside it
+        for _, local in by_reference.values():
+            if start <= local.created_at < end - skew:
+                report.missing_at_provider.append(_entry(local))
+
+        if not dry_run:
+            for index, shard_db in enumerate(shard_dbs):
+                if not updates[index] and not links[index]:
+                    continue
+                report.corrected += apply_status_updates(shard_db, updates[index])
+                report.linked += link_provider_references(shard_db, links[index])
+                shard_db.commit()
+
+    report.elapsed_seconds = time.perf_counter() - started
+    logger.info(
+        "Reconciled %s %s..%s: %d records, %d corrected, %d linked",
+        provider, start.isoformat(), end.isoformat(), report.provider_records, report.corrected, report.linked
+    )
+    return report
+
+
+async def _run(args) -> None:
+    init_db()
+    end = datetime.fromisoformat(args.end) if args.end else datetime.utcnow()
+    start = datetime.fromisoformat(args.start) if args.start else end - timedelta(hours=args.hours)
+    try:
+        report = await reconcile(args.provider, start, end, args.dry_run, args.concurrency, args.slice_minutes)
+    finally:
+        await close_clients()
+    print(json.dumps(report.to_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--provider", default=os.getenv("DEFAULT_POS_PROVIDER", "stripe"))
+    parser.add_argument("--hours", type=float, default=24.0, help="window length ending now (or at --end)")
+    parser.add_argument("--start", help="window start, ISO 8601 UTC")
+    parser.add_argument("--end", help="window end, ISO 8601 UTC")
+    parser.add_argument("--concurrency", type=int, default=RECONCILE_CONCURRENCY, help="list calls in flight")
+    parser.add_argument("--slice-minutes", type=float, default=RECONCILE_SLICE_MINUTES)
+    parser.add_argument("--dry-run", action="store_true", help="report without correcting")
+    asyncio.run(_run(parser.parse_args()))
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, model_validator
 from typing import Optional, List
 from datetime import datetime
 
@@ -73,13 +73,34 @@ class TransactionItem(BaseModel):
     name: str
     price: float
 
+class CartLine(BaseModel):
+    barcode: str
+    quantity: int = Field(default=1, ge=1)
+
 class TransactionCreate(BaseModel):
-    amount: float
-    items: List[TransactionItem]
+    # Either `cart` (priced server-side from inventory) or a client-priced `amount` and `items`
+    cart: Optional[List[CartLine]] = None
+    amount: Optional[float] = None
+    items: List[TransactionItem] = []
     fingerprint_hash: str
     payment_method_id: Optional[int] = None
     pos_provider: Optional[str] = "stripe"
 
+    @model_validator(mode="after")
+    def check_priced(self):
+        if not self.cart and self.amount is None:
+            raise ValueError("Send either 'cart' or 'amount' and 'items'")
+        return self
+
+class CartPriceRequest(BaseModel):
+    cart: List[CartLine] = Field(min_length=1)
+
+class CartPriceResponse(BaseModel):
+    items: List[dict]
+    amount: float
+    tax: float
+    total: float
+
 class TransactionResponse(BaseModel):
     transaction_id: str
     customer_id: str
@@ -124,6 +145,20 @@ class InventoryResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class InventorySearchHit(InventoryResponse):
+    score: float
+
+class InventorySearchResponse(BaseModel):
+    items: List[InventorySearchHit]
+    has_more: bool
+
+class InventorySyncResponse(BaseModel):
+    items: List[InventoryResponse]  # created or updated since the token
+    deleted: List[int]  # ids removed since the token
+    full: bool  # a full resync page: drop local items not sent by the end of the run
+    has_more: bool
+    sync_token: str
+
 # Fingerprint Verification
 class FingerprintVerify(BaseModel):
     fingerprint_hash: str
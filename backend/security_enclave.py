@@ -15,16 +15,21 @@ import hashlib
 
 load_dotenv()
 
-# Master key stored only in environment secrets (Fly.io/KMS/AWS Secrets Manager)
-MASTER_KEY = os.getenv("PROTEGA_MASTER_KEY")
-if not MASTER_KEY:
-    raise RuntimeError(
-        "Missing PROTEGA_MASTER_KEY secret. "
-        "Set via: fly secrets set PROTEGA_MASTER_KEY=$(openssl rand -hex 64)"
-    )
-
-if len(MASTER_KEY) < 64:
-    raise RuntimeError("PROTEGA_MASTER_KEY must be at least 64 characters for security")
+def master_key() -> str:
+    """
+    Master key stored only in environment secrets (Fly.io/KMS/AWS Secrets Manager).
+    Validated here rather than at import; the API calls this on startup so a
+    misconfigured machine still fails before serving.
+    """
+    key = os.getenv("PROTEGA_MASTER_KEY")
+    if not key:
+        raise RuntimeError(
+            "Missing PROTEGA_MASTER_KEY secret. "
+            "Set via: fly secrets set PROTEGA_MASTER_KEY=$(openssl rand -hex 64)"
+        )
+    if len(key) < 64:
+        raise RuntimeError("PROTEGA_MASTER_KEY must be at least 64 characters for security")
+    return key
 
 def derive_record_key(salt: bytes) -> bytes:
     """
@@ -44,7 +49,7 @@ def derive_record_key(salt: bytes) -> bytes:
         iterations=200_000,  # High iteration count for security
         backend=default_backend()
     )
-    return kdf.derive(MASTER_KEY.encode())
+    return kdf.derive(master_key().encode())
 
 def encrypt_sensitive(data: str) -> tuple[str, str]:
     """
@@ -0,0 +1,44 @@
+"""
+Server-Timing - per-request phase durations
+Handlers wrap their expensive steps in `phase("provider")` and friends; the
+middleware in main reports the totals in a Server-Timing response header
+(fingerprint;dur=3.1, db;dur=1.2, provider;dur=84.0, total;dur=90.4) so load
+tests and browser dev tools can split latency by phase.
+Enabled with SERVER_TIMING=true; `phase` is a no-op otherwise.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING", "false").lower() == "true"
+
+_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("server_timing_phases", default=None)
+
+
+def start_request() -> Dict[str, float]:
+    """Begin collecting phases for the current request; handlers add to the returned dict"""
+    phases: Dict[str, float] = {}
+    _phases.set(phases)
+    return phases
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Add the block's wall time (ms) to phase `name` of the current request"""
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+
+def header_value(phases: Dict[str, float], total_ms: float) -> str:
+    entries = [f"{name};dur={duration:.1f}" for name, duration in phases.items()]
+    entries.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(entries)
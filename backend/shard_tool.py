@@ -0,0 +1,177 @@
+"""
+Shard Tool - inspect and rebalance merchant shards
+Moves a merchant's transactions and inventory between shard databases online
+
+Usage:
+    python shard_tool.py status
+    python shard_tool.py move MERCH-06GN9MZVY3S00000 2
+
+A move copies rows while the merchant keeps trading, then blocks the
+merchant's writes (HTTP 503 + Retry-After) only for the final delta copy
+and the directory flip. Reads keep working throughout. The background
+fan-out writers (webhook inbox, status refresher, reconciliation) hold back
+the merchant's rows for the same span.
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from database import SHARD_DIRECTORY_TTL, SessionLocal, init_db, insert_for, shards
+from models import Base, Merchant, MerchantShard
+
+BATCH_SIZE = 1000
+
+# Clock skew allowance between app servers when selecting the delta
+DELTA_SKEW = timedelta(seconds=30)
+
+
+def _sharded_tables():
+    return [table for table in Base.metadata.sorted_tables if table.info.get("sharded")]
+
+
+def _resolve_merchant(db, reference: str) -> int:
+    if reference.isdigit():
+        merchant_pk = db.execute(select(Merchant.id).where(Merchant.id == int(reference))).scalar()
+    else:
+        merchant_pk = db.execute(select(Merchant.id).where(Merchant.merchant_id == reference)).scalar()
+    if merchant_pk is None:
+        raise SystemExit(f"Merchant {reference} not found")
+    return merchant_pk
+
+
+def _set_directory(db, merchant_pk: int, **values) -> None:
+    db.execute(
+        insert_for(db, MerchantShard)
+        .values(merchant_id=merchant_pk, **values)
+        .on_conflict_do_update(
+            index_elements=[MerchantShard.merchant_id],
+            set_={**values, "updated_at": datetime.utcnow()},
+        )
+    )
+    db.commit()
+
+
+def _copy_rows(source, target, table, merchant_pk: int, since=None, after_id: int = 0) -> tuple:
+    """Copy a merchant's rows in id order; returns (rows copied, highest id seen)"""
+    copied = 0
+    last_id = 0
+    criteria = [table.c.merchant_id == merchant_pk]
+    if since is not None:
+        criteria.append(or_(table.c.updated_at >= since, table.c.id > after_id))
+    while True:
+        rows = source.execute(
+            select(table).where(*criteria, table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)
+        ).mappings().all()
+        if not rows:
+            return copied, last_id
+        ids = [row["id"] for row in rows]
+        with target.begin() as conn:
+            if since is not None:
+                conn.execute(delete(table).where(table.c.id.in_(ids)))
+            conn.execute(insert(table), [dict(row) for row in rows])
+        copied += len(rows)
+        last_id = ids[-1]
+
+
+def move(reference: str, target_shard: int) -> None:
+    if not shards.enabled:
+        raise SystemExit("Sharding is disabled. Set DATABASE_SHARD_URLS first.")
+    if not 0 <= target_shard < len(shards.engines):
+        raise SystemExit(f"Target shard must be between 0 and {len(shards.engines) - 1}")
+
+    with SessionLocal() as db:
+        merchant_pk = _resolve_merchant(db, reference)
+        row = db.execute(
+            select(MerchantShard.shard, MerchantShard.status).where(MerchantShard.merchant_id == merchant_pk)
+        ).first()
+        source_shard, status = (row.shard, row.status) if row else (0, "active")
+        # Release the global connection; shard 0 may share the primary's single writer
+        db.rollback()
+        if status == "moving":
+            raise SystemExit(f"Merchant {reference} already has a move in progress")
+        if source_shard == target_shard:
+            print(f"Merchant {reference} already lives on shard {target_shard}")
+            return
+
+        source = shards.engines[source_shard]
+        target = shards.engines[target_shard]
+        grace = SHARD_DIRECTORY_TTL + 1
+        report = {}
+
+        try:
+            # Phase 1: bulk copy while the merchant keeps writing to the source
+            started_at = datetime.utcnow()
+            with source.connect() as conn:
+                for table in _sharded_tables():
+                    report[table.name] = _copy_rows(conn, target, table, merchant_pk)
+            print(f"Bulk copy done: {', '.join(f'{t}={n}' for t, (n, _) in report.items())}")
+
+            # Phase 2: block writes, wait out cached directory entries, copy the delta.
+            # The grace only covers short writes: anything written after a provider
+            # call resolves the shard again (settle_after_provider_call)
+            _set_directory(db, merchant_pk, shard=source_shard, status="moving")
+            time.sleep(grace)
+            with source.connect() as conn:
+                for table in _sharded_tables():
+                    copied, _ = _copy_rows(
+                        conn, target, table, merchant_pk,
+                        since=started_at - DELTA_SKEW, after_id=report[table.name][1]
+                    )
+                    print(f"Delta copy {table.name}: {copied} rows")
+        except IntegrityError as exc:
+            # Primary keys collide when a shard was created without its id range
+            with target.begin() as conn:
+                for table in reversed(_sharded_tables()):
+                    conn.execute(delete(table).where(table.c.merchant_id == merchant_pk))
+            _set_directory(db, merchant_pk, shard=source_shard, status="active")
+            raise SystemExit(f"Move aborted, target rows removed: {exc.orig}")
+
+        # Phase 3: flip the directory, then drop the source copy once every
+        # process has stopped reading it
+        _set_directory(db, merchant_pk, shard=target_shard, status="active")
+        time.sleep(grace)
+        with source.begin() as conn:
+            for table in reversed(_sharded_tables()):
+                conn.execute(delete(table).where(table.c.merchant_id == merchant_pk))
+    print(f"Moved merchant {reference} from shard {source_shard} to shard {target_shard}")
+
+
+def status() -> None:
+    with SessionLocal() as db:
+        assigned = dict(
+            db.execute(select(MerchantShard.shard, func.count()).group_by(MerchantShard.shard)).all()
+        )
+        moving = db.execute(
+            select(func.count()).select_from(MerchantShard).where(MerchantShard.status == "moving")
+        ).scalar()
+    print(f"{'shard':<6} {'merchants':>10} " + " ".join(f"{t.name:>14}" for t in _sharded_tables()))
+    for index, shard_engine in enumerate(shards.engines):
+        with shard_engine.connect() as conn:
+            counts = [conn.execute(select(func.count()).select_from(t)).scalar() for t in _sharded_tables()]
+        print(f"{index:<6} {assigned.get(index, 0):>10} " + " ".join(f"{c:>14}" for c in counts))
+    if moving:
+        print(f"{moving} merchant(s) currently moving")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect and rebalance merchant shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="show merchants and row counts per shard")
+    move_parser = commands.add_parser("move", help="move a merchant to another shard")
+    move_parser.add_argument("merchant", help="merchant id (MERCH-...) or numeric primary key")
+    move_parser.add_argument("shard", type=int, help="target shard index")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "status":
+        status()
+    else:
+        move(args.merchant, args.shard)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
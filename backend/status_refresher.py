@@ -0,0 +1,238 @@
+"""
+Status Refresher - background lookups for transactions stuck in "processing"
+Many provider states map to "processing" and nothing moves such a row until
+the terminal confirms or a webhook arrives. The refresher finds stale rows
+through the (status, updated_at) index, asks each provider for the current
+status under a per-provider rate limit and applies the answers in bulk.
+Rows that are still processing are re-checked with exponential spacing.
+
+Runs inside the API process (STATUS_REFRESH_ENABLED) or standalone:
+    python status_refresher.py
+"""
+import asyncio
+import logging
+import os
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Dict, List, Optional
+
+from sqlalchemy import and_, func, or_, select, update
+
+from database import ReadSessionLocal, SessionLocal, init_db, shards
+from models import Transaction
+from payment_status import apply_status_updates, map_provider_status
+from pos import POSAdapterError, POSCircuitOpenError, POSTransientError, pos_middleware
+from pos.clients import close_clients
+from pos.scheduler import RateLimiter, parse_mapping
+
+logger = logging.getLogger(__name__)
+
+STATUS_REFRESH_ENABLED = os.getenv("STATUS_REFRESH_ENABLED", "true").lower() == "true"
+STATUS_REFRESH_INTERVAL = float(os.getenv("STATUS_REFRESH_INTERVAL", "15"))
+STATUS_REFRESH_BATCH_SIZE = int(os.getenv("STATUS_REFRESH_BATCH_SIZE", "100"))
+# Leave fresh rows to checkout, webhooks and terminal polling
+STATUS_REFRESH_MIN_AGE_SECONDS = float(os.getenv("STATUS_REFRESH_MIN_AGE_SECONDS", "60"))
+# Older rows are left to the reconciliation job
+STATUS_REFRESH_MAX_AGE_HOURS = float(os.getenv("STATUS_REFRESH_MAX_AGE_HOURS", "72"))
+STATUS_REFRESH_BASE_DELAY = float(os.getenv("STATUS_REFRESH_BASE_DELAY", "30"))
+STATUS_REFRESH_MAX_DELAY = float(os.getenv("STATUS_REFRESH_MAX_DELAY", "3600"))
+# Provider lookups per second, e.g. stripe=20,square=10
+STATUS_REFRESH_RATES = parse_mapping(os.getenv("STATUS_REFRESH_RATES"))
+STATUS_REFRESH_DEFAULT_RATE = float(os.getenv("STATUS_REFRESH_DEFAULT_RATE", "5"))
+
+
+def next_check_delay(checks: int) -> float:
+    """Seconds until the next lookup after `checks` lookups that found the payment still processing"""
+    return min(STATUS_REFRESH_MAX_DELAY, STATUS_REFRESH_BASE_DELAY * (2 ** max(checks - 1, 0)))
+
+
+class StatusRefresher:
+    """Finds stale processing transactions and refreshes them from their provider."""
+
+    def __init__(self, batch_size: int = STATUS_REFRESH_BATCH_SIZE, interval: float = STATUS_REFRESH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.counters = Counter()
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _limiter(self, provider: str) -> RateLimiter:
+        if provider not in self._limiters:
+            self._limiters[provider] = RateLimiter(STATUS_REFRESH_RATES.get(provider, STATUS_REFRESH_DEFAULT_RATE))
+        return self._limiters[provider]
+
+    async def start(self) -> None:
+        if self._task or not STATUS_REFRESH_ENABLED:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("Started status refresher")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                checked = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Status refresher failed")
+                checked = 0
+            # A short batch, or one the providers could not answer (circuit
+            # open, outage), waits for the next interval
+            if checked < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def _stale(now: datetime):
+        return and_(
+            Transaction.status == "processing",
+            Transaction.updated_at >= now - timedelta(hours=STATUS_REFRESH_MAX_AGE_HOURS),
+            Transaction.updated_at < now - timedelta(seconds=STATUS_REFRESH_MIN_AGE_SECONDS),
+        )
+
+    def _due(self, now: datetime) -> List[List]:
+        """Due rows per shard, oldest first; merchants moving between shards wait for the move"""
+        moving = shards.moving_merchants()
+        with ReadSessionLocal() as db, shards.all_sessions(db, for_write=False) as shard_dbs:
+            return [
+                shard_db.execute(
+                    select(
+                        Transaction.id, Transaction.merchant_id, Transaction.payment_provider,
+                        Transaction.provider_transaction_id, Transaction.status_checks
+                    )
+                    .where(
+                        self._stale(now),
+                        Transaction.provider_transaction_id.isnot(None),
+                        or_(Transaction.next_status_check_at.is_(None), Transaction.next_status_check_at <= now),
+                        Transaction.merchant_id.notin_(list(moving))
+                    )
+                    .order_by(Transaction.updated_at)
+                    .limit(self.batch_size)
+                ).all()
+                for shard_db in shard_dbs
+            ]
+
+    async def _lookup(self, row) -> Optional[str]:
+        """Provider status for one row; None when the provider could not tell us"""
+        provider = row.payment_provider or "stripe"
+        await self._limiter(provider).acquire()
+        try:
+            record = await pos_middleware.retrieve_payment(provider, row.provider_transaction_id)
+        except POSCircuitOpenError:
+            self.counters["skipped"] += 1
+            return None
+        except POSTransientError as exc:
+            self.counters["errors"] += 1
+            logger.debug("Status lookup for %s failed: %s", row.provider_transaction_id, exc)
+            return None
+        except POSAdapterError as exc:
+            # The provider rejected the lookup; back off as if still in flight
+            self.counters["errors"] += 1
+            logger.warning("Status lookup for %s rejected: %s", row.provider_transaction_id, exc)
+            return "processing"
+        self.counters["checked"] += 1
+        return map_provider_status(record.status)
+
+    async def run_once(self) -> int:
+        """Refresh one batch of stale transactions; returns the number of rows the providers answered for"""
+        now = datetime.utcnow()
+        # Sessions are closed before the provider calls and reopened to write;
+        # both run in threads so a wait for the database never stalls the event loop
+        due = await asyncio.to_thread(self._due, now)
+        lookups = [[asyncio.ensure_future(self._lookup(row)) for row in rows] for rows in due]
+        statuses = [await asyncio.gather(*shard_lookups) for shard_lookups in lookups]
+        if not any(due):
+            return 0
+        return await asyncio.to_thread(self._record, due, statuses)
+
+    def _record(self, due: List[List], statuses: List[List[Optional[str]]]) -> int:
+        """Write one batch's lookups back; returns the number of rows the providers answered for"""
+        checked_at = datetime.utcnow()
+        answered = 0
+        # A move may have started during the lookups
+        moving = shards.moving_merchants()
+        with SessionLocal() as db, shards.all_sessions(db, for_write=True) as shard_dbs:
+            for shard_db, rows, shard_statuses in zip(shard_dbs, due, statuses):
+                updates: Dict[str, str] = {}
+                still_processing = defaultdict(list)
+                # Lookups that failed or were skipped by an open circuit are
+                # retried one step later without counting as a check, so the
+                # same rows don't head every batch
+                unanswered = defaultdict(list)
+                for row, status in zip(rows, shard_statuses):
+                    checks = row.status_checks or 0
+                    if row.merchant_id in moving:
+                        continue
+                    if status is None:
+                        unanswered[checks].append(row.id)
+                    elif status == "processing":
+                        answered += 1
+                        still_processing[checks + 1].append(row.id)
+                    else:
+                        answered += 1
+                        updates[row.provider_transaction_id] = status
+                self.counters["updated"] += apply_status_updates(shard_db, updates)
+                # One UPDATE per back-off step; updated_at is left alone so the
+                # row keeps its place in the stale index range
+                for checks, ids in chain(still_processing.items(), unanswered.items()):
+                    shard_db.execute(
+                        update(Transaction)
+                        .where(Transaction.id.in_(ids), Transaction.status == "processing")
+                        .values(
+                            status_checks=checks,
+                            next_status_check_at=checked_at + timedelta(seconds=next_check_delay(checks)),
+                            updated_at=Transaction.updated_at,
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                shard_db.commit()
+        self.counters["batches"] += 1
+        return answered
+
+    def metrics(self) -> Dict:
+        """Stale processing backlog plus this process's lookup counters"""
+        now = datetime.utcnow()
+        stale = 0
+        oldest = None
+        with ReadSessionLocal() as db, shards.all_sessions(db, for_write=False) as shard_dbs:
+            for shard_db in shard_dbs:
+                count, shard_oldest = shard_db.execute(
+                    select(func.count(), func.min(Transaction.updated_at)).where(self._stale(now))
+                ).one()
+                stale += count
+                if shard_oldest and (oldest is None or shard_oldest < oldest):
+                    oldest = shard_oldest
+        return {
+            "stale_processing": stale,
+            "oldest_stale_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+            "running": self._task is not None,
+            "checked": self.counters["checked"],
+            "updated": self.counters["updated"],
+            "errors": self.counters["errors"],
+            "skipped": self.counters["skipped"],
+            "batches": self.counters["batches"],
+        }
+
+
+status_refresher = StatusRefresher()
+
+
+async def _serve_forever() -> None:
+    init_db()
+    await status_refresher.start()
+    try:
+        await status_refresher._task
+    finally:
+        await status_refresher.stop()
+        await close_clients()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve_forever())
@@ -0,0 +1,117 @@
+"""
+Stock - inventory counts for checkout
+Every catalog line in a cart is decremented by one conditional UPDATE in the
+checkout transaction, so concurrent terminals selling the same SKU never read
+and rewrite the count. Stock comes back when the payment fails or is
+cancelled, and is taken again if a failed payment later succeeds.
+"""
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List
+
+from sqlalchemy import case, update
+from sqlalchemy.orm import Session
+
+from barcode_cache import barcode_cache
+from models import Inventory, Transaction
+
+# reject: refuse the sale when any line lacks stock; allow: sell anyway and let stock go negative
+OVERSELL_POLICY = os.getenv("OVERSELL_POLICY", "reject").lower()
+
+# Transaction statuses that give their stock back
+RELEASED_STATUSES = ("failed", "cancelled")
+
+
+class OutOfStockError(Exception):
+    """Raised when a cart line asks for more than is in stock"""
+
+    def __init__(self, barcodes: List[str]) -> None:
+        super().__init__(f"Insufficient stock for: {', '.join(barcodes)}")
+        self.barcodes = barcodes
+
+
+def _quantities(items: Iterable[Dict[str, Any]]) -> Dict[int, int]:
+    """Quantity per inventory id; client-priced lines carry no inventory id and hold no stock"""
+    quantities: Dict[int, int] = defaultdict(int)
+    for item in items or []:
+        if item.get("inventory_id") is not None:
+            quantities[item["inventory_id"]] += item.get("quantity", 1)
+    return dict(quantities)
+
+
+def _adjust(session: Session, quantities: Dict[int, int], sign: int, conditional: bool = False) -> set:
+    """Add sign * quantity to each item's stock in one statement; returns the ids changed"""
+    change = case(quantities, value=Inventory.id)
+    statement = (
+        update(Inventory)
+        .where(Inventory.id.in_(list(quantities)))
+        .values(stock=Inventory.stock + sign * change, updated_at=datetime.utcnow())
+        .returning(Inventory.id, Inventory.merchant_id, Inventory.barcode)
+        .execution_options(synchronize_session=False)
+    )
+    if conditional:
+        statement = statement.where(Inventory.stock >= change)
+    rows = session.execute(statement).all()
+    barcodes: Dict[int, List[str]] = defaultdict(list)
+    for _, merchant_pk, barcode in rows:
+        barcodes[merchant_pk].append(barcode)
+    for merchant_pk, changed in barcodes.items():
+        barcode_cache.invalidate_on_commit(session, merchant_pk, changed)
+    return {row[0] for row in rows}
+
+
+def reserve_stock(session: Session, items: List[Dict[str, Any]], policy: str = OVERSELL_POLICY) -> bool:
+    """
+    Decrement stock for the cart's catalog lines inside the caller's
+    transaction; returns whether any stock is now held. Under the reject
+    policy a short line raises OutOfStockError and the caller rolls back.
+    """
+    quantities = _quantities(items)
+    if not quantities:
+        return False
+    updated = _adjust(session, quantities, -1, conditional=policy != "allow")
+    short = [
+        item.get("barcode") or item["name"]
+        for item in items
+        if item.get("inventory_id") in quantities and item["inventory_id"] not in updated
+    ]
+    if short:
+        raise OutOfStockError(short)
+    return True
+
+
+def _claim(session: Session, holds: bool, criteria) -> Dict[int, int]:
+    """Flip stock_reserved on matching transactions and total the quantities they held"""
+    rows = session.execute(
+        update(Transaction)
+        .where(Transaction.stock_reserved == (not holds), *criteria)
+        .values(stock_reserved=holds)
+        .returning(Transaction.items)
+        .execution_options(synchronize_session=False)
+    ).scalars()
+    totals: Dict[int, int] = defaultdict(int)
+    for items in rows:
+        for inventory_id, quantity in _quantities(items).items():
+            totals[inventory_id] += quantity
+    return dict(totals)
+
+
+def release_stock(session: Session, *criteria) -> int:
+    """
+    Put back the stock of failed or cancelled transactions matching
+    `criteria`. The stock_reserved flag is flipped in the same statement that
+    selects the rows, so each sale is restocked at most once.
+    """
+    totals = _claim(session, False, (Transaction.status.in_(RELEASED_STATUSES), *criteria))
+    if totals:
+        _adjust(session, totals, 1)
+    return len(totals)
+
+
+def retake_stock(session: Session, *criteria) -> int:
+    """Take stock again for released sales that went on to complete (the goods are gone either way)"""
+    totals = _claim(session, True, (Transaction.status == "completed", *criteria))
+    if totals:
+        _adjust(session, totals, -1)
+    return len(totals)
@@ -4,18 +4,110 @@ Handles PaymentIntent creation, confirmation, and webhook processing
 """
 import stripe
 import os
-from typing import Dict, Optional
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
 from decimal import Decimal
 
+from pos.clients import POS_HTTP_READ_TIMEOUT, get_sync_session
+
 # Initialize Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Point at a local stand-in (benchmarks/provider_standin.py) for load tests
+stripe.api_base = os.getenv("STRIPE_API_BASE", stripe.api_base)
+
+# Reuse pooled keep-alive connections instead of a new TLS handshake per call
+stripe.default_http_client = stripe.http_client.RequestsClient(
+    timeout=POS_HTTP_READ_TIMEOUT,
+    session=get_sync_session("stripe")
+)
+
+class StripeTransientError(ValueError):
+    """Stripe unreachable, rate limiting or failing; `request_sent=False` means it is safe to retry"""
+
+    def __init__(self, message: str, request_sent: bool = True):
+        super().__init__(message)
+        self.request_sent = request_sent
+
+
+def _stripe_error(prefix: str, e: stripe.error.StripeError) -> ValueError:
+    message = f"{prefix}: {str(e)}"
+    if isinstance(e, stripe.error.RateLimitError):
+        return StripeTransientError(message, request_sent=False)
+    if isinstance(e, (stripe.error.APIConnectionError, stripe.error.APIError)):
+        return StripeTransientError(message)
+    return ValueError(message)
+
+
+STRIPE_CUSTOMER_CACHE_SIZE = int(os.getenv("STRIPE_CUSTOMER_CACHE_SIZE", "10000"))
+
+
+class CustomerCache:
+    """
+    Process-level LRU of Protega customer id -> Stripe customer id.
+    Concurrent misses for the same customer share a single Stripe lookup.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key: str, loader: Callable[[], str]) -> str:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = Future()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            return pending.result()
+
+        try:
+            value = loader()
+        except BaseException as exc:
+            pending.set_exception(exc)
+            raise
+        else:
+            self.put(key, value)
+            pending.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+customer_cache = CustomerCache(STRIPE_CUSTOMER_CACHE_SIZE)
+
 
 def create_payment_intent(
     amount: float,
     currency: str = "usd",
     customer_email: Optional[str] = None,
     payment_method_id: Optional[str] = None,
-    metadata: Optional[Dict] = None
+    metadata: Optional[Dict] = None,
+    idempotency_key: Optional[str] = None
 ) -> Dict:
     """
     Create a Stripe PaymentIntent
@@ -26,6 +118,7 @@ def create_payment_intent(
         customer_email: Customer email for receipt
         payment_method_id: Stripe payment method ID
         metadata: Additional metadata
+        idempotency_key: Stripe returns the original intent when a create is retried (optional)
     
     Returns:
         PaymentIntent object with client_secret
@@ -55,7 +148,7 @@ def create_payment_intent(
         intent_params["metadata"] = metadata
     
     try:
-        intent = stripe.PaymentIntent.create(**intent_params)
+        intent = stripe.PaymentIntent.create(idempotency_key=idempotency_key, **intent_params)
         return {
             "id": intent.id,
             "client_secret": intent.client_secret,
@@ -64,16 +157,21 @@ def create_payment_intent(
             "currency": intent.currency
         }
     except stripe.error.StripeError as e:
-        raise ValueError(f"Stripe error: {str(e)}")
+        raise _stripe_error("Stripe error", e)
 
 
-def confirm_payment_intent(payment_intent_id: str, payment_method_id: Optional[str] = None) -> Dict:
+def confirm_payment_intent(
+    payment_intent_id: str,
+    payment_method_id: Optional[str] = None,
+    idempotency_key: Optional[str] = None
+) -> Dict:
     """
     Confirm a PaymentIntent
     
     Args:
         payment_intent_id: Stripe PaymentIntent ID
         payment_method_id: Payment method to attach (optional)
+        idempotency_key: Makes a retried confirmation return the first result (optional)
     
     Returns:
         Confirmed PaymentIntent
@@ -85,7 +183,7 @@ def confirm_payment_intent(payment_intent_id: str, payment_method_id: Optional[s
             intent.payment_method = payment_method_id
         
         if intent.status == "requires_confirmation":
-            intent = intent.confirm()
+            intent = intent.confirm(idempotency_key=idempotency_key)
         
         return {
             "id": intent.id,
@@ -94,7 +192,7 @@ def confirm_payment_intent(payment_intent_id: str, payment_method_id: Optional[s
             "currency": intent.currency
         }
     except stripe.error.StripeError as e:
-        raise ValueError(f"Stripe confirmation error: {str(e)}")
+        raise _stripe_error("Stripe confirmation error", e)
 
 
 def retrieve_payment_intent(payment_intent_id: str) -> Dict:
@@ -114,19 +212,65 @@ def retrieve_payment_intent(payment_intent_id: str) -> Dict:
             "status": intent.status,
             "amount": intent.amount / 100,
             "currency": intent.currency,
-            "payment_method": intent.payment_method
+            "payment_method": intent.payment_method,
+            "created": intent.created,
+            "transaction_id": (intent.metadata or {}).get("transaction_id")
         }
     except stripe.error.StripeError as e:
-        raise ValueError(f"Stripe retrieval error: {str(e)}")
+        raise _stripe_error("Stripe retrieval error", e)
+
+
+def list_payment_intents(
+    created_gte: int,
+    created_lt: int,
+    starting_after: Optional[str] = None,
+    limit: int = 100
+) -> Tuple[List[Dict], bool]:
+    """
+    List PaymentIntents created in a time window, newest first
+    
+    Args:
+        created_gte: Window start (unix seconds, inclusive)
+        created_lt: Window end (unix seconds, exclusive)
+        starting_after: Last PaymentIntent ID of the previous page (optional)
+        limit: Page size, at most 100
+    
+    Returns:
+        (PaymentIntents on this page, whether more pages follow)
+    """
+    try:
+        page = stripe.PaymentIntent.list(
+            created={"gte": created_gte, "lt": created_lt},
+            limit=limit,
+            starting_after=starting_after,
+        )
+        intents = [
+            {
+                "id": intent.id,
+                "status": intent.status,
+                "amount": intent.amount / 100,
+                "created": intent.created,
+                "transaction_id": (intent.metadata or {}).get("transaction_id"),
+            }
+            for intent in page.data
+        ]
+        return intents, bool(page.has_more)
+    except stripe.error.StripeError as e:
+        raise _stripe_error("Stripe list error", e)
 
 
-def create_or_retrieve_customer(email: str, name: Optional[str] = None) -> str:
+def create_or_retrieve_customer(
+    email: str,
+    name: Optional[str] = None,
+    idempotency_key: Optional[str] = None
+) -> str:
     """
     Create or retrieve a Stripe customer
     
     Args:
         email: Customer email
         name: Customer name (optional)
+        idempotency_key: Makes concurrent creates across processes return one customer (optional)
     
     Returns:
         Stripe customer ID
@@ -140,11 +284,39 @@ def create_or_retrieve_customer(email: str, name: Optional[str] = None) -> str:
         # Create new customer
         customer = stripe.Customer.create(
             email=email,
-            name=name
+            name=name,
+            idempotency_key=idempotency_key
         )
         return customer.id
     except stripe.error.StripeError as e:
-        raise ValueError(f"Stripe customer error: {str(e)}")
+        raise _stripe_error("Stripe customer error", e)
+
+
+def resolve_customer_id(
+    customer_reference: Optional[str],
+    email: str,
+    name: Optional[str] = None,
+    stored_id: Optional[str] = None
+) -> str:
+    """
+    Stripe customer ID for a Protega customer: the id persisted on the
+    customer row, then the process cache, then a single Stripe lookup.
+    
+    Callers should persist the result on Customer.stripe_customer_id.
+    """
+    if not customer_reference:
+        return create_or_retrieve_customer(email=email, name=name)
+    if stored_id:
+        customer_cache.put(customer_reference, stored_id)
+        return stored_id
+    return customer_cache.get_or_load(
+        customer_reference,
+        lambda: create_or_retrieve_customer(
+            email=email,
+            name=name,
+            idempotency_key=f"protega-customer-{customer_reference}"
+        )
+    )
 
 
 def attach_payment_method_to_customer(payment_method_id: str, customer_id: str) -> Dict:
@@ -169,7 +341,7 @@ def attach_payment_method_to_customer(payment_method_id: str, customer_id: str)
             "card": payment_method.card if hasattr(payment_method, 'card') else None
         }
     except stripe.error.StripeError as e:
-        raise ValueError(f"Stripe attach error: {str(e)}")
+        raise _stripe_error("Stripe attach error", e)
 
 
 
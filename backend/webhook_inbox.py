@@ -0,0 +1,237 @@
+"""
+Webhook Inbox - durable intake for provider webhook events
+The webhook endpoint verifies the event, stores it keyed by event id and
+acknowledges straight away; the consumer applies status transitions to
+transactions in batches, one UPDATE ... FROM (VALUES ...) per shard.
+
+The consumer runs inside the API process or standalone:
+    python webhook_inbox.py
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from database import ReadSessionLocal, SessionLocal, init_db, insert_for, shards
+from models import Transaction, WebhookEvent
+from payment_status import apply_status_updates
+from pos.resilience import RollingStats
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_FLUSH_INTERVAL = float(os.getenv("WEBHOOK_FLUSH_INTERVAL", "0.5"))
+# Events can beat checkout to the database (the provider id is recorded
+# after the provider answers); keep retrying them for this long
+WEBHOOK_MATCH_WINDOW_SECONDS = float(os.getenv("WEBHOOK_MATCH_WINDOW_SECONDS", "300"))
+WEBHOOK_RETRY_DELAY = 5.0
+
+STRIPE_EVENT_STATUSES = {
+    "payment_intent.succeeded": "completed",
+    "payment_intent.payment_failed": "failed",
+    "payment_intent.canceled": "cancelled",
+}
+
+
+class WebhookInbox:
+    """Stores verified events and applies them to transactions in batches."""
+
+    def __init__(self, batch_size: int = WEBHOOK_BATCH_SIZE, flush_interval: float = WEBHOOK_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.counters = {"received": 0, "duplicates": 0, "applied": 0, "unmatched": 0, "deferred": 0, "batches": 0}
+        self.ingest_lag = RollingStats()
+        self.apply_lag = RollingStats()
+        self._task: Optional[asyncio.Task] = None
+
+    def record_stripe_event(self, db: Session, event) -> bool:
+        """Persist a verified Stripe event; returns False for a redelivery"""
+        target_status = STRIPE_EVENT_STATUSES.get(event["type"])
+        event_object = event["data"]["object"]
+        now = datetime.utcnow()
+        created = datetime.utcfromtimestamp(event["created"]) if event.get("created") else None
+        inserted = db.execute(
+            insert_for(db, WebhookEvent)
+            .values(
+                event_id=event["id"],
+                provider="stripe",
+                type=event["type"],
+                object_id=event_object.get("id"),
+                target_status=target_status,
+                status="pending" if target_status else "ignored",
+                event_created=created,
+                received_at=now,
+                available_at=now,
+            )
+            .on_conflict_do_nothing(index_elements=["event_id"])
+        ).rowcount
+        db.commit()
+
+        if not inserted:
+            self.counters["duplicates"] += 1
+            return False
+        self.counters["received"] += 1
+        if created:
+            self.ingest_lag.record(max(0.0, (now - created).total_seconds()), ok=True)
+        return True
+
+    async def start(self) -> None:
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info("Started webhook consumer")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # Off the event loop: the batch may have to wait for the database writer
+                applied = await asyncio.to_thread(self.apply_batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Webhook consumer failed")
+                applied = 0
+            if applied < self.batch_size:
+                # Let deliveries accumulate into the next batch
+                await asyncio.sleep(self.flush_interval)
+
+    def apply_batch(self) -> int:
+        """Apply one batch of pending events; returns the number of events taken"""
+        now = datetime.utcnow()
+        ready = (WebhookEvent.status == "pending", WebhookEvent.available_at <= now)
+        # Idle polls only read; the writer is taken once there is something to apply
+        with ReadSessionLocal() as db:
+            if db.execute(select(WebhookEvent.event_id).where(*ready).limit(1)).first() is None:
+                return 0
+        with SessionLocal() as db:
+            # SKIP LOCKED lets several consumers share the inbox on Postgres;
+            # the status guard in apply_status_updates keeps reapplying harmless
+            events = db.execute(
+                select(
+                    WebhookEvent.event_id, WebhookEvent.object_id, WebhookEvent.target_status,
+                    WebhookEvent.received_at
+                )
+                .where(*ready)
+                .order_by(WebhookEvent.event_created, WebhookEvent.received_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not events:
+                db.rollback()
+                return 0
+
+            # Later events win for the same payment
+            updates: Dict[str, str] = {}
+            for event in events:
+                if event.object_id:
+                    updates[event.object_id] = event.target_status
+
+            # Payments of merchants mid-move wait until the move is over;
+            # an update on the source shard now could miss the delta copy
+            moving = shards.moving_merchants()
+            matched, deferred = set(), set()
+            with shards.all_sessions(db, for_write=True) as shard_dbs:
+                for shard_db in shard_dbs:
+                    shard_updates = {}
+                    for reference, merchant_id in shard_db.execute(
+                        select(Transaction.provider_transaction_id, Transaction.merchant_id)
+                        .where(Transaction.provider_transaction_id.in_(list(updates)))
+                    ):
+                        if merchant_id in moving:
+                            deferred.add(reference)
+                        else:
+                            shard_updates[reference] = updates[reference]
+                    matched.update(shard_updates)
+                    apply_status_updates(shard_db, shard_updates)
+                    if shard_db is not db:
+                        shard_db.commit()
+            matched -= deferred
+
+            applied_at = datetime.utcnow()
+            match_cutoff = applied_at - timedelta(seconds=WEBHOOK_MATCH_WINDOW_SECONDS)
+            applied = [e.event_id for e in events if e.object_id in matched]
+            unmatched = [e for e in events if e.object_id not in matched and e.object_id not in deferred]
+            expired = [e.event_id for e in unmatched if e.received_at < match_cutoff]
+            waiting = [e.event_id for e in unmatched if e.received_at >= match_cutoff]
+            waiting += [e.event_id for e in events if e.object_id in deferred]
+            if applied:
+                db.execute(
+                    update(WebhookEvent)
+                    .where(WebhookEvent.event_id.in_(applied))
+                    .values(status="applied", applied_at=applied_at)
+                    .execution_options(synchronize_session=False)
+                )
+            if expired:
+                db.execute(
+                    update(WebhookEvent)
+                    .where(WebhookEvent.event_id.in_(expired))
+                    .values(status="unmatched", applied_at=applied_at)
+                    .execution_options(synchronize_session=False)
+                )
+            if waiting:
+                db.execute(
+                    update(WebhookEvent)
+                    .where(WebhookEvent.event_id.in_(waiting))
+                    .values(available_at=applied_at + timedelta(seconds=WEBHOOK_RETRY_DELAY))
+                    .execution_options(synchronize_session=False)
+                )
+            db.commit()
+
+        for event in events:
+            if event.object_id in matched:
+                self.apply_lag.record((applied_at - event.received_at).total_seconds(), ok=True)
+        self.counters["applied"] += len(applied)
+        self.counters["unmatched"] += len(expired)
+        self.counters["deferred"] += sum(1 for e in events if e.object_id in deferred)
+        self.counters["batches"] += 1
+        if expired:
+            logger.warning("Dropped %d webhook events with no matching transaction", len(expired))
+        return len(events)
+
+    def metrics(self) -> Dict:
+        """Inbox backlog from the database plus this process's ingest and apply lag"""
+        now = datetime.utcnow()
+        with ReadSessionLocal() as db:
+            pending, oldest = db.execute(
+                select(func.count(), func.min(WebhookEvent.received_at)).where(WebhookEvent.status == "pending")
+            ).one()
+        ingest = self.ingest_lag.snapshot()
+        apply = self.apply_lag.snapshot()
+        return {
+            "pending": pending,
+            "oldest_pending_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+            "consumer_running": self._task is not None,
+            **self.counters,
+            "ingest_lag_p50_ms": ingest["p50_ms"],
+            "ingest_lag_p95_ms": ingest["p95_ms"],
+            "apply_lag_p50_ms": apply["p50_ms"],
+            "apply_lag_p95_ms": apply["p95_ms"],
+            "apply_lag_p99_ms": apply["p99_ms"],
+        }
+
+
+webhook_inbox = WebhookInbox()
+
+
+async def _serve_forever() -> None:
+    init_db()
+    await webhook_inbox.start()
+    try:
+        await webhook_inbox._task
+    finally:
+        await webhook_inbox.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve_forever())